@@ -29,54 +29,67 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import argparse
+import importlib
+import sys
 
-from . import arguments, train, predict, server, kfserver, cache_embeddings, export, calibrate, run_bootleg, \
-    write_kf_metrics
-from .paraphrase import run_lm_finetuning, run_generation
-from .paraphrase.scripts import split_dataset, dialog_to_tsv, clean_paraphrasing_dataset, transform_dataset
-from .sts import sts_calculate_scores, sts_filter
-
+# each subcommand maps to its help string, and the names (relative to this package) of the functions that add its arguments
+# to a parser and run it; the modules are only imported when the subcommand runs, so that starting a subcommand does not pay
+# for importing the dependencies of all the others
 subcommands = {
     # main commands
-    'train': ('Train a model', arguments.parse_argv, train.main),
-    'export': ('Export a trained model for serving', export.parse_argv, export.main),
-    'predict': ('Evaluate a model, or compute predictions on a test dataset', predict.parse_argv, predict.main),
-    'server': ('Export RPC interface to predict', server.parse_argv, server.main),
-    'cache-embeddings': ('Download and cache embeddings', cache_embeddings.parse_argv, cache_embeddings.main),
-    'train-paraphrase': ('Train a paraphraser model', run_lm_finetuning.parse_argv, run_lm_finetuning.main),
-    'run-paraphrase': ('Run a paraphraser model', run_generation.parse_argv, run_generation.main),
+    'train': ('Train a model', 'arguments.parse_argv', 'train.main'),
+    'export': ('Export a trained model for serving', 'export.parse_argv', 'export.main'),
+    'predict': ('Evaluate a model, or compute predictions on a test dataset', 'predict.parse_argv', 'predict.main'),
+    'server': ('Export RPC interface to predict', 'server.parse_argv', 'server.main'),
+    'load-test': ('Measure the latency of a running server under a given request rate', 'load_test.parse_argv', 'load_test.main'),
+    'cache-embeddings': ('Download and cache embeddings', 'cache_embeddings.parse_argv', 'cache_embeddings.main'),
+    'train-paraphrase': ('Train a paraphraser model', 'paraphrase.run_lm_finetuning.parse_argv', 'paraphrase.run_lm_finetuning.main'),
+    'run-paraphrase': ('Run a paraphraser model', 'paraphrase.run_generation.parse_argv', 'paraphrase.run_generation.main'),
     
     # calibration commands
-    'calibrate': ('Train a confidence calibration model', calibrate.parse_argv, calibrate.main),
+    'calibrate': ('Train a confidence calibration model', 'calibrate.parse_argv', 'calibrate.main'),
 
     # commands that work with datasets
-    'transform-dataset': ('Apply transformations to a tab-separated dataset', transform_dataset.parse_argv, transform_dataset.main),
-    'clean-paraphrasing-dataset': ('Select a clean subset from the ParaBank2 dataset', clean_paraphrasing_dataset.parse_argv, clean_paraphrasing_dataset.main),
-    'dialog-to-tsv': ('Convert a dialog dataset to a turn-by-turn tab-separated format', dialog_to_tsv.parse_argv, dialog_to_tsv.main),
-    'split-dataset': ('Split a dataset file into two files', split_dataset.parse_argv, split_dataset.main),
+    'transform-dataset': ('Apply transformations to a tab-separated dataset', 'paraphrase.scripts.transform_dataset.parse_argv', 'paraphrase.scripts.transform_dataset.main'),
+    'clean-paraphrasing-dataset': ('Select a clean subset from the ParaBank2 dataset', 'paraphrase.scripts.clean_paraphrasing_dataset.parse_argv', 'paraphrase.scripts.clean_paraphrasing_dataset.main'),
+    'dialog-to-tsv': ('Convert a dialog dataset to a turn-by-turn tab-separated format', 'paraphrase.scripts.dialog_to_tsv.parse_argv', 'paraphrase.scripts.dialog_to_tsv.main'),
+    'split-dataset': ('Split a dataset file into two files', 'paraphrase.scripts.split_dataset.parse_argv', 'paraphrase.scripts.split_dataset.main'),
     
     # sts commands
-    'calculate-paraphrase-sts': ('Calculate semantic similarity scores between a dataset and its paraphrase', sts_calculate_scores.parse_argv, sts_calculate_scores.main),
-    'filter-paraphrase-sts': ('Filter paraphrases based on semantic similarity scores', sts_filter.parse_argv, sts_filter.main),
+    'calculate-paraphrase-sts': ('Calculate semantic similarity scores between a dataset and its paraphrase', 'sts.sts_calculate_scores.parse_argv', 'sts.sts_calculate_scores.main'),
+    'filter-paraphrase-sts': ('Filter paraphrases based on semantic similarity scores', 'sts.sts_filter.parse_argv', 'sts.sts_filter.main'),
     
     # bootleg commands
-    'bootleg-dump-features': ('Extract candidate features for named entity mentions in the dataset', run_bootleg.parse_argv, run_bootleg.main),
+    'bootleg-dump-features': ('Extract candidate features for named entity mentions in the dataset', 'run_bootleg.parse_argv', 'run_bootleg.main'),
     
     # kf commands
-    'kfserver': ('Export KFServing interface to predict', server.parse_argv, kfserver.main),
-    'write-kf-metrics': ('Write KF evaluation metrics', write_kf_metrics.parse_argv, write_kf_metrics.main)
+    'kfserver': ('Export KFServing interface to predict', 'server.parse_argv', 'kfserver.main'),
+    'write-kf-metrics': ('Write KF evaluation metrics', 'write_kf_metrics.parse_argv', 'write_kf_metrics.main')
 }
 
 
+def _import_function(name):
+    module_name, function_name = name.rsplit('.', 1)
+    return getattr(importlib.import_module('.' + module_name, __package__), function_name)
+
+
 def main():
+    # only the arguments of the subcommand that runs are needed, so the other subcommands get an empty parser
+    selected_subcommand = sys.argv[1] if len(sys.argv) > 1 else None
+
     parser = argparse.ArgumentParser(prog='genienlp')
     subparsers = parser.add_subparsers(dest='subcommand')
     for subcommand in subcommands:
         helpstr, get_parser, command_fn = subcommands[subcommand]
-        get_parser(subparsers.add_parser(subcommand, help=helpstr))
+        subparser = subparsers.add_parser(subcommand, help=helpstr)
+        if subcommand == selected_subcommand:
+            _import_function(get_parser)(subparser)
 
     argv = parser.parse_args()
-    subcommands[argv.subcommand][2](argv)
+    if argv.subcommand is None:
+        parser.print_help()
+        sys.exit(1)
+    _import_function(subcommands[argv.subcommand][2])(argv)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,274 @@
+#
+# Copyright (c) 2021, Salesforce, Inc.
+#                     The Board of Trustees of the Leland Stanford Junior University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import asyncio
+import itertools
+import logging
+import threading
+
+from .server_protocol import JsonLinesProtocol, PROTOCOLS
+
+logger = logging.getLogger(__name__)
+
+
+class ClientError(Exception):
+    """
+    An error response from the server, with its machine-readable `code` (e.g. `overloaded`)
+    """
+
+    def __init__(self, code, message):
+        super().__init__(f'{code}: {message}')
+        self.code = code
+        self.message = message
+
+
+class _Connection(object):
+    """
+    A connection to the server with any number of requests in flight, matched with their responses by `id`
+    """
+
+    def __init__(self, reader, writer, protocol):
+        self.reader = reader
+        self.writer = writer
+        self.protocol = protocol
+        # request ID -> (future of the response, partial answer callback)
+        self.pending = dict()
+        self.closed = False
+        self._read_task = asyncio.ensure_future(self._read_responses())
+
+    @classmethod
+    async def open(cls, host, port, protocol):
+        reader, writer = await asyncio.open_connection(host, port)
+        if protocol is not JsonLinesProtocol:
+            writer.write(JsonLinesProtocol.encode({'protocol': protocol.name}))
+            reply = JsonLinesProtocol.decode(await reader.readline())
+            if 'error' in reply:
+                writer.close()
+                raise ClientError(reply['error'], reply.get('message'))
+        return cls(reader, writer, protocol)
+
+    async def _read_responses(self):
+        error = ConnectionError('Connection closed by the server')
+        try:
+            while True:
+                data = await self.protocol.read(self.reader)
+                if data is None:
+                    break
+                message = self.protocol.decode(data)
+                entry = self.pending.get(message.get('id'))
+                if entry is None:
+                    logger.warning('Received a response for unknown request %s', message.get('id'))
+                    continue
+                future, on_partial = entry
+                if 'partial' in message:
+                    if on_partial is not None:
+                        on_partial(message)
+                    continue
+                del self.pending[message['id']]
+                if future.done():
+                    continue
+                if 'error' in message:
+                    future.set_exception(ClientError(message['error'], message.get('message')))
+                else:
+                    future.set_result(message)
+        except Exception as e:
+            error = e
+        finally:
+            self.closed = True
+            for future, _on_partial in self.pending.values():
+                if not future.done():
+                    future.set_exception(error)
+            self.pending.clear()
+
+    async def send(self, request, on_partial=None):
+        if self.closed:
+            raise ConnectionError('Connection closed')
+        future = asyncio.get_event_loop().create_future()
+        self.pending[request['id']] = (future, on_partial)
+        self.writer.write(self.protocol.encode(request))
+        await self.writer.drain()
+        return await future
+
+    async def close(self):
+        self.writer.close()
+        await self._read_task
+
+
+class AsyncClient(object):
+    """
+    A client for `genienlp server`, for use from asyncio code.
+    It keeps a pool of up to `pool_size` connections, and pipelines requests on them: each request is sent as soon
+    as it is made, on the connection with the fewest requests in flight (a new connection is opened while the pool
+    is not full), and matched with its response by `id`. Request IDs are assigned by the client; the ID given by
+    the caller, if any, is restored in the response.
+    `protocol` is the wire protocol, either `json` or `msgpack`.
+    """
+
+    def __init__(self, host='localhost', port=8401, pool_size=4, protocol='json'):
+        if protocol not in PROTOCOLS:
+            raise ValueError(f'Unknown protocol {protocol}, expected one of {list(PROTOCOLS)}')
+        self.host = host
+        self.port = port
+        self.pool_size = pool_size
+        self.protocol = PROTOCOLS[protocol]
+        self._connections = []
+        # tasks opening new connections
+        self._opening = set()
+        self._ids = itertools.count()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def _open_connection(self):
+        try:
+            connection = await _Connection.open(self.host, self.port, self.protocol)
+            self._connections.append(connection)
+            return connection
+        finally:
+            self._opening.discard(asyncio.current_task())
+
+    async def _connection(self):
+        while True:
+            self._connections = [connection for connection in self._connections if not connection.closed]
+            least_busy = min(self._connections, key=lambda connection: len(connection.pending), default=None)
+            pool_full = len(self._connections) + len(self._opening) >= self.pool_size
+            if least_busy is not None and (not least_busy.pending or pool_full):
+                return least_busy
+            if not pool_full:
+                task = asyncio.ensure_future(self._open_connection())
+                self._opening.add(task)
+                return await task
+            # all the connections of the pool are still being opened
+            await asyncio.wait(self._opening, return_when=asyncio.FIRST_COMPLETED)
+
+    async def request(self, request, on_partial=None):
+        """
+        Sends `request` (a dictionary with the fields described in the README) and returns the response message.
+        If `on_partial` is provided, it is called with each partial answer message of a streaming request.
+        Raises ClientError if the server responds with an error
+        """
+        request = dict(request)
+        caller_id = request.get('id')
+        request['id'] = next(self._ids)
+        if on_partial is not None:
+            callback = on_partial
+
+            def on_partial(message):
+                message['id'] = caller_id
+                callback(message)
+
+        connection = await self._connection()
+        response = await connection.send(request, on_partial)
+        response['id'] = caller_id
+        return response
+
+    async def predict(self, context, question='', task='generic', **fields):
+        """
+        Returns the answer of the model for a single instance. Additional `fields` are added to the request
+        (e.g. `deadline_ms` or `priority`)
+        """
+        response = await self.request(dict(fields, task=task, context=context, question=question))
+        return response['answer']
+
+    async def predict_batch(self, instances, task='generic', **fields):
+        """
+        Returns the responses of the model for a list of instances, each a dictionary with `context` and `question`
+        (and optionally `example_id`). Each response is a dictionary with `answer` (and `score`, if the server has calibrators)
+        """
+        response = await self.request(dict(fields, task=task, instances=instances))
+        return response['instances']
+
+    async def score(self, context, candidates, question='', task='generic', **fields):
+        """
+        Returns the log-probability that the model assigns to each of the `candidates` answers for a single instance,
+        as a list of dictionaries with `answer`, `log_prob` and `token_log_probs`
+        """
+        response = await self.request(dict(fields, task=task, context=context, question=question, candidates=candidates))
+        return response['candidates']
+
+    async def close(self):
+        connections, self._connections = self._connections, []
+        for connection in connections:
+            await connection.close()
+
+
+class Client(object):
+    """
+    A client for `genienlp server`, for use from synchronous code. It runs an AsyncClient with the same arguments
+    on an event loop in a background thread, and can be used from any number of threads at the same time:
+    concurrent calls are pipelined on the same connections. `submit` returns a `concurrent.futures.Future` instead
+    of waiting, to pipeline requests from a single thread.
+    """
+
+    def __init__(self, *args, timeout=None, **kwargs):
+        self.timeout = timeout
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='genienlp-client', daemon=True)
+        self._thread.start()
+        self._client = AsyncClient(*args, **kwargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, request, on_partial=None):
+        """
+        Sends `request` and returns a future of its response (see `AsyncClient.request`).
+        `on_partial` is called from the background thread
+        """
+        return asyncio.run_coroutine_threadsafe(self._client.request(request, on_partial), self._loop)
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result(self.timeout)
+
+    def request(self, request, on_partial=None):
+        return self.submit(request, on_partial).result(self.timeout)
+
+    def predict(self, context, question='', task='generic', **fields):
+        return self._run(self._client.predict(context, question, task, **fields))
+
+    def predict_batch(self, instances, task='generic', **fields):
+        return self._run(self._client.predict_batch(instances, task, **fields))
+
+    def score(self, context, candidates, question='', task='generic', **fields):
+        return self._run(self._client.score(context, candidates, question, task, **fields))
+
+    def close(self):
+        if not self._loop.is_running():
+            return
+        self._run(self._client.close())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
@@ -86,24 +86,32 @@ def bootleg_process_examples(ex, bootleg_annotator, args, label, task):
     return ex
 
 
-def extract_features_with_annotator(examples, bootleg_annotator, args, task):
+def label_utterances(bootleg_annotator, utterances):
+    """
+    Runs `bootleg_annotator` on a list of utterances in a single batch, and returns the label (a dictionary) of each utterance
+    """
     with torch.no_grad():
-        bootleg_inputs = []
-        for ex in examples:
-            bootleg_inputs.append(getattr(ex, task.utterance_field()))
-        
-        bootleg_labels = bootleg_annotator.label_mentions(bootleg_inputs)
-        
-        keys = tuple(bootleg_labels.keys())
-        values = list(bootleg_labels.values())
-        values_unpacked = list(zip(*values))
+        bootleg_labels = bootleg_annotator.label_mentions(utterances)
+    
+    keys = tuple(bootleg_labels.keys())
+    values = list(bootleg_labels.values())
+    values_unpacked = list(zip(*values))
 
-        bootleg_labels_unpacked = [dict(zip(keys, values)) for values in values_unpacked]
-        
-        for i in range(len(examples)):
-            ex = examples[i]
-            label = bootleg_labels_unpacked[i]
-            examples[i] = bootleg_process_examples(ex, bootleg_annotator, args, label, task)
+    return [dict(zip(keys, values)) for values in values_unpacked]
+
+
+def extract_features_with_annotator(examples, bootleg_annotator, args, task, labels=None):
+    """
+    Adds the entity features of `examples`, using `labels` (one for the utterance of each example, as returned by
+    `label_utterances`) if provided, or running `bootleg_annotator` on them otherwise
+    """
+    if labels is None:
+        labels = label_utterances(bootleg_annotator, [getattr(ex, task.utterance_field()) for ex in examples])
+    
+    for i in range(len(examples)):
+        ex = examples[i]
+        label = labels[i]
+        examples[i] = bootleg_process_examples(ex, bootleg_annotator, args, label, task)
 
 
 def init_bootleg_annotator(args, device):
@@ -105,6 +105,9 @@ class TransformerNumericalizer(object):
         self._special_tokens_to_token_regexes = []
         
         self.args = args
+        
+        # names of the tasks whose special tokens are already part of the vocabulary
+        self._tasks_in_vocab = set()
 
         self._init_tokenizer(save_dir, config, src_lang, tgt_lang)
         
@@ -215,6 +218,7 @@ class TransformerNumericalizer(object):
         special_tokens = []
         for task in tasks:
             special_tokens += list(task.special_tokens)
+            self._tasks_in_vocab.add(task.name)
         special_tokens.sort()
         
         if self._preprocess_special_tokens:
@@ -272,8 +276,12 @@ class TransformerNumericalizer(object):
             return
         
         # add the new special tokens from the task
+        # adding tokens is not free even if they are already in the vocabulary, so each task is only added once
         for task in tasks:
+            if task.name in self._tasks_in_vocab:
+                continue
             self._tokenizer.add_tokens(list(task.special_tokens))
+            self._tasks_in_vocab.add(task.name)
     
     def _build_special_tokens_maps(self, special_tokens):
         # we automatically construct the mapping from special tokens to the shortest unambiguous
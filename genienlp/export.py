@@ -32,9 +32,10 @@ import os
 import shutil
 import torch
 
-from .util import load_config_json
+from .util import load_config_json, add_quantization_arguments, quantize_model
 from . import models
 from .calibrate import ConfidenceEstimator
+from .model_utils.inference_checkpoint import save_inference_checkpoint, INFERENCE_CHECKPOINT_EXTENSION
 
 logger = logging.getLogger(__name__)
 
@@ -47,15 +48,24 @@ def parse_argv(parser):
                         help='Checkpoint file to use (relative to --path, defaults to best.pth)')
     parser.add_argument('-o', '--output', required=True,
                         help='the directory where to export into')
+    add_quantization_arguments(parser)
+    parser.add_argument('--inference_checkpoint', action='store_true',
+                        help='Save the weights in a memory-mappable inference checkpoint (same name as --checkpoint_name, with '
+                        f'the {INFERENCE_CHECKPOINT_EXTENSION} extension) instead of copying the checkpoint. Pass its name as '
+                        '--checkpoint_name to `predict` and `server`.')
+    parser.add_argument('--torchscript', action='store_true',
+                        help='Also save TorchScript graphs of the model, for `--runtime torchscript` (TransformerSeq2Seq models only)')
 
 
 def main(args):
+    if args.inference_checkpoint and args.quantize is not None:
+        raise ValueError('Quantized models cannot be saved in an inference checkpoint, quantize them when loading them instead')
     os.makedirs(args.output, exist_ok=True)
     load_config_json(args)
 
     # load everything - this will ensure that we initialize the numericalizer correctly
     Model = getattr(models, args.model)
-    model, _ = Model.load(args.path,
+    model, best_decascore = Model.load(args.path,
                                      model_checkpoint_file=args.checkpoint_name,
                                      args=args,
                                      device=torch.device('cpu'),
@@ -66,8 +76,23 @@ def main(args):
     # this will copy over all the necessary vocabulary and config files that the numericalizer needs
     model.numericalizer.save(args.output)
 
-    # now copy over the config.json, checkpoint file, and calibrator files (if any)
-    for fn in ['config.json', args.checkpoint_name] + [fn for fn in os.listdir(args.path) if ConfidenceEstimator.is_estimator(fn)]:
+    # quantized models are saved with their quantization settings, so that loading them quantizes the model before
+    # loading the state dict
+    copied_files = ['config.json']
+    if args.inference_checkpoint:
+        checkpoint_name = os.path.splitext(args.checkpoint_name)[0] + INFERENCE_CHECKPOINT_EXTENSION
+        save_inference_checkpoint(model.state_dict(), os.path.join(args.output, checkpoint_name), {'best_decascore': best_decascore})
+    elif args.quantize is not None:
+        quantize_model(model, args, torch.device('cpu'))
+        torch.save({'model_state_dict': model.state_dict(), 'best_decascore': best_decascore, 'quantization': model.quantization},
+                   os.path.join(args.output, args.checkpoint_name))
+    else:
+        copied_files.append(args.checkpoint_name)
+    if args.torchscript:
+        model.export_torchscript(args.output)
+
+    # now copy over the config.json, checkpoint file (unless it was saved above), and calibrator files (if any)
+    for fn in copied_files + [fn for fn in os.listdir(args.path) if ConfidenceEstimator.is_estimator(fn)]:
         src = os.path.join(args.path, fn)
         dst = os.path.join(args.output, fn)
         shutil.copyfile(src, dst)
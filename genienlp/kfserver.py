@@ -28,12 +28,19 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import asyncio
+import gc
+import json
 import logging
 
 import kfserving
+import torch
+import tornado.process
+import tornado.web
 
 from .util import log_model_size
-from .server import Server, init
+from .server import Server, ServerError, init, worker_num_threads
+from .server_metrics import start_metrics_server
 
 logger = logging.getLogger(__name__)
 
@@ -47,15 +54,92 @@ class KFModelServer(kfserving.KFModel):
         log_model_size(logger, self.server.model, self.server.args.model)
         self.server.model.to(self.server.device)
         self.server.model.eval()
+        if self.server.args.metrics_port is not None and self.server.args.workers <= 1:
+            start_metrics_server(self.server.metrics, self.server.args.metrics_port)
+        # KFServing only reports the model as ready, and KFServer only starts listening, once this returns
+        self.server.warmup()
+        self.server.metrics.reset()
+        self.server.metrics.ready = True
         self.ready = True
 
-    def predict(self, request):
-        results = self.server.handle_request(request)
+    def _start_process(self):
+        """
+        Initializes the state that cannot be shared between worker processes. With --workers, KFServer forks
+        the workers after the model is loaded, so this runs in each worker when it receives its first request.
+        """
+        args = self.server.args
+        if args.workers > 1:
+            worker_id = tornado.process.task_id()
+            torch.set_num_threads(worker_num_threads(args))
+            if args.metrics_port is not None:
+                start_metrics_server(self.server.metrics, args.metrics_port + worker_id)
+        self.server.batcher = self.server.make_batcher()
+        asyncio.ensure_future(self.server.batcher.run())
+
+    async def predict(self, request, stream=None):
+        # concurrent HTTP requests are batched together, like in the TCP server
+        if self.server.batcher is None:
+            self._start_process()
+        try:
+            results = await self.server.batcher.submit(request, stream)
+        except ServerError as e:
+            status_code = 503 if e.code in ('overloaded', 'deadline_exceeded') else 400
+            raise tornado.web.HTTPError(status_code=status_code, reason=e.message)
         return {"predictions": results}
 
 
+class StreamHandler(tornado.web.RequestHandler):
+    """
+    Same as the :predict endpoint, except that the response is a sequence of JSON lines: the partial answers
+    of the instances of the request while they are being generated, then the final response
+    """
+
+    def initialize(self, model_server):
+        self.model_server = model_server
+
+    async def post(self, name):
+        if name != self.model_server.name:
+            raise tornado.web.HTTPError(status_code=404, reason=f'Model with name {name} does not exist.')
+        try:
+            request = json.loads(self.request.body)
+        except json.decoder.JSONDecodeError as e:
+            raise tornado.web.HTTPError(status_code=400, reason=f'Unrecognized request format: {e}')
+
+        self.set_header('Content-Type', 'application/x-ndjson')
+        stream = self.model_server.server.partial_stream(request, 'instances' in request, self._send)
+        response = await self.model_server.predict(request, stream)
+        self._send(response)
+
+    def _send(self, message):
+        self.write(json.dumps(message) + '\n')
+        self.flush()
+
+
+class GenieKFServer(kfserving.KFServer):
+    """
+    KFServer with an additional /v1/models/<name>:stream endpoint
+    """
+
+    def __init__(self, model_server, **kwargs):
+        super().__init__(**kwargs)
+        self.model_server = model_server
+
+    def create_application(self):
+        application = super().create_application()
+        application.add_handlers(r'.*', [(r'/v1/models/([a-zA-Z0-9_-]+):stream', StreamHandler, dict(model_server=self.model_server))])
+        return application
+
+
 def main(args):
+    if args.workers > 1:
+        # see server.main
+        torch.set_num_threads(1)
     model, device, confidence_estimators, estimator_filenames, bootleg_annotator = init(args)
+    if args.workers > 1 and device.type != 'cpu':
+        raise ValueError('--workers is only supported when running on CPU')
     model_server = KFModelServer(args.inference_name, args, model.numericalizer, model, device, confidence_estimators, estimator_filenames, bootleg_annotator)
     model_server.load()
-    kfserving.KFServer(workers=1).start([model_server])
+    if args.workers > 1:
+        # keep the pages of the model shared by the workers, see Server._run_workers
+        gc.freeze()
+    GenieKFServer(model_server, workers=args.workers).start([model_server])
@@ -0,0 +1,189 @@
+#
+# Copyright (c) 2021, Salesforce, Inc.
+#                     The Board of Trustees of the Leland Stanford Junior University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import asyncio
+import json
+import logging
+import random
+import shlex
+import socket
+import subprocess
+import sys
+import time
+from collections import Counter, OrderedDict
+
+import numpy as np
+
+from .client import AsyncClient, ClientError
+
+logger = logging.getLogger(__name__)
+
+QUANTILES = [0.5, 0.9, 0.95, 0.99]
+
+
+def parse_argv(parser):
+    parser.add_argument('--input', type=str, required=True,
+                        help='TSV file with the inputs to send, one request per line. Lines are reused if --num_requests is larger')
+    parser.add_argument('--context_column', type=int, default=1, help='Column of the TSV file with the context of each request')
+    parser.add_argument('--question_column', type=int, default=None,
+                        help='Column of the TSV file with the question of each request. Defaults to the default question of the task')
+    parser.add_argument('--task', type=str, default='almond', help='Task of the requests')
+    parser.add_argument('--request_fields', type=json.loads, default={},
+                        help='JSON object with additional fields for every request, e.g. {"priority": "bulk"}')
+    parser.add_argument('--qps', type=float, default=10, help='Target number of requests per second')
+    parser.add_argument('--num_requests', type=int, default=None, help='Number of requests to send. Defaults to the number of lines of --input')
+    parser.add_argument('--poisson', action='store_true',
+                        help='Send requests at exponentially distributed intervals (like independent users), instead of evenly spaced')
+    parser.add_argument('--host', type=str, default='localhost', help='Host of the server')
+    parser.add_argument('--port', type=int, default=8401, help='TCP port of the server')
+    parser.add_argument('--connections', type=int, default=4, help='Maximum number of connections to the server')
+    parser.add_argument('--protocol', choices=['json', 'msgpack'], default='json', help='Wire protocol')
+    parser.add_argument('--path', type=str, default=None,
+                        help='If provided, start `genienlp server` with the model in this directory on --port, and stop it at the end')
+    parser.add_argument('--server_args', type=str, default='', help='Additional arguments of the server started with --path')
+    parser.add_argument('--server_timeout', type=float, default=600,
+                        help='Maximum time (in seconds) to wait for the server started with --path to accept connections')
+    parser.add_argument('--max_error_rate', type=float, default=0.0,
+                        help='Exit with an error if a larger fraction of the requests fails')
+    parser.add_argument('--output', type=str, default=None, help='If provided, write the results in JSON format to this file')
+    parser.add_argument('--seed', type=int, default=123, help='Random seed for --poisson')
+
+
+def read_inputs(args):
+    inputs = []
+    with open(args.input) as fp:
+        for line in fp:
+            parts = line.rstrip('\n').split('\t')
+            context = parts[args.context_column]
+            question = parts[args.question_column] if args.question_column is not None else ''
+            inputs.append((context, question))
+    if not inputs:
+        raise ValueError(f'{args.input} is empty')
+    return inputs
+
+
+def start_server(args):
+    command = [sys.executable, '-m', 'genienlp', 'server', '--path', args.path, '--port', str(args.port)] + shlex.split(args.server_args)
+    logger.info('Starting server: %s', ' '.join(command))
+    process = subprocess.Popen(command)
+    deadline = time.time() + args.server_timeout
+    # the server only listens once the model is loaded and warmed up
+    while True:
+        if process.poll() is not None:
+            raise RuntimeError(f'The server exited with status {process.returncode}')
+        try:
+            socket.create_connection((args.host, args.port), timeout=1).close()
+            return process
+        except OSError:
+            if time.time() > deadline:
+                process.terminate()
+                raise RuntimeError(f'The server did not accept connections within {args.server_timeout} seconds')
+            time.sleep(1)
+
+
+async def send_requests(args, inputs):
+    """
+    Sends requests at the target rate, without waiting for the previous responses (an open-loop load).
+    Returns the latency of each successful request in seconds, the error code of each failed request, and the total time
+    """
+    num_requests = args.num_requests if args.num_requests is not None else len(inputs)
+    rng = random.Random(args.seed)
+    latencies = []
+    errors = []
+
+    async with AsyncClient(args.host, args.port, pool_size=args.connections, protocol=args.protocol) as client:
+        async def send(request):
+            start = time.perf_counter()
+            try:
+                await client.request(request)
+                latencies.append(time.perf_counter() - start)
+            except ClientError as e:
+                errors.append(e.code)
+            except Exception as e:
+                errors.append(type(e).__name__)
+
+        tasks = []
+        start = time.perf_counter()
+        send_time = start
+        for i in range(num_requests):
+            delay = send_time - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            context, question = inputs[i % len(inputs)]
+            request = dict(args.request_fields, id=i, task=args.task, context=context, question=question)
+            tasks.append(asyncio.ensure_future(send(request)))
+            send_time += rng.expovariate(args.qps) if args.poisson else 1 / args.qps
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+
+    return latencies, errors, elapsed
+
+
+def summarize(args, latencies, errors, elapsed):
+    num_requests = len(latencies) + len(errors)
+    results = OrderedDict([
+        ('requests', num_requests),
+        ('target_qps', args.qps),
+        ('achieved_qps', len(latencies) / elapsed if elapsed > 0 else 0.0),
+        ('errors', dict(Counter(errors))),
+        ('error_rate', len(errors) / num_requests if num_requests else 0.0),
+    ])
+    if latencies:
+        latencies_ms = np.array(latencies) * 1000
+        results['latency_ms'] = OrderedDict([('mean', float(latencies_ms.mean()))] +
+                                            [(f'p{int(q * 100)}', float(np.quantile(latencies_ms, q))) for q in QUANTILES] +
+                                            [('max', float(latencies_ms.max()))])
+    return results
+
+
+def main(args):
+    inputs = read_inputs(args)
+    server = start_server(args) if args.path is not None else None
+    try:
+        latencies, errors, elapsed = asyncio.run(send_requests(args, inputs))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    results = summarize(args, latencies, errors, elapsed)
+    print(f'Sent {results["requests"]} requests in {elapsed:.1f} s ({results["achieved_qps"]:.1f} successful requests per second, '
+          f'target {args.qps:g})')
+    if 'latency_ms' in results:
+        print('Latency (ms): ' + ', '.join(f'{name} {value:.1f}' for name, value in results['latency_ms'].items()))
+    if errors:
+        print(f'Errors: {results["errors"]}')
+    if args.output is not None:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
+
+    if results['error_rate'] > args.max_error_rate:
+        logger.error('%.1f%% of the requests failed', results['error_rate'] * 100)
+        sys.exit(1)
@@ -0,0 +1,230 @@
+#
+# Copyright (c) 2021, Salesforce, Inc.
+#                     The Board of Trustees of the Leland Stanford Junior University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import functools
+import json
+import struct
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+from transformers import PreTrainedModel
+
+# Inference checkpoints use the safetensors layout: the length of the header (8 bytes, little endian), a JSON header
+# with the dtype, shape and offsets of each tensor in the data, and the raw data of all the tensors.
+# Tensors that share memory in the state dict (tied weights) are only stored once, and listed in the
+# "aliases" entry of the metadata of the header.
+INFERENCE_CHECKPOINT_EXTENSION = '.safetensors'
+
+_DTYPES = OrderedDict([
+    (torch.float64, ('F64', np.float64)),
+    (torch.float32, ('F32', np.float32)),
+    (torch.float16, ('F16', np.float16)),
+    (torch.int64, ('I64', np.int64)),
+    (torch.int32, ('I32', np.int32)),
+    (torch.int16, ('I16', np.int16)),
+    (torch.int8, ('I8', np.int8)),
+    (torch.uint8, ('U8', np.uint8)),
+    (torch.bool, ('BOOL', np.bool_)),
+])
+_NUMPY_DTYPES = {name: numpy_dtype for name, numpy_dtype in _DTYPES.values()}
+
+# the data starts at a multiple of this, so that memory-mapped tensors are aligned
+_DATA_ALIGNMENT = 64
+
+
+def is_inference_checkpoint(path):
+    return path.endswith(INFERENCE_CHECKPOINT_EXTENSION)
+
+
+def save_inference_checkpoint(state_dict, path, metadata=None):
+    """
+    Saves the tensors of `state_dict`, and `metadata` (a dict of JSON-serializable values), to `path` in a format that
+    `load_inference_checkpoint()` can memory-map
+    """
+    tensors = OrderedDict()
+    aliases = {}
+    names_by_memory = {}
+    for name, tensor in state_dict.items():
+        if not isinstance(tensor, torch.Tensor) or tensor.dtype not in _DTYPES or tensor.is_quantized:
+            raise ValueError(f'{name} cannot be saved in an inference checkpoint')
+        memory = (tensor.data_ptr(), tensor.dtype, tuple(tensor.shape), tensor.stride())
+        if tensor.numel() > 0 and memory in names_by_memory:
+            aliases[name] = names_by_memory[memory]
+            continue
+        names_by_memory[memory] = name
+        tensors[name] = tensor.detach().cpu().contiguous()
+
+    # tensors with larger items go first, so that every tensor starts at a multiple of the size of its items
+    names = sorted(tensors.keys(), key=lambda name: -tensors[name].element_size())
+    header = OrderedDict()
+    offset = 0
+    for name in names:
+        tensor = tensors[name]
+        size = tensor.numel() * tensor.element_size()
+        header[name] = {'dtype': _DTYPES[tensor.dtype][0], 'shape': list(tensor.shape), 'data_offsets': [offset, offset + size]}
+        offset += size
+    # safetensors only allows strings in the metadata
+    header['__metadata__'] = {key: json.dumps(value) for key, value in dict(metadata or {}, aliases=aliases).items()}
+
+    encoded_header = json.dumps(header).encode('utf-8')
+    encoded_header += b' ' * (-(8 + len(encoded_header)) % _DATA_ALIGNMENT)
+    with open(path, 'wb') as checkpoint_file:
+        checkpoint_file.write(struct.pack('<Q', len(encoded_header)))
+        checkpoint_file.write(encoded_header)
+        for name in names:
+            checkpoint_file.write(tensors[name].numpy().tobytes())
+
+
+def load_inference_checkpoint(path):
+    """
+    Memory-maps the checkpoint saved by `save_inference_checkpoint()` at `path`. The tensors share the page cache with other
+    processes that load the same file until they are written to (the mapping is copy-on-write).
+    Returns a state dict and the metadata
+    """
+    with open(path, 'rb') as checkpoint_file:
+        header_size, = struct.unpack('<Q', checkpoint_file.read(8))
+        header = json.loads(checkpoint_file.read(header_size).decode('utf-8'))
+    metadata = {key: json.loads(value) for key, value in header.pop('__metadata__', {}).items()}
+    aliases = metadata.pop('aliases', {})
+
+    data_size = max([tensor['data_offsets'][1] for tensor in header.values()], default=0)
+    data = np.memmap(path, dtype=np.uint8, mode='c', offset=8 + header_size, shape=(data_size,)) if data_size > 0 else None
+    state_dict = OrderedDict()
+    for name, tensor in header.items():
+        begin, end = tensor['data_offsets']
+        numpy_dtype = _NUMPY_DTYPES[tensor['dtype']]
+        if begin == end:
+            array = np.empty(tensor['shape'], dtype=numpy_dtype)
+        else:
+            array = data[begin:end].view(numpy_dtype).reshape(tensor['shape'])
+        state_dict[name] = torch.from_numpy(array)
+    for name, target in aliases.items():
+        state_dict[name] = state_dict[target]
+
+    return state_dict, metadata
+
+
+# the functions of `torch.nn.init` that no_weight_init() skips
+_INIT_FUNCTIONS = ['uniform_', 'normal_', 'trunc_normal_', 'constant_', 'ones_', 'zeros_', 'eye_', 'dirac_',
+                   'xavier_uniform_', 'xavier_normal_', 'kaiming_uniform_', 'kaiming_normal_', 'orthogonal_', 'sparse_']
+
+# whether the current thread is in no_weight_init()
+_no_init = threading.local()
+# protects the installation of the functions that skip initialization, and the number of threads using them
+_patch_lock = threading.Lock()
+_patch_users = 0
+_original_functions = dict()
+
+
+def _skipping_init(function):
+    @functools.wraps(function)
+    def init(tensor, *args, **kwargs):
+        if getattr(_no_init, 'active', False):
+            return tensor
+        return function(tensor, *args, **kwargs)
+    return init
+
+
+def _skipping_init_weights(function):
+    @functools.wraps(function)
+    def init_weights(self):
+        if getattr(_no_init, 'active', False):
+            self.tie_weights()
+        else:
+            function(self)
+    return init_weights
+
+
+@contextmanager
+def no_weight_init():
+    """
+    Skips the random initialization of the weights of the modules (and `transformers` models) created in this context,
+    for models whose weights are all replaced afterwards. The memory of the weights is allocated but never written, so
+    it does not count towards the resident memory of the process.
+    Only the current thread is affected: models created at the same time by other threads are initialized as usual.
+    """
+    global _patch_users
+    with _patch_lock:
+        if _patch_users == 0:
+            # the initialization functions are module attributes, so they can only be replaced for the whole process;
+            # the replacements check which thread calls them
+            for name in _INIT_FUNCTIONS:
+                if hasattr(torch.nn.init, name):
+                    _original_functions[name] = getattr(torch.nn.init, name)
+                    setattr(torch.nn.init, name, _skipping_init(_original_functions[name]))
+            _original_functions['init_weights'] = PreTrainedModel.init_weights
+            PreTrainedModel.init_weights = _skipping_init_weights(_original_functions['init_weights'])
+        _patch_users += 1
+
+    was_active = getattr(_no_init, 'active', False)
+    _no_init.active = True
+    try:
+        yield
+    finally:
+        _no_init.active = was_active
+        with _patch_lock:
+            _patch_users -= 1
+            if _patch_users == 0:
+                PreTrainedModel.init_weights = _original_functions.pop('init_weights')
+                for name, function in _original_functions.items():
+                    setattr(torch.nn.init, name, function)
+                _original_functions.clear()
+
+
+def assign_state_dict(model, state_dict):
+    """
+    Like `model.load_state_dict(state_dict, strict=True)`, but the tensors of `state_dict` become the parameters and buffers
+    of `model` instead of being copied into them. Tensors that are shared in `state_dict` are shared in `model`.
+    """
+    expected_names = set(model.state_dict().keys())
+    missing_names = expected_names - set(state_dict.keys())
+    unexpected_names = set(state_dict.keys()) - expected_names
+    if missing_names or unexpected_names:
+        raise RuntimeError(f'Error assigning state dict to {type(model).__name__}: missing keys {sorted(missing_names)}, '
+                           f'unexpected keys {sorted(unexpected_names)}')
+
+    parameters = dict()
+    for name, tensor in state_dict.items():
+        module = model
+        *module_names, tensor_name = name.split('.')
+        for module_name in module_names:
+            module = getattr(module, module_name)
+        current = module._parameters.get(tensor_name, module._buffers.get(tensor_name))
+        if current.shape != tensor.shape:
+            raise RuntimeError(f'Size mismatch for {name}: the checkpoint has {tuple(tensor.shape)}, the model has {tuple(current.shape)}')
+        if tensor_name in module._parameters:
+            if id(tensor) not in parameters:
+                parameters[id(tensor)] = torch.nn.Parameter(tensor, requires_grad=current.requires_grad)
+            module._parameters[tensor_name] = parameters[id(tensor)]
+        else:
+            module._buffers[tensor_name] = tensor
@@ -32,13 +32,29 @@ import logging
 import os
 
 from transformers import PreTrainedModel
+from ..data_utils.example import SequentialField
+from ..model_utils.inference_checkpoint import is_inference_checkpoint, load_inference_checkpoint, no_weight_init, assign_state_dict
 from ..data_utils.numericalizer import TransformerNumericalizer
+from ..util import format_quantization
 
 logger = logging.getLogger(__name__)
 
 
 class GenieModel(PreTrainedModel):
     numericalizer: TransformerNumericalizer
+    # whether the model implements `start_greedy_decoding()`
+    supports_incremental_decoding = False
+    # whether the model implements `encode()`, and `generate()` accepts its output as `encoder_hidden_states`
+    supports_encoder_outputs = False
+    # whether the model implements `score()`
+    supports_scoring = False
+    # whether the output of `encode()` is a tensor of shape (batch_size, input_length, hidden_size), where the states of the
+    # tokens of each input do not depend on the rest of the batch, so they can be cached separately
+    token_encoder_outputs = False
+    # name of the module that maps decoder states to vocabulary logits
+    lm_head_name = None
+    # None, or the settings that `quantize()` was called with
+    quantization = None
 
     @classmethod
     def load(cls, save_directory: str, *model_args, **kwargs):
@@ -55,21 +71,144 @@ class GenieModel(PreTrainedModel):
 
         full_checkpoint_path = os.path.join(save_directory, model_checkpoint_file)
         logger.info(f'Loading the model from {full_checkpoint_path}')
+        if is_inference_checkpoint(full_checkpoint_path):
+            # all the weights come from the checkpoint, which is memory-mapped instead of copied
+            with no_weight_init():
+                model = cls(args=args, tasks=tasks, vocab_sets=vocab_sets, save_directory=save_directory, *model_args, **kwargs)
+            state_dict, metadata = load_inference_checkpoint(full_checkpoint_path)
+            assign_state_dict(model, state_dict)
+            return model, metadata.get('best_decascore')
+
         model = cls(args=args, tasks=tasks, vocab_sets=vocab_sets, save_directory=save_directory, *model_args, **kwargs)
         save_dict = torch.load(full_checkpoint_path, map_location=device)
-        
+
+        # quantized checkpoints (see export.py) can only be loaded into a model with the same quantized modules
+        if save_dict.get('quantization') is not None:
+            if device is not None and torch.device(device).type != 'cpu':
+                raise ValueError(f'{full_checkpoint_path} is quantized and can only be loaded on CPU')
+            model.quantize(**save_dict['quantization'])
+
         # HACK
         # `transformers` version 4.1 changed the name of language modeling head of BartForConditionalGeneration
         # (and therefore its subclass MBartForConditionalGeneration) to lm_head to make it similar to other models
         # like T5. The following will make this change so that genienlp models trained with `transformers`==4.0 can be properly loaded
-        if 'model.lm_head.weight' not in save_dict['model_state_dict'] and 'model.model.shared.weight' in save_dict['model_state_dict']:
+        if 'model.lm_head.weight' not in save_dict['model_state_dict'] and 'model.model.shared.weight' in save_dict['model_state_dict'] \
+                and not (model.quantization and model.quantization['quantize_lm_head']):
             save_dict['model_state_dict']['model.lm_head.weight'] = save_dict['model_state_dict']['model.model.shared.weight']
         model.load_state_dict(save_dict['model_state_dict'], strict=True)
 
         return model, save_dict.get('best_decascore')
 
-    def add_new_vocab_from_data(self, tasks, resize_decoder=False):
+    def add_new_vocab_from_data(self, tasks, resize_decoder=False, reserve_capacity=False):
+        """
+        Adds the special tokens of `tasks` to the vocabulary.
+        Returns True if the vocabulary has grown. Subclasses should then resize any embeddings smaller than the vocabulary,
+        whether or not it has just grown, so that a resize that failed before is attempted again.
+        If `reserve_capacity` is True, embedding matrices that only map tokens to vectors (and never
+        the other way) can be grown beyond the vocabulary size, so that they are not copied every time a new task shows up.
+        Models that use `reserve_capacity` should not be saved afterwards.
+        """
         old_num_tokens = self.numericalizer.num_tokens
         self.numericalizer.grow_vocab(tasks)
         if self.numericalizer.num_tokens > old_num_tokens:
             logger.info(f'Vocabulary has expanded to {self.numericalizer.num_tokens} tokens')
+            return True
+        return False
+
+    def _input_embedding_capacity(self, current_size, reserve_capacity):
+        """
+        Returns the number of rows that an input embedding matrix, currently with `current_size` rows, should have
+        to fit all the tokens in the vocabulary.
+        With `reserve_capacity`, the space for tokens added on top of the pretrained vocabulary is doubled every time
+        it runs out, so the cost of growing the vocabulary one task at a time is amortized.
+        """
+        num_tokens = self.numericalizer.num_tokens
+        if not reserve_capacity or num_tokens <= current_size:
+            return num_tokens
+        pretrained_size = self.numericalizer.vocab.vocab_size
+        return max(num_tokens, pretrained_size + 2 * (current_size - pretrained_size))
+
+    def quantize(self, dtype='int8', quantize_lm_head=False):
+        """
+        Applies dynamic quantization to the Linear, LSTM and LSTMCell layers of the model, in place, for inference on CPU.
+        Weights are stored in `dtype` and activations are quantized on the fly. Embeddings are kept in full precision,
+        and so is the LM head (see `lm_head_name`), unless `quantize_lm_head` is True.
+        """
+        if self.quantization is not None:
+            if self.quantization != {'dtype': dtype, 'quantize_lm_head': quantize_lm_head}:
+                raise ValueError(f'Model was saved quantized with {format_quantization(self.quantization)}, '
+                                 f'and cannot be quantized again with '
+                                 f'{format_quantization({"dtype": dtype, "quantize_lm_head": quantize_lm_head})}')
+            return
+        if dtype != 'int8':
+            raise ValueError(f'Invalid quantization type {dtype}')
+        qconfig_spec = {layer: torch.quantization.default_dynamic_qconfig
+                        for layer in (torch.nn.Linear, torch.nn.LSTM, torch.nn.LSTMCell)}
+        if not quantize_lm_head and self.lm_head_name is not None:
+            # module names take precedence over module types
+            qconfig_spec[self.lm_head_name] = None
+        torch.quantization.quantize_dynamic(self, qconfig_spec, dtype=torch.qint8, inplace=True)
+        self.quantization = {'dtype': dtype, 'quantize_lm_head': quantize_lm_head}
+
+    def export_torchscript(self, save_directory):
+        """
+        Saves TorchScript graphs of the model to `save_directory`, to be loaded with `load_torchscript()`
+        """
+        raise ValueError(f'{type(self).__name__} models cannot be exported to TorchScript')
+
+    def load_torchscript(self, save_directory, device):
+        """
+        Replaces the model with the TorchScript graphs that `export_torchscript()` saved to `save_directory`.
+        Afterwards, the model can only be used for generation.
+        """
+        raise ValueError(f'{type(self).__name__} models cannot be exported to TorchScript')
+
+    def score(self, batch):
+        """
+        Computes the log-probability of the answers of `batch` given their inputs with a single teacher-forced pass through the model.
+        Rows of `batch` with the same input share a single run of the encoder.
+        Returns a tensor with the log-probability of each answer token (0 for padding), and the mask of the answer tokens
+        that were scored, both of shape (batch_size, number of scored answer tokens)
+        """
+        raise ValueError(f'{type(self).__name__} models cannot score answers')
+
+    @staticmethod
+    def _shared_encoder_inputs(batch):
+        """
+        Finds the rows of `batch` with the same input. Returns a batch with one row for each distinct input (only its
+        `context` field is selected), and a tensor with the index of the input of each row of `batch` in that batch
+        """
+        # input -> index in the new batch
+        inputs = dict()
+        first_rows = []
+        inverse = []
+        for row, input_ids in enumerate(batch.context.value.tolist()):
+            key = tuple(input_ids)
+            if key not in inputs:
+                inputs[key] = len(first_rows)
+                first_rows.append(row)
+            inverse.append(inputs[key])
+        device = batch.context.value.device
+        first_rows = torch.tensor(first_rows, dtype=torch.long, device=device)
+        context = SequentialField(*(t.index_select(0, first_rows) if t is not None else None for t in batch.context))
+        return batch._replace(context=context), torch.tensor(inverse, dtype=torch.long, device=device)
+
+    @staticmethod
+    def _streaming_hook(streamer, num_beams, map_ids=None):
+        """
+        Returns a `prefix_allowed_tokens_fn` for `generate()` that passes the tokens generated so far by each output
+        sequence to `streamer(row, token_ids)` at every decoding step, without constraining generation
+        (our version of `transformers` has no streaming API, and this is the only callback made at every step).
+        Beam search hypotheses are only final at the end, so nothing is streamed if `num_beams` > 1.
+        """
+        if streamer is None or num_beams > 1:
+            return None
+
+        def prefix_allowed_tokens_fn(row, token_ids):
+            if map_ids is not None:
+                token_ids = map_ids(token_ids)
+            streamer(row, token_ids)
+            # allow all tokens
+            return slice(None)
+
+        return prefix_allowed_tokens_fn
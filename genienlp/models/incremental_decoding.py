@@ -0,0 +1,214 @@
+#
+# Copyright (c) 2021, Salesforce, Inc.
+#                     The Board of Trustees of the Leland Stanford Junior University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from contextlib import contextmanager
+
+import torch
+from transformers.modeling_outputs import BaseModelOutput
+
+
+def _pad(tensor, dim, size, value=0, left=False):
+    """
+    Pads `tensor` with `value` along `dim` (at the end, or at the start if `left` is True) to `size` elements
+    """
+    missing = size - tensor.shape[dim]
+    if missing <= 0:
+        return tensor
+    shape = list(tensor.shape)
+    shape[dim] = missing
+    padding = tensor.new_full(shape, value)
+    return torch.cat([padding, tensor] if left else [tensor, padding], dim=dim)
+
+
+class _RowPositionalEmbedding(torch.nn.Module):
+    """
+    Stands in for the position embedding module of a `transformers` decoder for one decoding step, so that each
+    sequence gets the embedding of its own position instead of the position given by the length of the decoder cache
+    """
+
+    def __init__(self, embed_positions, positions):
+        super().__init__()
+        self.embed_positions = embed_positions
+        self.positions = positions
+
+    def forward(self, input_ids_shape, past_key_values_length=0):
+        embeddings = dict((position, self.embed_positions(torch.Size([1, 1]), position)) for position in set(self.positions))
+        return torch.stack([embeddings[position] for position in self.positions])
+
+
+class GreedyDecoding(object):
+    """
+    Greedy decoding of a batch of sequences with a `transformers` encoder-decoder model, one token at a time.
+    Generates the same outputs as `generate()`, but the caller decides when to run each step, can remove the sequences
+    that are complete from the batch (with `keep()`) so they do not use the model any longer, and can add the sequences
+    of another GreedyDecoding that started later (with `merge()`) so that all of them go through the decoder together.
+
+    Sequences of different lengths are padded on the left, and the padding is masked in the self-attention of the decoder.
+    `transformers` derives the position of the new tokens from the length of the decoder cache, which is the same for the
+    whole batch, so merging is only possible (`mergeable`) if the positions are relative, or if `decoder` has an `embed_positions`
+    module that can be replaced with the position of each sequence for a step.
+    """
+
+    def __init__(self, model, encoder_outputs, attention_mask, decoder_input_ids, logits_processor, max_length, eos_token_id,
+                 pad_token_id, mergeable=False, decoder=None):
+        self.model = model
+        self.encoder_outputs = encoder_outputs
+        self.attention_mask = attention_mask
+        self.sequences = decoder_input_ids
+        self.logits_processor = logits_processor
+        self.max_length = max_length
+        self.eos_token_id = eos_token_id
+        self.pad_token_id = pad_token_id
+        self.mergeable = mergeable
+        self.decoder = decoder
+        self.past = None
+        # number of tokens of each sequence, without the padding
+        self.lengths = [decoder_input_ids.shape[1]] * decoder_input_ids.shape[0]
+        # None as long as all sequences have the same length
+        self.decoder_attention_mask = None
+
+    def __len__(self):
+        return self.sequences.shape[0]
+
+    def step(self):
+        """
+        Generates the next token of every sequence.
+        Returns the indices of the sequences that are now complete, because they generated EOS or reached the maximum length
+        """
+        model_inputs = self.model.prepare_inputs_for_generation(self.sequences, past=self.past, attention_mask=self.attention_mask,
+                                                                use_cache=True, encoder_outputs=self.encoder_outputs)
+        if self.decoder_attention_mask is not None:
+            model_inputs['decoder_attention_mask'] = self.decoder_attention_mask
+        with self._row_positions():
+            outputs = self.model(**model_inputs, return_dict=True)
+        next_token_scores = self._process_logits(outputs.logits[:, -1, :])
+        next_tokens = torch.argmax(next_token_scores, dim=-1)
+        self.sequences = torch.cat([self.sequences, next_tokens[:, None]], dim=-1)
+        if self.decoder_attention_mask is not None:
+            self.decoder_attention_mask = _pad(self.decoder_attention_mask, 1, self.sequences.shape[1], value=1)
+        self.lengths = [length + 1 for length in self.lengths]
+        self.past = outputs.past_key_values
+
+        finished = set((next_tokens == self.eos_token_id).nonzero(as_tuple=False).view(-1).tolist())
+        return [row for row, length in enumerate(self.lengths) if row in finished or length >= self.max_length]
+
+    @contextmanager
+    def _row_positions(self):
+        if self.decoder_attention_mask is None or self.decoder is None:
+            yield
+            return
+        embed_positions = self.decoder.embed_positions
+        self.decoder.embed_positions = _RowPositionalEmbedding(embed_positions, [length - 1 for length in self.lengths])
+        try:
+            yield
+        finally:
+            self.decoder.embed_positions = embed_positions
+
+    def _process_logits(self, logits):
+        if self.decoder_attention_mask is None:
+            return self.logits_processor(self.sequences, logits)
+        # the logits processors look at the tokens generated so far, which must not include the padding
+        scores = torch.empty_like(logits)
+        for length in sorted(set(self.lengths)):
+            rows = torch.tensor([row for row, row_length in enumerate(self.lengths) if row_length == length],
+                                dtype=torch.long, device=logits.device)
+            scores[rows] = self.logits_processor(self.sequences[rows, -length:], logits[rows])
+        return scores
+
+    def keep(self, indices):
+        """
+        Removes all the sequences except those in `indices`, which will be renumbered 0, 1, ... in the same order
+        """
+        index = torch.tensor(indices, dtype=torch.long, device=self.sequences.device)
+        self.sequences = self.sequences.index_select(0, index)
+        self.attention_mask = self.attention_mask.index_select(0, index)
+        self.encoder_outputs = BaseModelOutput(last_hidden_state=self.encoder_outputs.last_hidden_state.index_select(0, index))
+        if self.past is not None:
+            # not _reorder_cache(), which leaves the cross-attention cache of BART models as it is, since beams share it
+            self.past = tuple(tuple(t.index_select(0, index) for t in layer_past) for layer_past in self.past)
+        self.lengths = [self.lengths[row] for row in indices]
+        if self.decoder_attention_mask is None:
+            return
+
+        self.decoder_attention_mask = self.decoder_attention_mask.index_select(0, index)
+        # remove the padding that no sequence needs any longer
+        padding = self.sequences.shape[1] - max(self.lengths)
+        if padding > 0:
+            self.sequences = self.sequences[:, padding:]
+            self.decoder_attention_mask = self.decoder_attention_mask[:, padding:]
+            # the self-attention cache comes first in the cache of each layer, followed by the cross-attention cache
+            self.past = tuple(tuple(t[:, :, padding:] for t in layer_past[:2]) + tuple(layer_past[2:]) for layer_past in self.past)
+        if min(self.lengths) == max(self.lengths):
+            self.decoder_attention_mask = None
+
+    def can_merge(self, other):
+        """
+        Whether the sequences of `other` can be added to this one with `merge()`
+        """
+        return (self.mergeable and other.mergeable and self.model is other.model and self.decoder is other.decoder
+                and self.past is not None and other.past is not None and self._settings() == other._settings())
+
+    def _settings(self):
+        # the logits processors only keep their parameters, so two lists with the same parameters process the logits the same way
+        processors = [(type(processor), vars(processor)) for processor in self.logits_processor]
+        return processors, self.max_length, self.eos_token_id, self.pad_token_id
+
+    def merge(self, other):
+        """
+        Adds the sequences of `other` after the sequences of this GreedyDecoding. Both must have run at least one step
+        """
+        length = max(self.sequences.shape[1], other.sequences.shape[1])
+        input_length = max(self.attention_mask.shape[1], other.attention_mask.shape[1])
+
+        def decoder_mask(decoding):
+            mask = decoding.decoder_attention_mask
+            if mask is None:
+                mask = decoding.attention_mask.new_ones(decoding.sequences.shape)
+            return _pad(mask, 1, length, left=True)
+
+        def merge_past(layer_past, other_layer_past):
+            # the self-attention cache has one entry for each token but the last one, the cross-attention cache one for each input token
+            return tuple(torch.cat([_pad(a, 2, length - 1, left=True), _pad(b, 2, length - 1, left=True)]) for a, b in
+                         zip(layer_past[:2], other_layer_past[:2])) + \
+                tuple(torch.cat([_pad(a, 2, input_length), _pad(b, 2, input_length)]) for a, b in zip(layer_past[2:], other_layer_past[2:]))
+
+        # nothing changes if anything fails
+        sequences = torch.cat([_pad(decoding.sequences, 1, length, self.pad_token_id, left=True) for decoding in (self, other)])
+        decoder_attention_mask = torch.cat([decoder_mask(self), decoder_mask(other)])
+        attention_mask = torch.cat([_pad(decoding.attention_mask, 1, input_length) for decoding in (self, other)])
+        encoder_hidden_states = torch.cat([_pad(decoding.encoder_outputs.last_hidden_state, 1, input_length) for decoding in (self, other)])
+        past = tuple(merge_past(layer_past, other_layer_past) for layer_past, other_layer_past in zip(self.past, other.past))
+
+        self.sequences = sequences
+        self.attention_mask = attention_mask
+        self.encoder_outputs = BaseModelOutput(last_hidden_state=encoder_hidden_states)
+        self.past = past
+        self.lengths = self.lengths + other.lengths
+        self.decoder_attention_mask = decoder_attention_mask if min(self.lengths) != max(self.lengths) else None
@@ -70,31 +70,12 @@ class MQANDecoder(nn.Module):
                 current_token_id=None, decoder_wrapper=None, expansion_factor=1, generation_dict=None):
 
         context, context_limited = batch.context.value, batch.context.limited
-        answer, answer_limited = batch.answer.value, batch.answer.limited
+        answer_limited = batch.answer.limited
         decoder_vocab = self.numericalizer.decoder_vocab
         self.map_to_full = decoder_vocab.decode
         context_padding = context.data == self.pad_idx
         if self.training:
-            if self.args.rnn_layers > 0:
-                self.rnn_decoder.applyMasks(context_padding)
-            else:
-                self.context_attn.applyMasks(context_padding)
-
-
-            answer_padding = (answer.data == self.pad_idx)[:, :-1]
-            answer_embedded = self.decoder_embeddings(answer[:, :-1], padding=answer_padding)
-
-            if self.args.rnn_layers > 0:
-                rnn_decoder_outputs = self.rnn_decoder(answer_embedded, final_context, hidden=context_rnn_state)
-                decoder_output, vocab_pointer_switch_input, context_attention, rnn_state = rnn_decoder_outputs
-            else:
-                context_decoder_output, context_attention = self.context_attn(answer_embedded, final_context)
-                vocab_pointer_switch_input = torch.cat((context_decoder_output, answer_embedded), dim=-1)
-                decoder_output = self.dropout(context_decoder_output)
-
-            vocab_pointer_switch = self.vocab_pointer_switch(vocab_pointer_switch_input)
-
-            probs = self.probs(decoder_output, vocab_pointer_switch, context_attention, context_limited, decoder_vocab)
+            probs = self.teacher_forced_probs(batch, final_context, context_rnn_state)
         
             probs, targets = mask(answer_limited[:, 1:].contiguous(), probs.contiguous(), pad_idx=decoder_vocab.pad_idx)
             loss = F.nll_loss(probs.log(), targets, ignore_index=decoder_vocab.pad_idx)
@@ -113,6 +94,35 @@ class MQANDecoder(nn.Module):
             logits = torch.log(decoder_wrapper.next_token_probs(current_token_id))
             return Seq2SeqLMOutput(logits=logits, past_key_values=decoder_wrapper)
 
+    def teacher_forced_probs(self, batch, final_context, context_rnn_state):
+        """
+        Runs the decoder on the answers of `batch`, and returns the probability of each next answer token in the decoder vocabulary,
+        with shape (batch_size, answer_length - 1, decoder_vocab_size)
+        """
+        context, context_limited = batch.context.value, batch.context.limited
+        answer = batch.answer.value
+        decoder_vocab = self.numericalizer.decoder_vocab
+        context_padding = context.data == self.pad_idx
+        if self.args.rnn_layers > 0:
+            self.rnn_decoder.applyMasks(context_padding)
+        else:
+            self.context_attn.applyMasks(context_padding)
+
+        answer_padding = (answer.data == self.pad_idx)[:, :-1]
+        answer_embedded = self.decoder_embeddings(answer[:, :-1], padding=answer_padding)
+
+        if self.args.rnn_layers > 0:
+            rnn_decoder_outputs = self.rnn_decoder(answer_embedded, final_context, hidden=context_rnn_state)
+            decoder_output, vocab_pointer_switch_input, context_attention, rnn_state = rnn_decoder_outputs
+        else:
+            context_decoder_output, context_attention = self.context_attn(answer_embedded, final_context)
+            vocab_pointer_switch_input = torch.cat((context_decoder_output, answer_embedded), dim=-1)
+            decoder_output = self.dropout(context_decoder_output)
+
+        vocab_pointer_switch = self.vocab_pointer_switch(vocab_pointer_switch_input)
+
+        return self.probs(decoder_output, vocab_pointer_switch, context_attention, context_limited, decoder_vocab)
+
     def probs(self, outputs, vocab_pointer_switches, context_attention, context_indices, decoder_vocab):
         size = list(outputs.size())
 
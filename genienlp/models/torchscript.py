@@ -0,0 +1,205 @@
+#
+# Copyright (c) 2021, Salesforce, Inc.
+#                     The Board of Trustees of the Leland Stanford Junior University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import inspect
+import json
+import logging
+import os
+import torch
+from transformers import PreTrainedModel
+from transformers.modeling_outputs import BaseModelOutput, Seq2SeqLMOutput
+
+logger = logging.getLogger(__name__)
+
+# the subdirectory of a model directory where the TorchScript graphs are saved
+TORCHSCRIPT_DIRECTORY = 'torchscript'
+
+
+class _Seq2SeqGraphs(torch.nn.Module):
+    """
+    The computations that `generate()` runs with a `transformers` encoder-decoder model, as functions of tensors that can be traced.
+    Decoding runs one token at a time, starting without a decoder cache (`start_decoding()`) and continuing with the cache of
+    the previous step (`decode_step()`); both return the logits, the new cache and the cross attentions of every layer.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def encode(self, input_ids, attention_mask):
+        return self.model.get_encoder()(input_ids=input_ids, attention_mask=attention_mask, return_dict=True).last_hidden_state
+
+    def start_decoding(self, decoder_input_ids, encoder_hidden_states, attention_mask):
+        return self.decode_step(decoder_input_ids, encoder_hidden_states, attention_mask, None)
+
+    def decode_step(self, decoder_input_ids, encoder_hidden_states, attention_mask, past_key_values):
+        outputs = self.model(encoder_outputs=(encoder_hidden_states,), attention_mask=attention_mask, decoder_input_ids=decoder_input_ids,
+                             past_key_values=past_key_values, use_cache=True, output_attentions=True, return_dict=True)
+        return outputs.logits, outputs.past_key_values, outputs.cross_attentions
+
+
+def _example_inputs(graphs, num_tokens, batch_size, input_length, decoder_start_token_id, pad_token_id, seed):
+    """
+    Returns random inputs for each method of `graphs`, with the outputs of the eager model for the inputs of the decoder cache.
+    Unless `batch_size` is 1, the last row of the inputs is padded.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    input_ids = torch.randint(num_tokens, (batch_size, input_length), generator=generator)
+    if batch_size > 1:
+        input_ids[-1, input_length // 2:] = pad_token_id
+    attention_mask = input_ids.ne(pad_token_id).long()
+    decoder_input_ids = torch.full((batch_size, 1), decoder_start_token_id, dtype=torch.long)
+
+    encoder_hidden_states = graphs.encode(input_ids, attention_mask)
+    logits, past_key_values, _ = graphs.start_decoding(decoder_input_ids, encoder_hidden_states, attention_mask)
+    next_token_ids = logits[:, -1, :].argmax(dim=-1, keepdim=True)
+    return {'encode': (input_ids, attention_mask),
+            'start_decoding': (decoder_input_ids, encoder_hidden_states, attention_mask),
+            'decode_step': (next_token_ids, encoder_hidden_states, attention_mask, past_key_values)}
+
+
+def _check_graphs(graphs, traced_graphs, example_inputs, num_steps, atol):
+    """
+    Runs the encoder and `num_steps` steps of greedy decoding with both `graphs` and `traced_graphs`, and raises ValueError
+    if their outputs differ by more than `atol`
+    """
+    def check(name, expected, actual):
+        difference = (expected - actual).abs().max().item()
+        if difference > atol:
+            raise ValueError(f'The TorchScript graph of {name} differs from the model by {difference}')
+
+    input_ids, attention_mask = example_inputs['encode']
+    encoder_hidden_states = graphs.encode(input_ids, attention_mask)
+    check('encode', encoder_hidden_states, traced_graphs.encode(input_ids, attention_mask))
+
+    decoder_input_ids = example_inputs['start_decoding'][0]
+    expected = graphs.start_decoding(decoder_input_ids, encoder_hidden_states, attention_mask)
+    actual = traced_graphs.start_decoding(decoder_input_ids, encoder_hidden_states, attention_mask)
+    check('start_decoding', expected[0], actual[0])
+    for _ in range(num_steps):
+        next_token_ids = expected[0][:, -1, :].argmax(dim=-1, keepdim=True)
+        expected = graphs.decode_step(next_token_ids, encoder_hidden_states, attention_mask, expected[1])
+        actual = traced_graphs.decode_step(next_token_ids, encoder_hidden_states, attention_mask, actual[1])
+        check('decode_step', expected[0], actual[0])
+
+
+def export_torchscript(model, num_tokens, save_directory, decoder_start_token_id, pad_token_id, num_check_steps=4, atol=1e-4):
+    """
+    Traces the encoder and the decoding steps of `model` (a `transformers` encoder-decoder model, on CPU), checks them against
+    the eager model on inputs of a different shape, and saves them to the TORCHSCRIPT_DIRECTORY of `save_directory`
+    """
+    model.eval()
+    graphs = _Seq2SeqGraphs(model)
+    with torch.no_grad():
+        example_inputs = _example_inputs(graphs, num_tokens, batch_size=2, input_length=8,
+                                         decoder_start_token_id=decoder_start_token_id, pad_token_id=pad_token_id, seed=0)
+        traced_graphs = torch.jit.trace_module(graphs, example_inputs)
+        check_inputs = _example_inputs(graphs, num_tokens, batch_size=3, input_length=13,
+                                       decoder_start_token_id=decoder_start_token_id, pad_token_id=pad_token_id, seed=1)
+        _check_graphs(graphs, traced_graphs, check_inputs, num_check_steps, atol)
+
+    directory = os.path.join(save_directory, TORCHSCRIPT_DIRECTORY)
+    os.makedirs(directory, exist_ok=True)
+    traced_graphs.save(os.path.join(directory, 'model.pt'))
+    with open(os.path.join(directory, 'config.json'), 'w') as config_file:
+        json.dump({'num_tokens': num_tokens}, config_file)
+    logger.info(f'Saved TorchScript graphs to {directory}')
+
+
+def load_torchscript(config, model_class, save_directory, device):
+    """
+    Loads the graphs saved by `export_torchscript()` from `save_directory`, for a model of class `model_class` with `config`.
+    Returns a ScriptedSeq2SeqLM, and the number of tokens of the vocabulary of the graphs
+    """
+    if torch.device(device).type != 'cpu':
+        raise ValueError('TorchScript models can only run on CPU')
+    directory = os.path.join(save_directory, TORCHSCRIPT_DIRECTORY)
+    if not os.path.exists(os.path.join(directory, 'model.pt')):
+        raise ValueError(f'{save_directory} has no TorchScript graphs, use `genienlp export --torchscript` to create them')
+    with open(os.path.join(directory, 'config.json')) as config_file:
+        num_tokens = json.load(config_file)['num_tokens']
+    graphs = torch.jit.load(os.path.join(directory, 'model.pt'), map_location=device)
+    return ScriptedSeq2SeqLM(config, model_class, graphs, device), num_tokens
+
+
+class ScriptedSeq2SeqLM(PreTrainedModel):
+    """
+    Stands in for a `transformers` encoder-decoder model of class `model_class` in `generate()` (greedy decoding, sampling and
+    beam search) and GreedyDecoding, running the TorchScript graphs of `export_torchscript()` instead of the eager model.
+    Nothing else is supported: the decoder only runs one token at a time, so there is no teacher forcing.
+    """
+
+    def __init__(self, config, model_class, graphs, device):
+        super().__init__(config)
+        self.graphs = graphs
+        self._model_class = model_class
+        self._device = torch.device(device)
+
+    @property
+    def device(self):
+        # the parameters of quantized graphs are packed, so they cannot tell the device
+        return self._device
+
+    def _model_method(self, name):
+        # `transformers` models implement some of these as static methods
+        return inspect.getattr_static(self._model_class, name).__get__(self, type(self))
+
+    def get_encoder(self):
+        return self._encode
+
+    def _encode(self, input_ids, attention_mask=None, return_dict=True, **kwargs):
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        return BaseModelOutput(last_hidden_state=self.graphs.encode(input_ids, attention_mask.long()))
+
+    def forward(self, input_ids=None, attention_mask=None, decoder_input_ids=None, encoder_outputs=None, past_key_values=None,
+                labels=None, **kwargs):
+        if encoder_outputs is None or labels is not None or (past_key_values is None and decoder_input_ids.shape[1] != 1):
+            raise ValueError('TorchScript models only support generation')
+        encoder_hidden_states = encoder_outputs[0]
+        attention_mask = attention_mask.long()
+        if past_key_values is None:
+            logits, past_key_values, cross_attentions = self.graphs.start_decoding(decoder_input_ids, encoder_hidden_states, attention_mask)
+        else:
+            logits, past_key_values, cross_attentions = self.graphs.decode_step(decoder_input_ids, encoder_hidden_states, attention_mask,
+                                                                                past_key_values)
+        return Seq2SeqLMOutput(logits=logits, past_key_values=past_key_values, cross_attentions=cross_attentions)
+
+    def prepare_inputs_for_generation(self, *args, **kwargs):
+        return self._model_method('prepare_inputs_for_generation')(*args, **kwargs)
+
+    def adjust_logits_during_generation(self, *args, **kwargs):
+        return self._model_method('adjust_logits_during_generation')(*args, **kwargs)
+
+    def _reorder_cache(self, past, beam_idx):
+        return self._model_method('_reorder_cache')(past, beam_idx)
+
+    def resize_token_embeddings(self, new_num_tokens=None):
+        raise ValueError('Cannot add new tokens to a TorchScript model')
@@ -44,6 +44,9 @@ logger = logging.getLogger(__name__)
 
 
 class TransformerLSTM(GenieModel):
+    supports_encoder_outputs = True
+    supports_scoring = True
+    lm_head_name = 'decoder.out'
 
     def __init__(self, config=None, *inputs, args, vocab_sets, tasks, save_directory=None, **kwargs):
         """
@@ -97,11 +100,15 @@ class TransformerLSTM(GenieModel):
         self.encoder = IdentityEncoder(self.numericalizer, args, config, self.encoder_embeddings)
         self.decoder = MQANDecoder(self.numericalizer, args)
 
-    def add_new_vocab_from_data(self, tasks, resize_decoder=False):
-        super().add_new_vocab_from_data(tasks, resize_decoder=resize_decoder)
-        self.encoder_embeddings.resize_token_embeddings(self.numericalizer.num_tokens)
+    def add_new_vocab_from_data(self, tasks, resize_decoder=False, reserve_capacity=False):
+        grown = super().add_new_vocab_from_data(tasks, resize_decoder=resize_decoder)
+        current_size = self.encoder_embeddings.get_input_embeddings().num_embeddings
+        new_size = self._input_embedding_capacity(current_size, reserve_capacity)
+        if new_size > current_size:
+            self.encoder_embeddings.resize_token_embeddings(new_size)
         if resize_decoder:
             self.decoder.decoder_embeddings.resize_embedding(self.numericalizer.num_tokens)
+        return grown
     
     def forward(self, batch, current_token_id=None, past_key_values=None,
                 expansion_factor=1, generation_dict=None, encoder_output=None, return_dict=False,
@@ -118,6 +125,20 @@ class TransformerLSTM(GenieModel):
                             encoder_loss, current_token_id, decoder_wrapper=past_key_values,
                             expansion_factor=expansion_factor, generation_dict=generation_dict)
 
+    def score(self, batch):
+        encoder_batch, inverse = self._shared_encoder_inputs(batch)
+        final_context, context_rnn_state = self.encoder(encoder_batch)
+        final_context = final_context.index_select(0, inverse)
+        if context_rnn_state is not None:
+            context_rnn_state = tuple(state.index_select(1, inverse) for state in context_rnn_state)
+
+        probs = self.decoder.teacher_forced_probs(batch, final_context, context_rnn_state)
+        # the first token of the answer is the start token, which is given rather than predicted
+        targets = batch.answer.limited[:, 1:]
+        answer_mask = targets != self.numericalizer.decoder_vocab.pad_idx
+        token_log_probs = probs.gather(dim=-1, index=targets.unsqueeze(-1)).squeeze(-1).log()
+        return token_log_probs.masked_fill(~answer_mask, 0), answer_mask
+
     def get_encoder_loss(self, context_rnn_state):
         
         # concat hidden and cell state
@@ -169,10 +190,17 @@ class TransformerLSTM(GenieModel):
                  num_beam_groups,
                  diversity_penalty,
                  no_repeat_ngram_size,
-                 do_sample
+                 do_sample,
+                 streamer=None,
+                 encoder_hidden_states=None
                  ):
-
-        encoder_output = self.encoder(batch)
+        """
+        If `encoder_hidden_states` is provided, it is the output of `encode(batch)` (possibly computed earlier), and the encoder does not run
+        """
+        if encoder_hidden_states is not None:
+            encoder_output = encoder_hidden_states
+        else:
+            encoder_output = self.encode(batch)
         self.config.vocab_size = len(self.numericalizer.decoder_vocab)
         self.config.is_encoder_decoder = False # in order to make it work with `transformers` generation code, we should treat this as a decoder-only model
         batch_size = len(batch.example_id)
@@ -198,6 +226,7 @@ class TransformerLSTM(GenieModel):
                                      do_sample=do_sample,
                                      generation_dict={'max_output_length': max_output_length},
                                      encoder_output=encoder_output,
+                                     prefix_allowed_tokens_fn=self._streaming_hook(streamer, num_beams, map_ids=self._map_partial_output_ids),
                                      output_scores=False,
                                      output_attentions=False,
                                      output_hidden_states=False,
@@ -206,5 +235,16 @@ class TransformerLSTM(GenieModel):
         output_ids = generated.sequences
         mapped_output_ids = torch.cat((output_ids[:, 0:1], output_ids[:, 1:].cpu().apply_(self.decoder.map_to_full).to(batch.context.value.device)), dim=1) # map everything to full vocabulary except BOS which already is in full vocabulary
         generated.sequences = mapped_output_ids
-        
+
         return generated
+
+    def encode(self, batch):
+        """
+        Runs the encoder (including the entity embeddings of NED) on the inputs of `batch`, and returns the final context
+        and the initial state of the decoder
+        """
+        return self.encoder(batch)
+
+    def _map_partial_output_ids(self, token_ids):
+        # same as above for a single output that is still being generated; `token_ids` is owned by `generate()` so we copy it first
+        return torch.cat((token_ids[0:1], token_ids[1:].clone().cpu().apply_(self.decoder.map_to_full).to(token_ids.device)))
@@ -33,9 +33,12 @@ import torch
 
 from torch.tensor import Tensor
 from transformers import AutoModelForSeq2SeqLM, AutoConfig, MBartTokenizer, MBartTokenizerFast
+from transformers.modeling_outputs import BaseModelOutput
 
 from ..data_utils.numericalizer import TransformerNumericalizer
 from .base import GenieModel
+from .incremental_decoding import GreedyDecoding
+from .torchscript import ScriptedSeq2SeqLM, export_torchscript, load_torchscript
 from ..util import ConfidenceFeatures, adjust_language_code
 from .common import LabelSmoothingCrossEntropy
 
@@ -43,6 +46,11 @@ logger = logging.getLogger(__name__)
 
 
 class TransformerSeq2Seq(GenieModel):
+    supports_incremental_decoding = True
+    supports_encoder_outputs = True
+    supports_scoring = True
+    token_encoder_outputs = True
+    lm_head_name = 'model.lm_head'
     
     def __init__(self, config=None, *inputs, args, tasks, vocab_sets, save_directory=None, **kwargs):
         """
@@ -59,15 +67,17 @@ class TransformerSeq2Seq(GenieModel):
         self.src_lang, self.tgt_lang = adjust_language_code(config, args.pretrained_model,
                                                             kwargs.get('src_lang', 'en'), kwargs.get('tgt_lang', 'en'))
         
+        self.numericalizer = TransformerNumericalizer(self.args.pretrained_model, args, max_generative_vocab=None,
+                                save_dir=save_directory, config=config, src_lang=self.src_lang, tgt_lang=self.tgt_lang, vocab_sets=vocab_sets, tasks=tasks)
+
         if save_directory is not None:
+            # the weights are loaded afterwards, so the embeddings are created with the size of the vocabulary
+            # rather than resized, which would allocate and initialize a new matrix and copy the old one into it
+            config.vocab_size = self.numericalizer.num_tokens
             self.model = AutoModelForSeq2SeqLM.from_config(config)
         else:
             self.model = AutoModelForSeq2SeqLM.from_pretrained(self.args.pretrained_model, cache_dir=self.args.embeddings)
-
-        self.numericalizer = TransformerNumericalizer(self.args.pretrained_model, args, max_generative_vocab=None,
-                                save_dir=save_directory, config=config, src_lang=self.src_lang, tgt_lang=self.tgt_lang, vocab_sets=vocab_sets, tasks=tasks)
-
-        self.model.resize_token_embeddings(self.numericalizer.num_tokens)
+            self.model.resize_token_embeddings(self.numericalizer.num_tokens)
 
         # set decoder_start_token_id
         # recommended by huggingface
@@ -91,9 +101,17 @@ class TransformerSeq2Seq(GenieModel):
         self.criterion = LabelSmoothingCrossEntropy(args.label_smoothing)
         
 
-    def add_new_vocab_from_data(self, tasks, resize_decoder=False):
-        super().add_new_vocab_from_data(tasks, resize_decoder)
+    def add_new_vocab_from_data(self, tasks, resize_decoder=False, reserve_capacity=False):
+        # `reserve_capacity` is ignored because the embedding matrix is shared with the LM head,
+        # which must have exactly one output for each token in the vocabulary
+        grown = super().add_new_vocab_from_data(tasks, resize_decoder)
+        # `resize_token_embeddings` keeps the vocabulary size of the config up to date (the TorchScript runtime shares it too)
+        if self.model.config.vocab_size >= self.numericalizer.num_tokens:
+            return grown
+        if self.quantization and self.quantization['quantize_lm_head']:
+            raise ValueError('Cannot add new tokens to a model with a quantized LM head')
         self.model.resize_token_embeddings(self.numericalizer.num_tokens)
+        return grown
     
     def forward(self, *input, **kwargs):
         if self.training:
@@ -145,16 +163,19 @@ class TransformerSeq2Seq(GenieModel):
                  num_beam_groups,
                  diversity_penalty,
                  no_repeat_ngram_size,
-                 do_sample
+                 do_sample,
+                 streamer=None,
+                 encoder_hidden_states=None
                  ):
-        
-        decoder_start_token_id, forced_bos_token_id = None, None
-        if self._is_mbart:
-            decoder_start_token_id = self.model.config.decoder_start_token_id
-        if self._is_mbart50:
-            forced_bos_token_id = self.numericalizer._tokenizer.lang_code_to_id[self.tgt_lang]
+        """
+        If `encoder_hidden_states` is provided, it is the output of `encode(batch)` (possibly computed earlier), and the encoder does not run
+        """
+        decoder_start_token_id, forced_bos_token_id = self._generation_start_token_ids()
 
         input_ids = batch.context.value
+        encoder_kwargs = {}
+        if encoder_hidden_states is not None:
+            encoder_kwargs['encoder_outputs'] = BaseModelOutput(last_hidden_state=encoder_hidden_states)
         # when attention_mask is not provided to generate(), it will default to masking pad tokens, which is the correct thing
         generated = self.model.generate(input_ids=input_ids,
                                         max_length=max_output_length,
@@ -175,14 +196,110 @@ class TransformerSeq2Seq(GenieModel):
                                         do_sample=do_sample,
                                         decoder_start_token_id=decoder_start_token_id,
                                         forced_bos_token_id=forced_bos_token_id,
+                                        prefix_allowed_tokens_fn=self._streaming_hook(streamer, num_beams),
                                         output_scores=False,
                                         output_attentions=True,
                                         output_hidden_states=False,
-                                        return_dict_in_generate=True
+                                        return_dict_in_generate=True,
+                                        **encoder_kwargs
                                         )
         
         return generated
 
+    def encode(self, batch):
+        """
+        Runs the encoder on the inputs of `batch`, and returns its last hidden state, of shape (batch_size, input_length, hidden_size).
+        Positions with padding have no meaningful state.
+        """
+        input_ids = batch.context.value
+        attention_mask = self.model._prepare_attention_mask_for_generation(input_ids, self.numericalizer.pad_id, self.numericalizer.eos_id)
+        return self.model.get_encoder()(input_ids, attention_mask=attention_mask, return_dict=True).last_hidden_state
+
+    def export_torchscript(self, save_directory):
+        decoder_start_token_id, _ = self._generation_start_token_ids()
+        if decoder_start_token_id is None:
+            decoder_start_token_id = self.model.config.decoder_start_token_id
+        export_torchscript(self.model, self.numericalizer.num_tokens, save_directory, decoder_start_token_id, self.numericalizer.pad_id)
+
+    def load_torchscript(self, save_directory, device):
+        scripted_model, num_tokens = load_torchscript(self.model.config, type(self.model), save_directory, device)
+        if num_tokens != self.numericalizer.num_tokens:
+            raise ValueError(f'The TorchScript graphs in {save_directory} have {num_tokens} tokens, but the vocabulary has '
+                             f'{self.numericalizer.num_tokens} tokens')
+        self.model = scripted_model
+        # the graphs only run the decoder one token at a time, so there is no teacher forcing
+        self.supports_scoring = False
+
+    def _generation_start_token_ids(self):
+        decoder_start_token_id, forced_bos_token_id = None, None
+        if self._is_mbart:
+            decoder_start_token_id = self.model.config.decoder_start_token_id
+        if self._is_mbart50:
+            forced_bos_token_id = self.numericalizer._tokenizer.lang_code_to_id[self.tgt_lang]
+        return decoder_start_token_id, forced_bos_token_id
+
+    def start_greedy_decoding(self, batch, max_output_length, repetition_penalty, no_repeat_ngram_size, encoder_hidden_states=None):
+        """
+        Runs the encoder on `batch` (unless `encoder_hidden_states` is provided, see `generate()`), and returns a GreedyDecoding
+        that generates the same outputs as `generate()` with greedy decoding and a single output, one step at a time
+        """
+        decoder_start_token_id, forced_bos_token_id = self._generation_start_token_ids()
+
+        input_ids = batch.context.value
+        attention_mask = self.model._prepare_attention_mask_for_generation(input_ids, self.numericalizer.pad_id, self.numericalizer.eos_id)
+        if encoder_hidden_states is None:
+            encoder_hidden_states = self.encode(batch)
+        encoder_outputs = BaseModelOutput(last_hidden_state=encoder_hidden_states)
+        decoder_input_ids = self.model._prepare_decoder_input_ids_for_generation(input_ids, decoder_start_token_id=decoder_start_token_id,
+                                                                                 bos_token_id=self.numericalizer.init_id)
+        logits_processor = self.model._get_logits_processor(repetition_penalty=repetition_penalty,
+                                                            no_repeat_ngram_size=no_repeat_ngram_size,
+                                                            # not supported, because it is tied to the rows of the initial batch
+                                                            # (none of our pretrained models enable it)
+                                                            encoder_no_repeat_ngram_size=0,
+                                                            encoder_input_ids=None,
+                                                            bad_words_ids=None,
+                                                            min_length=3, # same as generate()
+                                                            max_length=max_output_length,
+                                                            eos_token_id=self.numericalizer.eos_id,
+                                                            forced_bos_token_id=forced_bos_token_id,
+                                                            forced_eos_token_id=None,
+                                                            prefix_allowed_tokens_fn=None,
+                                                            num_beams=1,
+                                                            num_beam_groups=1,
+                                                            diversity_penalty=None,
+                                                            remove_invalid_values=None)
+
+        # the decoders of T5 models use relative positions, and the others have a module for absolute positions that we can
+        # replace when decodings are merged; the TorchScript graphs cannot take a decoder attention mask
+        decoder, mergeable = None, False
+        if isinstance(self.model, ScriptedSeq2SeqLM):
+            pass
+        elif self.model.config.model_type in ('t5', 'mt5'):
+            mergeable = True
+        elif hasattr(self.model.get_decoder(), 'embed_positions'):
+            decoder, mergeable = self.model.get_decoder(), True
+
+        return GreedyDecoding(self.model, encoder_outputs, attention_mask, decoder_input_ids, logits_processor,
+                              max_output_length, self.numericalizer.eos_id, self.numericalizer.pad_id, mergeable=mergeable,
+                              decoder=decoder)
+
+    def score(self, batch):
+        answer = batch.answer.value
+        if self._is_bart_large:
+            # score the same tokens that the model was trained to predict, see forward()
+            answer = answer[:, 1:].contiguous()
+
+        encoder_batch, inverse = self._shared_encoder_inputs(batch)
+        attention_mask = encoder_batch.context.value != self.numericalizer.pad_id
+        encoder_outputs = self.model.get_encoder()(encoder_batch.context.value, attention_mask=attention_mask, return_dict=True)
+        # the decoder inputs are the answer shifted to the right, as in training
+        outputs = self.model(encoder_outputs=(encoder_outputs.last_hidden_state.index_select(0, inverse),),
+                             attention_mask=attention_mask.index_select(0, inverse), labels=answer, return_dict=True, use_cache=False)
+
+        token_log_probs = torch.log_softmax(outputs.logits, dim=-1).gather(dim=-1, index=answer.unsqueeze(-1)).squeeze(-1)
+        answer_mask = answer != self.numericalizer.pad_id
+        return token_log_probs.masked_fill(~answer_mask, 0), answer_mask
 
     def confidence_features(self, batch, predictions, mc_dropout_num=0) -> List[ConfidenceFeatures]:
         """
@@ -35,6 +35,7 @@ from pprint import pformat
 from collections import defaultdict
 import copy
 import shutil
+import time
 
 # multiprocessing with CUDA
 from torch.multiprocessing import Process, set_start_method
@@ -52,7 +53,8 @@ import torch
 from . import models
 from .tasks.registry import get_tasks
 from .util import set_seed, load_config_json, make_data_loader, log_model_size, get_devices, \
-    combine_folders_on_disk, split_folder_on_disk, get_part_path
+    combine_folders_on_disk, split_folder_on_disk, get_part_path, add_quantization_arguments, format_quantization, quantize_model, \
+    add_runtime_arguments, check_runtime_args, load_runtime
 from .validate import generate_with_model, calculate_and_reduce_metrics
 from .calibrate import ConfidenceEstimator
 from .arguments import check_and_update_generation_args
@@ -178,6 +180,16 @@ def run(args, device):
     iters = prepare_data_iterators(args, val_sets, model.numericalizer, device)
 
     log_model_size(logger, model, args.model)
+
+    full_precision_model = None
+    if args.compare_quantized:
+        if model.quantization is not None:
+            raise ValueError(f'{args.checkpoint_name} was saved quantized with {format_quantization(model.quantization)}, '
+                             f'so there is no full precision model to compare to')
+        full_precision_model = copy.deepcopy(model)
+        full_precision_model.eval()
+    quantize_model(model, args, device)
+    load_runtime(model, args, device)
     model.to(device)
 
     decaScore = []
@@ -217,12 +229,14 @@ def run(args, device):
                     logger.info('Loading confidence estimator "%s" from %s', estimator.name, path)
             else:
                 confidence_estimators = None
+            generation_start = time.time()
             with torch.cuda.amp.autocast(enabled=args.mixed_precision):
                 generation_output = generate_with_model(model, it, model.numericalizer, task, args,
                                                      original_order=original_order,
                                                      output_confidence_features=args.save_confidence_features,
                                                      confidence_estimators=confidence_estimators,
                                                      disable_progbar=False)
+            generation_time = time.time() - generation_start
             
             if args.save_confidence_features:
                 torch.save(generation_output.confidence_features, args.confidence_feature_path)
@@ -258,6 +272,10 @@ def run(args, device):
                     logger.info(metrics)
                     
                 task_scores[task].append((len(generation_output.answers), metrics[task.metrics[0]]))
+
+            if full_precision_model is not None:
+                compare_to_full_precision(full_precision_model, it, original_order, task, args, language, eval_dir,
+                                          generation_output, generation_time)
     
     for task in task_scores.keys():
         decaScore.append(sum([length * score for length, score in task_scores[task]]) / sum([length for length, score in task_scores[task]]))
@@ -270,6 +288,40 @@ def run(args, device):
     logger.info(f'\nSummary: | {sum(decaScore)} | {" | ".join([str(x) for x in decaScore])} |\n')
 
 
+def compare_to_full_precision(full_precision_model, it, original_order, task, args, language, eval_dir,
+                              quantized_output, quantized_time):
+    """
+    Runs `full_precision_model` on the same data as the quantized model, and reports the difference in metrics
+    and the speedup of quantization in a .quantization.json file next to the results of the task
+    """
+    generation_start = time.time()
+    full_precision_output = generate_with_model(full_precision_model, it, full_precision_model.numericalizer, task, args,
+                                                original_order=original_order, disable_progbar=False)
+    full_precision_time = time.time() - generation_start
+
+    comparison = {'quantize': args.quantize, 'quantize_lm_head': args.quantize_lm_head,
+                  'time': quantized_time, 'full_precision_time': full_precision_time,
+                  'speedup': full_precision_time / quantized_time}
+    if len(quantized_output.answers) > 0:
+        metrics_to_compute = task.metrics
+        if args.main_metric_only:
+            metrics_to_compute = [metrics_to_compute[0]]
+        metrics = calculate_and_reduce_metrics(quantized_output.predictions, quantized_output.answers, metrics_to_compute, args)
+        full_precision_metrics = calculate_and_reduce_metrics(full_precision_output.predictions, full_precision_output.answers,
+                                                              metrics_to_compute, args)
+        comparison['metrics'] = metrics
+        comparison['full_precision_metrics'] = full_precision_metrics
+        comparison['metrics_delta'] = {k: metrics[k] - full_precision_metrics[k] for k in metrics}
+    logger.info(f'Quantization of {task.name}: {comparison}')
+
+    if language is None or 'multilingual' not in task.name:
+        comparison_file_name = os.path.join(eval_dir, task.name + '.quantization.json')
+    else:
+        comparison_file_name = os.path.join(eval_dir, task.name + '_{}.quantization.json'.format(language))
+    with open(comparison_file_name, 'w') as comparison_file:
+        comparison_file.write(json.dumps(comparison) + '\n')
+
+
 def parse_argv(parser):
     parser.add_argument('--path', type=str, required=True, help='Folder to load the model from')
     parser.add_argument('--evaluate', type=str, required=True, choices=['train', 'valid', 'test'],
@@ -340,6 +392,12 @@ def parse_argv(parser):
     parser.add_argument('--translate_no_answer', action='store_true', help='if true the provided dataset would not contain the answer (translated sentence)')
     parser.add_argument('--plot_heatmaps', action='store_true', help='whether to plot cross-attention heatmaps')
 
+    add_quantization_arguments(parser)
+    add_runtime_arguments(parser)
+    parser.add_argument('--compare_quantized', action='store_true',
+                        help='With --quantize, also run the full precision model, and report the difference in metrics and the speedup '
+                        'in a .quantization.json file for each task')
+
             
 def set_default_values(args):
     """
@@ -351,6 +409,10 @@ def set_default_values(args):
 
 def check_args(args):
     
+    if args.compare_quantized and args.quantize is None:
+        raise ValueError('--compare_quantized requires --quantize')
+    check_runtime_args(args)
+
     if len(args.task_names) != len(args.pred_src_languages):
         raise ValueError('You have to define prediction languages for each task'
                          'Use None for single language tasks. Also provide languages in the same order you provided the tasks.')
@@ -374,7 +436,11 @@ def main(args):
     logger.info(f'Arguments:\n{pformat(vars(args))}')
     logger.info(f'Loading from {args.best_checkpoint}')
 
-    devices = get_devices(args.devices)
+    if args.quantize is not None or args.runtime != 'eager':
+        # quantized and TorchScript models only run on CPU
+        devices = [torch.device('cpu')]
+    else:
+        devices = get_devices(args.devices)
 
     if len(devices) > 1:
         logger.info(f'Independent multi-GPU generation on following devices: {devices}')
@@ -30,26 +30,958 @@
 
 
 import asyncio
+import copy
+import functools
+import gc
+import hashlib
+import itertools
 import json
 import logging
+import math
+import signal
+import socket
 import sys
 import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pprint import pformat
 
 import torch
 
 from . import models
-from .data_utils.example import Example, NumericalizedExamples
-from .data_utils.bootleg import init_bootleg_annotator, extract_features_with_annotator
+from .data_utils.example import Example, NumericalizedExamples, SequentialField
+from .data_utils.bootleg import init_bootleg_annotator, extract_features_with_annotator, label_utterances
 from .tasks.registry import get_tasks
-from .util import set_seed, get_devices, load_config_json, log_model_size
-from .validate import generate_with_model
+from .tasks.generic_dataset import input_then_output_len, input_tokens_fn
+from .util import set_seed, get_devices, load_config_json, log_model_size, make_features_data_loader, \
+    add_quantization_arguments, quantize_model, add_runtime_arguments, check_runtime_args, load_runtime, StageTimer
+from .validate import generate_with_model, score_with_model
 from .calibrate import ConfidenceEstimator
+from .server_metrics import ServerMetrics, start_metrics_server
+from .server_protocol import JsonLinesProtocol, PROTOCOLS
+from .server_queue import FairQueue
 
 
 logger = logging.getLogger(__name__)
 
 
+# inputs used to warm up the model
+WARMUP_WORDS = ['show', 'me', 'the', 'weather', 'in', 'new', 'york', 'tomorrow', 'and', 'play', 'some', 'music', '.']
+
+# the first class is the default
+DEFAULT_PRIORITY_CLASSES = ['interactive=10', 'bulk=1']
+
+GENERATION_HYPERPARAMETERS = ['num_outputs', 'temperature', 'top_k', 'top_p', 'repetition_penalty', 'num_beams',
+                              'num_beam_groups', 'diversity_penalty', 'no_repeat_ngram_size']
+
+
+def checkpoint_hash(paths):
+    """
+    A cheap fingerprint of the model files, used to make sure cached responses come from the current model
+    """
+    h = hashlib.sha1()
+    for path in paths:
+        stat = os.stat(path)
+        h.update(f'{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}'.encode('utf-8'))
+    return h.hexdigest()
+
+
+class ResponseCache(object):
+    """
+    LRU cache of the responses of the model, keyed by task, input and model configuration.
+    Entries are evicted when the cache holds more than `max_size` entries, or when they are older than `ttl` seconds
+    (0 means that entries never expire).
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._store = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._store)
+
+    def get(self, key):
+        entry = self._store.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        value, expiry = entry
+        if self.ttl > 0 and expiry < time.monotonic():
+            del self._store[key]
+            self.evictions += 1
+            self.misses += 1
+            return None
+        self._store.move_to_end(key)
+        self.hits += 1
+        # responses are modified before being sent to the client, so we never hand out the cached object itself
+        return copy.deepcopy(value)
+
+    def put(self, key, value):
+        self._store[key] = (copy.deepcopy(value), time.monotonic() + self.ttl)
+        self._store.move_to_end(key)
+        while len(self._store) > self.max_size:
+            self._store.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self._store.clear()
+
+    def stats(self):
+        return {'size': len(self._store), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+class BootlegAnnotations(object):
+    """
+    Runs the Bootleg annotator of the server, and keeps the label of each sentence in a ResponseCache of `cache_size` entries
+    (0 disables the cache), keyed by the sentence with normalized whitespace, so every sentence is only annotated once.
+    All the sentences that are not in the cache go through the annotator in a single batch.
+    It is shared by the inference thread and the annotation thread of the RequestBatcher, and by all the models of the server.
+    """
+
+    def __init__(self, annotator, cache_size, cache_ttl):
+        self.annotator = annotator
+        self.cache = ResponseCache(cache_size, cache_ttl) if cache_size > 0 else None
+        # protects the cache
+        self._lock = threading.Lock()
+        # the annotator is not safe to use concurrently
+        self._annotator_lock = threading.Lock()
+
+    @staticmethod
+    def normalize(utterance):
+        return ' '.join(utterance.split())
+
+    def label(self, utterances):
+        """
+        Returns the label of each sentence in `utterances`
+        """
+        keys = [self.normalize(utterance) for utterance in utterances]
+        labels = dict()
+        if self.cache is not None:
+            with self._lock:
+                for key in OrderedDict.fromkeys(keys):
+                    cached = self.cache.get(key)
+                    if cached is not None:
+                        labels[key] = cached
+
+        missing = [key for key in OrderedDict.fromkeys(keys) if key not in labels]
+        if missing:
+            with self._annotator_lock:
+                new_labels = label_utterances(self.annotator, missing)
+            labels.update(zip(missing, new_labels))
+            if self.cache is not None:
+                with self._lock:
+                    for key, label in zip(missing, new_labels):
+                        self.cache.put(key, label)
+
+        return [labels[key] for key in keys]
+
+    def annotate(self, groups, args):
+        """
+        Adds the entity features of the examples in `groups`, a list of (task, list of examples)
+        """
+        labels = iter(self.label([getattr(ex, task.utterance_field()) for task, examples in groups for ex in examples]))
+        for task, examples in groups:
+            extract_features_with_annotator(examples, self.annotator, args, task, [next(labels) for _ in examples])
+
+
+class EncoderCache(object):
+    """
+    Encoder hidden states of the recent inputs of each session, for requests that carry a `session` field (e.g. the turns
+    of a dialogue, which resend the same context). Entries are keyed by session and by a hash of the task and the input tokens.
+    The least recently used entries are evicted when a session has more than `max_session_entries` entries, or when
+    all states take more than `max_bytes` bytes.
+    Our encoders are bidirectional, so the state of an input cannot be extended when a turn is appended to it:
+    only inputs that exactly match a cached entry skip the encoder.
+    It is only used from the inference thread.
+    """
+
+    def __init__(self, max_bytes, max_session_entries):
+        self.max_bytes = max_bytes
+        self.max_session_entries = max_session_entries
+        # (session, input hash) -> tensor of shape (input_length, hidden_size)
+        self._store = OrderedDict()
+        # session -> number of entries
+        self._session_entries = dict()
+        self.num_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._store)
+
+    @staticmethod
+    def input_hash(task_name, input_ids):
+        return hashlib.sha1((task_name + ' ' + ' '.join(map(str, input_ids))).encode('utf-8')).hexdigest()
+
+    def get(self, session, input_hash):
+        states = self._store.get((session, input_hash))
+        if states is None:
+            self.misses += 1
+            return None
+        self._store.move_to_end((session, input_hash))
+        self.hits += 1
+        return states
+
+    def put(self, session, input_hash, states):
+        key = (session, input_hash)
+        if key in self._store:
+            self._remove(key)
+        self._store[key] = states
+        self._session_entries[session] = self._session_entries.get(session, 0) + 1
+        self.num_bytes += states.numel() * states.element_size()
+        if self._session_entries[session] > self.max_session_entries:
+            # the oldest entry of this session
+            self._remove(next(other for other in self._store if other[0] == session))
+            self.evictions += 1
+        while self.num_bytes > self.max_bytes and self._store:
+            self._remove(next(iter(self._store)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        states = self._store.pop(key)
+        self.num_bytes -= states.numel() * states.element_size()
+        session = key[0]
+        self._session_entries[session] -= 1
+        if self._session_entries[session] == 0:
+            del self._session_entries[session]
+
+    def clear(self):
+        self._store.clear()
+        self._session_entries.clear()
+        self.num_bytes = 0
+
+    def encode(self, model, batch, task_name, sessions, pad_id):
+        """
+        Returns the encoder hidden states of `batch` (whose examples belong to the task `task_name`) for `model`, where
+        `sessions` has the session of each row of `batch` (or None). The encoder only runs on the rows that are not in the cache.
+        """
+        input_ids = batch.context.value
+        # padding is not part of the input, and its states are not used
+        input_mask = input_ids != pad_id
+        states = [None] * len(sessions)
+        hashes = [None] * len(sessions)
+        for row, (session, row_ids, row_mask) in enumerate(zip(sessions, input_ids.tolist(), input_mask.tolist())):
+            if session is None:
+                continue
+            hashes[row] = self.input_hash(task_name, [token for token, is_input in zip(row_ids, row_mask) if is_input])
+            states[row] = self.get(session, hashes[row])
+
+        missing = [row for row, row_states in enumerate(states) if row_states is None]
+        if len(missing) == len(states):
+            hidden_states = model.encode(batch)
+        else:
+            hidden_states = None
+            if missing:
+                index = torch.tensor(missing, dtype=torch.long, device=input_ids.device)
+                context = SequentialField(*(t.index_select(0, index) if t is not None else None for t in batch.context))
+                missing_states = model.encode(batch._replace(context=context))
+            for row, row_states in enumerate(states):
+                if row_states is not None:
+                    if hidden_states is None:
+                        hidden_states = row_states.new_zeros((len(states), input_ids.size(1), row_states.size(-1)))
+                    hidden_states[row, input_mask[row]] = row_states
+            for i, row in enumerate(missing):
+                hidden_states[row] = missing_states[i]
+
+        for row in missing:
+            if sessions[row] is not None:
+                self.put(sessions[row], hashes[row], hidden_states[row, input_mask[row]].clone())
+        return hidden_states
+
+    def stats(self):
+        return {'size': len(self._store), 'bytes': self.num_bytes, 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+def worker_num_threads(args):
+    """
+    Number of torch threads of each worker process when serving with `--workers`
+    """
+    if args.threads_per_worker is not None:
+        return args.threads_per_worker
+    return max(1, os.cpu_count() // args.workers)
+
+
+def reap_children():
+    """
+    Yields a (pid, status) tuple for each child process that has exited, without blocking
+    """
+    while True:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            return
+        if pid == 0:
+            return
+        yield pid, status
+
+
+def request_num_tokens(request):
+    """
+    A cheap estimate of the number of input tokens in `request`, used to limit the size of batches
+    """
+    if 'instances' in request:
+        instances = request['instances']
+    else:
+        instances = [request]
+    return sum(len(instance.get('context', '').split()) + len(instance.get('question', '').split()) for instance in instances)
+
+
+class ServerError(Exception):
+    """
+    An error that is reported to the client as a structured response, with a machine-readable `code`
+    """
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+class QueuedRequest(object):
+    def __init__(self, request, future, num_tokens, deadline, stream=None):
+        self.request = request
+        self.future = future
+        self.num_tokens = num_tokens
+        # in the event loop's clock, or None if the request has no deadline
+        self.deadline = deadline
+        # called from the inference thread with partial outputs, see Server.handle_requests
+        self.stream = stream
+        # in the event loop's clock, when a ContinuousBatcher started running the request
+        self.started = None
+        # whether the request went through Bootleg ahead of the model, see RequestBatcher._run_inference
+        self.annotated = False
+
+
+class RequestBatcher(object):
+    """
+    Collects the requests coming from all clients, and runs them through the model in batches.
+    A batch is closed when `max_wait` seconds have passed since its first request arrived,
+    or when adding more requests would exceed `max_tokens` input tokens.
+    Batches run on a dedicated inference thread, so the event loop keeps accepting connections,
+    reading requests and writing responses while the model is busy.
+
+    Each request belongs to a priority class, given by its `priority` field or by the class of its task in `task_priorities`
+    (a list of TASK=CLASS), and defaulting to the first class in `priority_classes` (a list of NAME=WEIGHT).
+    Waiting requests are kept in one queue per priority class and task, and batches are filled from these queues
+    in weighted-fair order (see FairQueue), so a class gets a share of the model proportional to its weight when
+    all classes have work, and the leftover capacity otherwise. Requests with more than `max_tokens` tokens are split
+    into several parts, so that batches of other requests can run between their parts.
+
+    At most `max_queue_size` requests can wait for the model (0 means no limit); further requests are rejected
+    as overloaded. Requests can carry a `deadline_ms`; those that would not complete in time are rejected
+    as soon as possible instead of occupying the model.
+
+    With Bootleg, the requests that arrive while the model is busy are annotated on a second thread in the meantime,
+    all together, so that entity annotation overlaps with the model instead of adding to the time of each batch.
+    """
+
+    def __init__(self, server, max_wait, max_tokens, max_queue_size=0, priority_classes=DEFAULT_PRIORITY_CLASSES, task_priorities=None):
+        self.server = server
+        self.max_wait = max_wait
+        self.max_tokens = max_tokens
+        self.max_queue_size = max_queue_size
+        self.queue = FairQueue()
+        # a single thread, because the model is not safe to use concurrently
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='inference')
+        self.annotation_executor = None
+        if server.annotations is not None:
+            self.annotation_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='annotation')
+        self._arrived = asyncio.Event()
+        # the round of annotation that is running on the annotation thread, if any
+        self._prefetch = None
+
+        # priority class -> weight
+        self.priority_classes = OrderedDict()
+        for spec in priority_classes:
+            name, sep, weight = spec.partition('=')
+            try:
+                weight = float(weight)
+            except ValueError:
+                weight = 0
+            if not sep or not name or weight <= 0:
+                raise ValueError(f'Invalid priority class {spec}, expected NAME=WEIGHT with a positive weight')
+            self.priority_classes[name] = weight
+        self.default_priority = next(iter(self.priority_classes))
+        # task name -> priority class
+        self.task_priorities = dict()
+        for spec in task_priorities or []:
+            task, sep, priority = spec.partition('=')
+            if not sep or priority not in self.priority_classes:
+                raise ValueError(f'Invalid task priority {spec}, expected TASK=CLASS with one of the classes in {list(self.priority_classes)}')
+            self.task_priorities[task] = priority
+
+        # used to estimate how long a new request will wait
+        self._running = False
+        self._batch_seconds = None
+
+    def priority_class(self, request):
+        priority = request.get('priority')
+        if priority is None:
+            priority = self.task_priorities.get(request.get('task', 'generic'), self.default_priority)
+        if priority not in self.priority_classes:
+            raise ServerError('invalid_priority', f'Unknown priority class {priority}')
+        return priority
+
+    def queue_sizes(self):
+        """
+        Number of requests waiting for the model, by priority class
+        """
+        sizes = OrderedDict((priority, 0) for priority in self.priority_classes)
+        for (priority, _task), size in self.queue.qsizes().items():
+            sizes[priority] += size
+        return sizes
+
+    def estimated_latency(self, num_tokens, key, weight):
+        """
+        Estimates how long a request with `num_tokens` input tokens would take to complete if submitted now
+        to the queue `key` with `weight`, in seconds
+        """
+        if self._batch_seconds is None:
+            # no batch has completed yet, so we have no idea
+            return 0.0
+        num_batches = math.ceil(self.queue.tokens_ahead(key, weight, num_tokens) / self.max_tokens)
+        if self._running:
+            num_batches += 1
+        return num_batches * self._batch_seconds
+
+    def _split(self, request, num_tokens):
+        """
+        Splits a request with several instances and more than `max_tokens` input tokens into parts of at most `max_tokens`
+        tokens (or a single instance)
+        """
+        instances = request.get('instances')
+        if instances is None or len(instances) < 2 or num_tokens <= self.max_tokens:
+            return [request]
+        parts = [[]]
+        part_tokens = 0
+        for instance in instances:
+            instance_tokens = request_num_tokens(instance)
+            if parts[-1] and part_tokens + instance_tokens > self.max_tokens:
+                parts.append([])
+                part_tokens = 0
+            parts[-1].append(instance)
+            part_tokens += instance_tokens
+        return [dict(request, instances=part) for part in parts]
+
+    async def submit(self, request, stream=None):
+        """
+        Queues `request` and returns its response once it has run.
+        If `stream` is provided, it is called in the event loop as `stream(instance_index, partial_answer)` while
+        the answers of the request are being generated
+        """
+        loop = asyncio.get_event_loop()
+        num_tokens = request_num_tokens(request)
+        priority = self.priority_class(request)
+        key = (priority, request.get('task', 'generic'))
+        weight = self.priority_classes[priority]
+        deadline = None
+        deadline_ms = request.get('deadline_ms')
+        if deadline_ms is not None:
+            # bool is a subclass of int, and NaN is not >= 0
+            if isinstance(deadline_ms, bool) or not isinstance(deadline_ms, (int, float)) or not deadline_ms >= 0:
+                raise ServerError('invalid_request', f'Invalid deadline_ms {deadline_ms!r}, expected a non-negative number of milliseconds')
+            deadline = loop.time() + deadline_ms / 1000
+            if loop.time() + self.estimated_latency(num_tokens, key, weight) > deadline:
+                raise ServerError('overloaded', 'The server cannot complete this request before its deadline')
+        if self.max_queue_size > 0 and self.queue.qsize() >= self.max_queue_size:
+            raise ServerError('overloaded', 'Too many requests are waiting to be processed')
+
+        futures = []
+        first_instance = 0
+        for part in self._split(request, num_tokens):
+            part_stream = None
+            if stream is not None:
+                part_stream = self._threadsafe_stream(loop, stream, first_instance)
+            future = loop.create_future()
+            self.queue.put_nowait(QueuedRequest(part, future, request_num_tokens(part), deadline, part_stream), key, weight)
+            futures.append(future)
+            first_instance += len(part.get('instances', [None]))
+        self._arrived.set()
+        if len(futures) == 1:
+            return await futures[0]
+
+        responses = await asyncio.gather(*futures, return_exceptions=True)
+        for response in responses:
+            if isinstance(response, Exception):
+                raise response
+        return [instance for response in responses for instance in response]
+
+    @staticmethod
+    def _threadsafe_stream(loop, callback, first_instance):
+        def stream(instance_index, partial_answer):
+            loop.call_soon_threadsafe(callback, first_instance + instance_index, partial_answer)
+        return stream
+
+    def _dequeued(self, item):
+        if item.deadline is not None and asyncio.get_event_loop().time() > item.deadline:
+            if not item.future.done():
+                item.future.set_exception(ServerError('deadline_exceeded', 'The request expired before it could be processed'))
+            return False
+        return True
+
+    async def _next_batch(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            first = await self.queue.get()
+            if self._dequeued(first):
+                break
+
+        # measured when the batch starts, i.e. how much work was waiting for the model
+        self.server.metrics.queue_depth.observe(self.queue.qsize() + 1)
+        batch = [first]
+        num_tokens = first.num_tokens
+        deadline = loop.time() + self.max_wait
+        while True:
+            timeout = deadline - loop.time()
+            if timeout > 0:
+                try:
+                    await asyncio.wait_for(self.queue.wait(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            # once the time is up, we still take whatever is already waiting in the queue
+            item = self.queue.peek_nowait()
+            if item is None:
+                break
+            if num_tokens + item.num_tokens > self.max_tokens:
+                # it stays in the queue for the next batch
+                break
+            self.queue.get_nowait()
+            if not self._dequeued(item):
+                continue
+            batch.append(item)
+            num_tokens += item.num_tokens
+
+        await self._finish_prefetch()
+        return batch
+
+    async def _finish_prefetch(self):
+        """
+        Waits for the round of annotation that is still running, if any, so that the next batch finds its labels
+        in the cache and Bootleg never runs on both threads at once
+        """
+        if self._prefetch is not None:
+            await self._prefetch
+            self._prefetch = None
+
+    async def _run_inference(self, fn, *args):
+        """
+        Runs `fn(*args)` on the inference thread and returns its result. With Bootleg, the requests waiting in the queue
+        are annotated on the annotation thread in the meantime, in one batch per round, and requests that arrive
+        during a round are annotated in the next one. The result is returned as soon as inference is done, without
+        waiting for the current round, which is left for the next batch (see _finish_prefetch)
+        """
+        loop = asyncio.get_event_loop()
+        inference = loop.run_in_executor(self.executor, fn, *args)
+        if self.annotation_executor is None:
+            return await inference
+
+        while not inference.done():
+            if self._prefetch is not None:
+                if not self._prefetch.done():
+                    await asyncio.wait([inference, self._prefetch], return_when=asyncio.FIRST_COMPLETED)
+                    continue
+                self._prefetch = None
+            self._arrived.clear()
+            items = [item for item in self.queue if not item.annotated]
+            if not items:
+                arrived = asyncio.ensure_future(self._arrived.wait())
+                await asyncio.wait([inference, arrived], return_when=asyncio.FIRST_COMPLETED)
+                arrived.cancel()
+                continue
+            for item in items:
+                item.annotated = True
+            self._prefetch = loop.run_in_executor(self.annotation_executor, self.server.prefetch_annotations,
+                                                  [item.request for item in items])
+        return await inference
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = await self._next_batch()
+            requests = [item.request for item in batch]
+            streams = [item.stream for item in batch]
+            logger.debug('Running a batch of %d requests', len(requests))
+            self.server.metrics.batch_requests.observe(len(requests))
+            start = loop.time()
+            self._running = True
+            try:
+                responses = await self._run_inference(self.server.handle_requests, requests, streams)
+            except Exception as e:
+                for item in batch:
+                    if not item.future.done():
+                        item.future.set_exception(e)
+                continue
+            finally:
+                self._running = False
+                elapsed = loop.time() - start
+                # exponential moving average of the time it takes to run one batch
+                self._batch_seconds = elapsed if self._batch_seconds is None else 0.8 * self._batch_seconds + 0.2 * elapsed
+            for item, response in zip(batch, responses):
+                if item.future.done():
+                    # the client went away while we were running the model
+                    continue
+                if isinstance(response, Exception):
+                    item.future.set_exception(response)
+                else:
+                    item.future.set_result(response)
+
+
+class RunningRequest(object):
+    """
+    A request whose instances are being decoded by a ContinuousBatcher
+    """
+
+    def __init__(self, item, responses):
+        self.item = item
+        # one element for each instance, None until the instance is complete
+        self.responses = responses
+        self.remaining = sum(response is None for response in responses)
+
+
+class DecodingCohort(object):
+    """
+    Instances that go through the decoder together in a ContinuousBatcher: those that started decoding at the same step,
+    and those of the cohorts merged into it (see GreedyDecoding.merge).
+    Each member is a (RunningRequest, instance index, example ID, cache key, number of input tokens) tuple, and corresponds
+    to the sequence in the same position of `decoding`.
+    The cohort keeps the task, numericalizer and cache of the model it started with, so it can finish after a reload.
+    """
+
+    def __init__(self, server, task, decoding, members):
+        self.numericalizer = server.numericalizer
+        self.cache = server.cache
+        self.task = task
+        self.decoding = decoding
+        self.members = members
+
+    @property
+    def num_tokens(self):
+        return sum(member[4] for member in self.members)
+
+    def requests(self):
+        return list(OrderedDict.fromkeys(member[0] for member in self.members))
+
+    def can_merge(self, other):
+        return (self.task is other.task and self.numericalizer is other.numericalizer and self.cache is other.cache
+                and self.decoding.can_merge(other.decoding))
+
+    def merge(self, other):
+        """
+        Adds the instances of `other` to this cohort, so they go through the decoder together from now on
+        """
+        self.decoding.merge(other.decoding)
+        self.members = self.members + other.members
+
+    def step(self, timer):
+        """
+        Generates the next token of each instance, and removes the instances that are complete.
+        `timer` is the StageTimer of the current step of the ContinuousBatcher.
+        Returns the requests that are now complete
+        """
+        with torch.no_grad(), timer.time('generate'):
+            finished = self.decoding.step()
+
+        finished_set = set(finished)
+        streaming = [row for row, member in enumerate(self.members) if member[0].item.stream is not None and row not in finished_set]
+        if streaming:
+            with timer.time('reverse'):
+                partial_answers = self.numericalizer.reverse(self.decoding.sequences[streaming], 'answer')
+            for row, partial_answer in zip(streaming, partial_answers):
+                running, instance_idx, _, _, _ = self.members[row]
+                running.item.stream(instance_idx, partial_answer)
+        if not finished:
+            return []
+
+        with timer.time('reverse'):
+            answers = self.numericalizer.reverse(self.decoding.sequences[finished], 'answer')
+        completed = []
+        with timer.time('postprocess'):
+            for row, answer in zip(finished, answers):
+                running, instance_idx, example_id, key, _ = self.members[row]
+                response = {'answer': self.task.postprocess_prediction(example_id, answer)}
+                running.responses[instance_idx] = response
+                if key is not None:
+                    self.cache.put(key, response)
+                running.remaining -= 1
+                if running.remaining == 0:
+                    completed.append(running)
+
+        keep = [row for row in range(len(self.members)) if row not in finished_set]
+        if keep:
+            self.decoding.keep(keep)
+        self.members = [self.members[row] for row in keep]
+        return completed
+
+
+class ContinuousBatcher(RequestBatcher):
+    """
+    A RequestBatcher that schedules the model one decoding step at a time instead of one batch at a time (continuous batching).
+    The model keeps running the instances of all the requests that have started. At every step, it generates the next
+    token of each of them, instances that are complete are removed, and the requests that arrived in the meantime
+    are run through the encoder and join at the next step. This way, short outputs do not wait for the longest output
+    of their batch, and new requests do not wait for the running ones to finish.
+
+    Only greedy decoding is supported (see Server.supports_continuous_batching); other requests run to completion as in
+    a RequestBatcher. Instances that start at the same step form a DecodingCohort, which is merged into the running cohort
+    of the same model and task after its first step, so every step runs the decoder once for all of them. Cohorts that cannot
+    be merged (e.g. with the TorchScript runtime, or other generation hyperparameters) run the decoder once each.
+    The stages of a step are observed once for all cohorts. `max_tokens` limits the number of input tokens of the running instances.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cohorts = []
+
+    def _running_tokens(self):
+        return sum(cohort.num_tokens for cohort in self.cohorts)
+
+    def _waiting_requests(self):
+        """
+        Takes the requests that are already waiting, as long as they fit next to the running instances
+        """
+        batch = []
+        num_tokens = self._running_tokens()
+        while True:
+            item = self.queue.peek_nowait()
+            if item is None or num_tokens + item.num_tokens > self.max_tokens:
+                break
+            self.queue.get_nowait()
+            if not self._dequeued(item):
+                continue
+            batch.append(item)
+            num_tokens += item.num_tokens
+        if batch:
+            self.server.metrics.queue_depth.observe(self.queue.qsize() + len(batch))
+        return batch
+
+    def _step(self):
+        """
+        Runs one decoding step of all cohorts, on the inference thread.
+        Returns a list of (request, response) for the requests that are complete, where the response is an exception
+        if the model failed
+        """
+        self._merge_cohorts()
+        completed = []
+        # each stage is observed once per step, for all the cohorts
+        timer = StageTimer(self.server.metrics)
+        for cohort in self.cohorts:
+            try:
+                completed += [(running.item, running.responses) for running in cohort.step(timer)]
+            except Exception as e:
+                logger.exception('Failed to run a decoding step')
+                completed += [(running.item, e) for running in cohort.requests()]
+                cohort.members = []
+        timer.observe()
+        self.cohorts = [cohort for cohort in self.cohorts if cohort.members]
+        return completed
+
+    def _merge_cohorts(self):
+        """
+        Merges each cohort into the first one before it that can take its instances
+        """
+        cohorts = []
+        for cohort in self.cohorts:
+            target = next((c for c in cohorts if c.can_merge(cohort)), None)
+            if target is None:
+                cohorts.append(cohort)
+                continue
+            try:
+                with torch.no_grad():
+                    target.merge(cohort)
+            except Exception:
+                # the cohorts are left as they were, and run separately
+                logger.exception('Failed to merge decoding cohorts')
+                cohorts.append(cohort)
+        self.cohorts = cohorts
+
+    def _complete(self, completed):
+        now = asyncio.get_event_loop().time()
+        for item, response in completed:
+            if item.started is not None:
+                # there are no batches, so we estimate latency with the time it takes to run a request instead
+                elapsed = now - item.started
+                self._batch_seconds = elapsed if self._batch_seconds is None else 0.8 * self._batch_seconds + 0.2 * elapsed
+            if item.future.done():
+                continue
+            if isinstance(response, Exception):
+                item.future.set_exception(response)
+            else:
+                item.future.set_result(response)
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            if self.cohorts:
+                batch = self._waiting_requests()
+            else:
+                batch = await self._next_batch()
+
+            if batch:
+                await self._finish_prefetch()
+                self.server.metrics.batch_requests.observe(len(batch))
+                for item in batch:
+                    item.started = loop.time()
+                try:
+                    completed, cohorts = await self._run_inference(self.server.start_requests, batch)
+                except Exception as e:
+                    completed, cohorts = [(item, e) for item in batch], []
+                self.cohorts += cohorts
+                self._complete(completed)
+
+            if self.cohorts:
+                self._complete(await self._run_inference(self._step))
+
+
+def model_memory_size(model):
+    """
+    Number of bytes used by the parameters and buffers of `model`
+    """
+    return sum(t.numel() * t.element_size() for t in itertools.chain(model.parameters(), model.buffers()))
+
+
+class ModelPool(object):
+    """
+    The models hosted by a server, in addition to its default model, selected by the `model` field of requests.
+    Each entry of `specs` has the form NAME=PATH[:SRC_LOCALE[:TGT_LOCALE]].
+    Models are loaded the first time they are used, and the least recently used ones are unloaded when the
+    parameters of all loaded models (including the default model) exceed `memory_budget` bytes.
+    Each model is held by its own Server, which shares the metrics, response cache and Bootleg annotations of the default one.
+    """
+
+    def __init__(self, server, specs, memory_budget=None):
+        self.server = server
+        self.memory_budget = memory_budget
+        # name -> (path, src_locale, tgt_locale)
+        self.specs = OrderedDict()
+        for spec in specs or []:
+            name, sep, rest = spec.partition('=')
+            if not sep or not name or not rest:
+                raise ValueError(f'Invalid model {spec}, expected NAME=PATH[:SRC_LOCALE[:TGT_LOCALE]]')
+            path, src_locale, tgt_locale = (rest.split(':') + [None, None])[:3]
+            self.specs[name] = (path, src_locale or server.args.src_locale, tgt_locale or server.args.tgt_locale)
+
+        # name -> Server, from least to most recently used
+        self._resident = OrderedDict()
+        self._sizes = dict()
+        self._lock = threading.Lock()
+        self._load_locks = dict((name, threading.Lock()) for name in self.specs)
+
+        self.loads = dict((name, 0) for name in self.specs)
+        self.load_seconds = dict((name, 0.0) for name in self.specs)
+        self.evictions = dict((name, 0) for name in self.specs)
+
+        if self.specs:
+            metrics = server.metrics
+            metrics.add_gauge('model_resident', 'Whether each model is loaded in memory',
+                              lambda: dict((name, int(name in self._resident)) for name in self.specs), label='model')
+            metrics.add_gauge('model_memory_bytes', 'Memory used by the parameters of each loaded model',
+                              lambda: dict((name, self._sizes.get(name, 0)) for name in self.specs), label='model')
+            metrics.add_gauge('model_load_seconds', 'Time it took to load each model the last time it was loaded',
+                              lambda: dict(self.load_seconds), label='model')
+            metrics.add_counter('model_loads', 'Number of times each model was loaded', lambda: dict(self.loads), label='model')
+            metrics.add_counter('model_evictions', 'Number of times each model was unloaded to stay within the memory budget',
+                                lambda: dict(self.evictions), label='model')
+
+    def get(self, name):
+        """
+        Returns the Server for the model called `name`, loading it if necessary. `None` is the default model.
+        This blocks while the model is loading, so it should not be called from the event loop.
+        """
+        if name is None:
+            return self.server
+        if name not in self.specs:
+            raise ServerError('unknown_model', f'Unknown model {name}')
+        with self._lock:
+            server = self._resident.get(name)
+            if server is not None:
+                self._resident.move_to_end(name)
+                return server
+
+        # only one thread loads each model, the others wait for it
+        with self._load_locks[name]:
+            with self._lock:
+                server = self._resident.get(name)
+                if server is not None:
+                    self._resident.move_to_end(name)
+                    return server
+            server = self._load(name)
+            self._install(name, server)
+        return server
+
+    def reload(self, name):
+        """
+        Loads the model called `name` again from disk. Until the new copy is loaded, requests keep using the old one.
+        """
+        if name not in self.specs:
+            raise ServerError('unknown_model', f'Unknown model {name}')
+        with self._load_locks[name]:
+            self._install(name, self._load(name))
+        gc.collect()
+
+    def evict(self, name):
+        """
+        Unloads the model called `name`, if it is loaded. It is loaded again from disk the next time it is used.
+        """
+        with self._lock:
+            if self._resident.pop(name, None) is not None:
+                del self._sizes[name]
+                self.evictions[name] += 1
+        gc.collect()
+
+    def _load(self, name):
+        path, src_locale, tgt_locale = self.specs[name]
+        logger.info('Loading model %s from %s', name, path)
+        start = time.perf_counter()
+        args = copy.copy(self.server.args)
+        args.path = path
+        args.src_locale = src_locale
+        args.tgt_locale = tgt_locale
+        args.models = None
+        # calibrators given on the command line belong to the default model
+        args.calibrator_paths = None
+        args.search_calibrators = True
+        try:
+            server = self.server.load_server(args)
+            server.warmup()
+        except Exception as e:
+            logger.exception('Failed to load model %s', name)
+            raise ServerError('model_load_failed', f'Failed to load model {name}: {e}')
+        server.metrics = self.server.metrics
+        server.cache = self.server.cache
+        server.annotations = self.server.annotations
+        self.loads[name] += 1
+        self.load_seconds[name] = time.perf_counter() - start
+        logger.info('Loaded model %s in %.1f seconds', name, self.load_seconds[name])
+        return server
+
+    def _install(self, name, server):
+        with self._lock:
+            self._resident[name] = server
+            self._resident.move_to_end(name)
+            self._sizes[name] = model_memory_size(server.model)
+            self._evict()
+
+    def _evict(self):
+        if self.memory_budget is None:
+            return
+        total = model_memory_size(self.server.model) + sum(self._sizes.values())
+        # never unload the model that was just loaded (the most recently used one)
+        while total > self.memory_budget and len(self._resident) > 1:
+            name, _ = self._resident.popitem(last=False)
+            total -= self._sizes.pop(name)
+            self.evictions[name] += 1
+            logger.info('Unloaded model %s to stay within the memory budget', name)
+
+
 class Server(object):
     def __init__(self, args, numericalizer, model, device, confidence_estimators, estimator_filenames, bootleg_annotator=None):
         self.args = args
@@ -61,49 +993,250 @@ class Server(object):
         self.bootleg_annotator = bootleg_annotator
 
         self._cached_task_names = dict()
+        self.batcher = None
+        self._reloading = False
+        # the messages received over TCP that are not answered yet
+        self._pending_messages = set()
+        self._client_writers = set()
 
-    def numericalize_examples(self, ex):
+        self._generation_config = tuple((h, tuple(getattr(args, h))) for h in GENERATION_HYPERPARAMETERS) + (args.max_output_length,)
+        self.model_hash = checkpoint_hash([args.best_checkpoint] + (args.calibrator_paths or []))
+        # sampled outputs are random, so they should not be cached
+        if args.cache_size > 0 and not any(t > 0 for t in args.temperature):
+            self.cache = ResponseCache(args.cache_size, args.cache_ttl)
+        else:
+            self.cache = None
+        self.annotations = None
+        if bootleg_annotator is not None:
+            self.annotations = BootlegAnnotations(bootleg_annotator, args.bootleg_cache_size, args.cache_ttl)
+        self.encoder_cache = None
+        if args.encoder_cache_mb > 0 and model.token_encoder_outputs:
+            self.encoder_cache = EncoderCache(args.encoder_cache_mb * 1024 * 1024, args.encoder_cache_session_entries)
 
-        all_features = NumericalizedExamples.from_examples(ex, self.numericalizer)
-        # make a single batch with all examples
-        return NumericalizedExamples.collate_batches(all_features, self.numericalizer, device=self.device)
-    
+        self.metrics = ServerMetrics()
+        self.metrics.add_gauge('queue_size', 'Number of requests waiting for the model',
+                               lambda: self.batcher.queue.qsize() if self.batcher is not None else 0)
+        self.metrics.add_gauge('priority_queue_size', 'Number of requests waiting for the model, by priority class',
+                               lambda: self.batcher.queue_sizes() if self.batcher is not None else {}, label='priority')
+        if self.cache is not None:
+            self.metrics.add_gauge('cache_size', 'Number of entries in the response cache', lambda: len(self.cache))
+            self.metrics.add_counter('cache_hits', 'Number of response cache hits', lambda: self.cache.hits)
+            self.metrics.add_counter('cache_misses', 'Number of response cache misses', lambda: self.cache.misses)
+            self.metrics.add_counter('cache_evictions', 'Number of entries evicted from the response cache', lambda: self.cache.evictions)
+        if self.annotations is not None and self.annotations.cache is not None:
+            self.metrics.add_gauge('bootleg_cache_size', 'Number of sentences in the Bootleg annotation cache', lambda: len(self.annotations.cache))
+            self.metrics.add_counter('bootleg_cache_hits', 'Number of Bootleg annotation cache hits', lambda: self.annotations.cache.hits)
+            self.metrics.add_counter('bootleg_cache_misses', 'Number of Bootleg annotation cache misses', lambda: self.annotations.cache.misses)
+        if self.encoder_cache is not None:
+            self.metrics.add_gauge('encoder_cache_bytes', 'Size of the encoder states in the encoder cache', lambda: self.encoder_cache.num_bytes)
+            self.metrics.add_counter('encoder_cache_hits', 'Number of inputs whose encoder states were found in the encoder cache',
+                                     lambda: self.encoder_cache.hits)
+            self.metrics.add_counter('encoder_cache_misses', 'Number of inputs of sessions that went through the encoder',
+                                     lambda: self.encoder_cache.misses)
 
-    def handle_request(self, request):
-        task_name = request['task'] if 'task' in request else 'generic'
+        memory_budget = args.model_memory_budget * 1024 * 1024 if args.model_memory_budget is not None else None
+        self.models = ModelPool(self, args.models, memory_budget)
+
+    def numericalize_examples(self, ex):
+        """
+        Numericalizes `ex` and splits it into batches of examples of similar length, each with at most
+        `--val_batch_size` input tokens including padding (an example longer than that gets a batch of its own).
+        Returns the list of batches, and the position in `ex` of each example of the batches
+        """
+        with self.metrics.time('numericalize'):
+            all_features = NumericalizedExamples.from_examples(ex, self.numericalizer)
+        longest = max(features.context.length for features in all_features)
+        if self.args.val_batch_size is not None:
+            batch_size = max(self.args.val_batch_size[0], longest)
+        else:
+            batch_size = longest * len(all_features)
+        with self.metrics.time('collate'):
+            data_loader, original_order = make_features_data_loader(all_features, self.numericalizer, batch_size,
+                                                                    sort_key_fn=input_then_output_len, batch_size_fn=input_tokens_fn,
+                                                                    device=self.device, return_original_order=True)
+            batches = list(data_loader)
+        return batches, original_order
+
+    def _get_task(self, task_name):
         task = list(get_tasks([task_name], self.args, self._cached_task_names).values())[0]
         if task_name not in self._cached_task_names:
+            # the vocabulary only needs to grow the first time we see a task; if the embeddings cannot be resized,
+            # the task is not cached so that the next request fails the same way instead of using unknown token ids
+            self.model.add_new_vocab_from_data([task], reserve_capacity=True)
             self._cached_task_names[task_name] = task
+        return task
+
+    def prepare_request(self, request):
+        """
+        Validates `request` and normalizes its instances
+        Returns the task of the request and a list of (example_id, context, question, answer) tuples
+        """
+        task_name = request['task'] if 'task' in request else 'generic'
+        task = self._get_task(task_name)
+        if not isinstance(request.get('session', ''), (str, int)):
+            raise ServerError('invalid_session', 'The session of a request must be a string or an integer')
 
         # if single example wrap it as a list
         if 'instances' not in request:
             request['instances'] = [{'example_id': request.get('example_id', ''), 'context': request['context'],
                                      'question': request['question'], 'answer': request.get('answer', '')}]
-        
-        examples = []
-        # request['instances'] is an array of {context, question, answer, example_id}
-        for instance in request['instances']:
+            if 'candidates' in request:
+                request['instances'][0]['candidates'] = request['candidates']
+
+        return task, self._request_instances(task, request['instances'])
+
+    def _request_instances(self, task, request_instances):
+        instances = []
+        # request_instances is an array of {context, question, answer, example_id}
+        for instance in request_instances:
             example_id, context, question, answer = instance.get('example_id', ''), instance['context'], instance['question'], instance.get('answer', '')
             if not context:
                 context = task.default_context
             if not question:
                 question = task.default_question
+            context, question = self._limit_input_length(context, question)
+            instances.append((str(example_id), context, question, answer))
+
+        return instances
+
+    @staticmethod
+    def is_scoring_request(request):
+        """
+        Whether `request` asks for the log-probability of given `candidates` answers instead of generating answers
+        """
+        if 'instances' in request:
+            return any('candidates' in instance for instance in request['instances'])
+        return 'candidates' in request
+
+    @staticmethod
+    def request_candidates(request):
+        """
+        Returns the list of candidate answers of each instance of a prepared scoring request
+        """
+        all_candidates = []
+        for instance in request['instances']:
+            candidates = instance.get('candidates')
+            if not isinstance(candidates, list) or not candidates or not all(isinstance(candidate, str) for candidate in candidates):
+                raise ServerError('invalid_candidates', 'Every instance of a scoring request must have a non-empty list of candidate answers')
+            all_candidates.append(candidates)
+        return all_candidates
+
+    def _limit_input_length(self, context, question):
+        """
+        Applies `--max_input_words` to an instance, either by rejecting it or by truncating its context (and question if needed)
+        """
+        max_words = self.args.max_input_words
+        if max_words is None:
+            return context, question
+        context_words, question_words = context.split(), question.split()
+        if len(context_words) + len(question_words) <= max_words:
+            return context, question
+        if not self.args.truncate_long_inputs:
+            raise ServerError('input_too_long', f'Inputs are limited to {max_words} words')
+        # keep the question whole if possible, since it usually tells the model what to do
+        question_words = question_words[:max_words]
+        context_words = context_words[:max_words - len(question_words)]
+        return ' '.join(context_words), ' '.join(question_words)
+
+    def make_example(self, task, instance):
+        example_id, context, question, answer = instance
+        return Example.from_raw(example_id, context, question, answer, preprocess=task.preprocess_field, lower=self.args.lower)
+
+    def make_annotated_examples(self, groups):
+        """
+        Makes the examples for `groups`, a list of (task, list of instances), and adds their Bootleg features
+        with a single batch of the annotator for all groups. Returns the list of examples of each group
+        """
+        with self.metrics.time('preprocess'):
+            examples = [[self.make_example(task, instance) for instance in instances] for task, instances in groups]
+        if self.annotations is not None and groups:
+            with self.metrics.time('bootleg'):
+                self.annotations.annotate([(task, group_examples) for (task, _), group_examples in zip(groups, examples)], self.args)
+        return examples
+
+    def prefetch_annotations(self, requests):
+        """
+        Runs Bootleg on the instances of `requests` ahead of `handle_requests`, so their labels are already in the cache
+        when they reach the model. This runs on the annotation thread while the model is busy, so it leaves out the requests
+        that only the inference thread can prepare: requests for another model, for a task that was never seen (the first
+        request of a task grows the vocabulary), and invalid requests.
+        """
+        utterances = []
+        for request in requests:
+            task = self._cached_task_names.get(request.get('task', 'generic'))
+            if task is None or request.get('model') is not None:
+                continue
+            try:
+                request_instances = request['instances'] if 'instances' in request else [request]
+                for instance in self._request_instances(task, request_instances):
+                    utterances.append(getattr(self.make_example(task, instance), task.utterance_field()))
+            except Exception:
+                continue
+        if not utterances:
+            return
+        try:
+            with self.metrics.time('bootleg'):
+                self.annotations.label(utterances)
+        except Exception:
+            # the inference thread will try again, and report the error
+            logger.warning('Failed to annotate waiting requests', exc_info=True)
+
+    def cache_key(self, task, instance):
+        _example_id, context, question, answer = instance
+        return (task.name, context, question, answer, self._generation_config, self.model_hash)
+
+    def _make_streamer(self, streams, original_order):
+        """
+        Adapts the per-example `streams` of `predict` to the `streamer` argument of `generate_with_model`
+        """
+        if streams is None or all(stream is None for stream in streams):
+            return None
+
+        def streamer(example_index, token_ids):
+            stream = streams[original_order[example_index]]
+            if stream is not None:
+                stream(self.numericalizer.reverse(token_ids.unsqueeze(0), 'answer')[0])
 
-            ex = Example.from_raw(str(example_id), context, question, answer, preprocess=task.preprocess_field, lower=self.args.lower)
-            examples.append(ex)
-        
-        # process bootleg features
-        if self.bootleg_annotator:
-            extract_features_with_annotator(examples, self.bootleg_annotator, self.args, task)
-        
-        self.model.add_new_vocab_from_data([task])
-        batch = self.numericalize_examples(examples)
-        
+        return streamer
+
+    def _make_encoder(self, task, sessions, original_order):
+        """
+        Returns an `encoder` for `generate_with_model` that reuses the encoder states of the examples of a session (one element of
+        `sessions` for each example of `predict`, which all belong to `task`), or None if there are none
+        """
+        if self.encoder_cache is None or sessions is None or all(session is None for session in sessions):
+            return None
+
+        def encoder(batch, batch_start):
+            batch_sessions = [sessions[original_order[batch_start + row]] for row in range(len(batch.example_id))]
+            return self.encoder_cache.encode(self.model, batch, task.name, batch_sessions, self.numericalizer.pad_id)
+
+        return encoder
+
+    def predict(self, task, examples, streams=None, sessions=None):
+        """
+        Runs the model on `examples`, which must all belong to `task` and already have their Bootleg features
+        (see make_annotated_examples), in as few batches as `--val_batch_size` allows
+        If `streams` is provided, it has one element for each example, which is either None or a function called
+        with the partial answer for that example after every decoding step
+        If `sessions` is provided, it has the session of each example (or None), used to look up its encoder states in the EncoderCache
+        Returns a list with one response dictionary for each example
+        """
+        batches, original_order = self.numericalize_examples(examples)
+        for batch in batches:
+            self.metrics.batch_examples.observe(len(batch.example_id))
+
+        streamer = self._make_streamer(streams, original_order)
+        encoder = self._make_encoder(task, sessions, original_order)
         with torch.no_grad():
             if self.args.calibrator_paths is not None:
-                output = generate_with_model(self.model, [batch], self.numericalizer, task, self.args,
+                output = generate_with_model(self.model, batches, self.numericalizer, task, self.args,
                                                 output_predictions_only=True,
-                                                confidence_estimators=self.confidence_estimators)
+                                                original_order=original_order,
+                                                confidence_estimators=self.confidence_estimators,
+                                                timer=self.metrics,
+                                                streamer=streamer,
+                                                encoder=encoder)
                 response = []
                 for idx, p in enumerate(output.predictions):
                     instance = {'answer': p[0], 'score': {}}
@@ -111,49 +1244,600 @@ class Server(object):
                         instance['score'][self.estimator_filenames[e_idx]] = float(estimator_scores[idx])
                     response.append(instance)
             else:
-                output = generate_with_model(self.model, [batch], self.numericalizer, task, self.args, output_predictions_only=True)
+                output = generate_with_model(self.model, batches, self.numericalizer, task, self.args, output_predictions_only=True,
+                                             original_order=original_order, timer=self.metrics, streamer=streamer, encoder=encoder)
                 response = [{'answer': p[0]} for p in output.predictions]
             
         return response
 
+    def score(self, task, examples):
+        """
+        Computes the log-probability of the answer of each of `examples` given its input with a teacher-forced pass through the model.
+        `examples` must all belong to `task` and already have their Bootleg features; they run in as few batches as `--val_batch_size`
+        allows, and examples with the same input share a single run of the encoder.
+        Returns a list with a (log-probability, list of token log-probabilities) tuple for each example
+        """
+        batches, original_order = self.numericalize_examples(examples)
+        for batch in batches:
+            self.metrics.batch_examples.observe(len(batch.example_id))
+        with torch.no_grad():
+            return score_with_model(self.model, batches, original_order=original_order, timer=self.metrics)
 
-    def handle_json_request(self, line : str) -> str:
-        request = json.loads(line)
-        if 'instances' in request:
-            return json.dumps({'id': request['id'], 'instances': self.handle_request(request)}) + '\n'
+    def handle_request(self, request):
+        response = self.handle_requests([request])[0]
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def handle_requests(self, requests, streams=None):
+        """
+        Runs a list of requests through the model selected by their `model` field (see ModelPool).
+        Returns a list with the response of each request, in the same order as `requests`.
+        A malformed request does not affect the others; its response is the exception it raised.
+        If `streams` is provided, it has one element for each request, which is either None or a function called as
+        `stream(instance_index, partial_answer)` while the request is running (only for greedy decoding and sampling).
+        """
+        if streams is None:
+            streams = [None] * len(requests)
+        # model name -> list of request indices
+        groups = OrderedDict()
+        for idx, request in enumerate(requests):
+            groups.setdefault(request.get('model'), []).append(idx)
+        if len(groups) == 1 and None in groups:
+            return self._run_requests(requests, streams)
+
+        responses = [None] * len(requests)
+        for name, indices in groups.items():
+            try:
+                server = self.models.get(name)
+            except ServerError as e:
+                for idx in indices:
+                    responses[idx] = e
+                continue
+            for idx, response in zip(indices, server._run_requests([requests[idx] for idx in indices], [streams[idx] for idx in indices])):
+                responses[idx] = response
+        return responses
+
+    def _run_requests(self, requests, streams):
+        """
+        Runs a list of requests through the model of this server. Instances found in the response cache are answered
+        directly, and the remaining instances of requests for the same task are merged into a single batch.
+        The candidates of scoring requests (see is_scoring_request) for the same task are scored in a single batch too.
+        """
+        responses = [None] * len(requests)
+        # task name -> (task, list of (request index, instance index, instance, cache key))
+        groups = OrderedDict()
+        # task name -> (task, list of (request index, instance index, instance, candidates))
+        scoring_groups = OrderedDict()
+        for idx, request in enumerate(requests):
+            try:
+                task, instances = self.prepare_request(request)
+                all_candidates = None
+                if self.is_scoring_request(request):
+                    if not self.model.supports_scoring:
+                        raise ServerError('invalid_request', f'{type(self.model).__name__} models with --runtime {self.args.runtime} '
+                                                             f'cannot score candidate answers')
+                    all_candidates = self.request_candidates(request)
+            except Exception as e:
+                responses[idx] = e
+                continue
+            responses[idx] = [None] * len(instances)
+            if all_candidates is not None:
+                if task.name not in scoring_groups:
+                    scoring_groups[task.name] = (task, [])
+                scoring_groups[task.name][1].extend((idx, instance_idx, instance, candidates)
+                                                    for instance_idx, (instance, candidates) in enumerate(zip(instances, all_candidates)))
+                continue
+            for instance_idx, instance in enumerate(instances):
+                key = None
+                if self.cache is not None:
+                    key = self.cache_key(task, instance)
+                    cached = self.cache.get(key)
+                    if cached is not None:
+                        responses[idx][instance_idx] = cached
+                        continue
+                if task.name not in groups:
+                    groups[task.name] = (task, [])
+                groups[task.name][1].append((idx, instance_idx, instance, key))
+
+        # every candidate is scored as the answer of its instance
+        scoring_instances = [(task, [(example_id, context, question, candidate)
+                                     for _, _, (example_id, context, question, _), candidates in members for candidate in candidates])
+                             for task, members in scoring_groups.values()]
+        # all tasks go through Bootleg together
+        all_groups = [(task, [instance for _, _, instance, _ in members]) for task, members in groups.values()] + scoring_instances
+        try:
+            all_examples = self.make_annotated_examples(all_groups)
+        except Exception:
+            # find the groups that fail, so that the others still get their responses
+            all_examples = []
+            for group in all_groups:
+                try:
+                    all_examples.extend(self.make_annotated_examples([group]))
+                except Exception as e:
+                    all_examples.append(e)
+
+        # a group that fails only fails its own requests, not the others of the batch
+        for (task, members), examples in zip(scoring_groups.values(), all_examples[len(groups):]):
+            try:
+                if isinstance(examples, Exception):
+                    raise examples
+                scores = iter(self.score(task, examples))
+            except Exception as e:
+                for idx, _, _, _ in members:
+                    responses[idx] = e
+                continue
+            for idx, instance_idx, _, candidates in members:
+                responses[idx][instance_idx] = {'candidates': [{'answer': candidate, 'log_prob': log_prob, 'token_log_probs': token_log_probs}
+                                                               for candidate, (log_prob, token_log_probs) in zip(candidates, scores)]}
+
+        for (task, members), examples in zip(groups.values(), all_examples):
+            member_streams = None
+            if any(streams[idx] is not None for idx, _, _, _ in members):
+                member_streams = [functools.partial(streams[idx], instance_idx) if streams[idx] is not None else None
+                                  for idx, instance_idx, _, _ in members]
+            sessions = [requests[idx].get('session') for idx, _, _, _ in members]
+            try:
+                if isinstance(examples, Exception):
+                    raise examples
+                predictions = self.predict(task, examples, member_streams, sessions)
+            except Exception as e:
+                for idx, _, _, _ in members:
+                    responses[idx] = e
+                continue
+            # put the predictions back into their original requests
+            for (idx, instance_idx, _, key), prediction in zip(members, predictions):
+                responses[idx][instance_idx] = prediction
+                if key is not None:
+                    self.cache.put(key, prediction)
+
+        return responses
+
+    def supports_continuous_batching(self):
+        """
+        Whether requests for this model can run with a ContinuousBatcher, which only supports greedy decoding
+        with a single output, and no calibrators
+        """
+        args = self.args
+        return (self.model.supports_incremental_decoding and self.confidence_estimators is None and len(args.temperature) == 1
+                and args.temperature[0] == 0 and args.num_beams[0] == 1 and args.num_outputs[0] == 1)
+
+    def make_batcher(self):
+        args = self.args
+        if args.continuous_batching:
+            if self.supports_continuous_batching():
+                return ContinuousBatcher(self, args.max_batch_wait / 1000, args.max_batch_tokens, args.max_queue_size,
+                                         args.priority_classes, args.task_priorities)
+            logger.warning('Continuous batching requires a TransformerSeq2Seq model with greedy decoding, a single output and '
+                           'no calibrators; requests will run in regular batches instead')
+        return RequestBatcher(self, args.max_batch_wait / 1000, args.max_batch_tokens, args.max_queue_size,
+                              args.priority_classes, args.task_priorities)
+
+    def start_requests(self, items):
+        """
+        Starts running the QueuedRequests in `items` with a ContinuousBatcher. Instances found in the response cache are
+        answered directly, and requests that need the regular batch generation (e.g. because they are for another model,
+        scoring requests, or requests whose task needs the cross-attention of whole outputs) run to completion right away.
+        Returns a list of (QueuedRequest, response) for the requests that are complete, and the list of new DecodingCohorts
+        """
+        completed = []
+        batch_requests = []
+        # task name -> (task, list of (RunningRequest, instance index, instance, cache key))
+        groups = OrderedDict()
+        for item in items:
+            request = item.request
+            if request.get('model') is not None or not self.supports_continuous_batching() or self.is_scoring_request(request):
+                batch_requests.append(item)
+                continue
+            try:
+                task, instances = self.prepare_request(request)
+            except Exception as e:
+                completed.append((item, e))
+                continue
+            if task.uses_cross_attentions:
+                batch_requests.append(item)
+                continue
+
+            responses = [None] * len(instances)
+            for instance_idx, instance in enumerate(instances):
+                if self.cache is not None:
+                    cached = self.cache.get(self.cache_key(task, instance))
+                    if cached is not None:
+                        responses[instance_idx] = cached
+            running = RunningRequest(item, responses)
+            if running.remaining == 0:
+                completed.append((item, responses))
+                continue
+            if task.name not in groups:
+                groups[task.name] = (task, [])
+            groups[task.name][1].extend((running, instance_idx, instance, self.cache_key(task, instance) if self.cache is not None else None)
+                                        for instance_idx, instance in enumerate(instances) if responses[instance_idx] is None)
+
+        if batch_requests:
+            responses = self.handle_requests([item.request for item in batch_requests], [item.stream for item in batch_requests])
+            completed.extend(zip(batch_requests, responses))
+
+        cohorts = []
+        try:
+            all_examples = self.make_annotated_examples([(task, [instance for _, _, instance, _ in members]) for task, members in groups.values()])
+        except Exception as e:
+            logger.exception('Failed to prepare the examples')
+            completed.extend((running.item, e) for _, members in groups.values() for running in OrderedDict.fromkeys(member[0] for member in members))
+            return completed, cohorts
+        for (task, members), examples in zip(groups.values(), all_examples):
+            try:
+                cohorts += self._start_cohorts(task, members, examples)
+            except Exception as e:
+                logger.exception('Failed to start decoding')
+                completed.extend((running.item, e) for running in OrderedDict.fromkeys(member[0] for member in members))
+        return completed, cohorts
+
+    def _start_cohorts(self, task, members, examples):
+        """
+        Runs the encoder on the `examples` of the instances in `members`, which must all belong to `task`, in as few batches
+        as `--val_batch_size` allows. Returns a DecodingCohort for each batch
+        """
+        batches, original_order = self.numericalize_examples(examples)
+        encoder = self._make_encoder(task, [running.item.request.get('session') for running, _, _, _ in members], original_order)
+        cohorts = []
+        start = 0
+        for batch in batches:
+            batch_size = len(batch.example_id)
+            self.metrics.batch_examples.observe(batch_size)
+            with torch.no_grad(), self.metrics.time('encode'):
+                encoder_hidden_states = encoder(batch, start) if encoder is not None else None
+                decoding = self.model.start_greedy_decoding(batch, self.args.max_output_length, self.args.repetition_penalty[0],
+                                                            self.args.no_repeat_ngram_size[0], encoder_hidden_states)
+            cohort_members = []
+            for idx in original_order[start:start + batch_size]:
+                running, instance_idx, instance, key = members[idx]
+                example_id, context, question, _answer = instance
+                cohort_members.append((running, instance_idx, example_id, key, len(context.split()) + len(question.split())))
+            cohorts.append(DecodingCohort(self, task, decoding, cohort_members))
+            start += batch_size
+        return cohorts
+
+    def warmup(self, task_names=None):
+        """
+        Runs synthetic inputs through the model for each task in `task_names` (`--warmup_tasks` by default),
+        in batches of each size in `--warmup_batch_sizes` and with inputs of each length in `--warmup_lengths`,
+        with all the configured generation hyperparameters. This way, lazy initialization (growing the vocabulary,
+        tokenizer and kernel caches, memory allocation) happens before the server sees real requests.
+        """
+        if task_names is None:
+            task_names = self.args.warmup_tasks
+        start = time.perf_counter()
+        for task_name in task_names:
+            try:
+                task = self._get_task(task_name)
+                for length in self.args.warmup_lengths:
+                    context = ' '.join(WARMUP_WORDS[i % len(WARMUP_WORDS)] for i in range(length))
+                    for batch_size in self.args.warmup_batch_sizes:
+                        instances = [(f'warmup-{i}', context, task.default_question, '') for i in range(batch_size)]
+                        examples = self.make_annotated_examples([(task, instances)])[0]
+                        self.predict(task, examples)
+            except Exception:
+                logger.warning('Failed to warm up task %s', task_name, exc_info=True)
+        logger.info('Warmup took %.1f seconds', time.perf_counter() - start)
+
+    def load_replacement(self, path=None, checkpoint_name=None):
+        """
+        Loads a fresh copy of the model, numericalizer and calibrators from disk (optionally from a different
+        `path` or `checkpoint_name`), and warms it up with the tasks this server has seen so far.
+        Returns a new Server, whose state can be moved into this one with `swap`
+        """
+        args = copy.copy(self.args)
+        if path is not None:
+            args.path = path
+        if checkpoint_name is not None:
+            args.checkpoint_name = checkpoint_name
+        replacement = self.load_server(args)
+        replacement.warmup(list(OrderedDict.fromkeys(self.args.warmup_tasks + list(self._cached_task_names.keys()))))
+        return replacement
+
+    def load_server(self, args):
+        """
+        Loads the model and calibrators in `args.path`, and returns a new Server for them on the same device
+        """
+        load_config_json(args)
+        model = load_model(args, self.device)
+        confidence_estimators, estimator_filenames = load_confidence_estimators(args)
+        return Server(args, model.numericalizer, model, self.device, confidence_estimators, estimator_filenames,
+                      self.bootleg_annotator)
+
+    def _load_replacement_or_fail(self, path, checkpoint_name):
+        try:
+            return self.load_replacement(path, checkpoint_name)
+        except Exception as e:
+            logger.exception('Failed to reload the model, still serving the old one')
+            raise ServerError('reload_failed', str(e))
+
+    def swap(self, replacement):
+        """
+        Starts serving with the model of `replacement`. This must not run concurrently with `handle_requests`,
+        so it is called from the inference thread, between two batches.
+        """
+        self.args = replacement.args
+        self.numericalizer = replacement.numericalizer
+        self.model = replacement.model
+        self.confidence_estimators = replacement.confidence_estimators
+        self.estimator_filenames = replacement.estimator_filenames
+        self._cached_task_names = replacement._cached_task_names
+        self._generation_config = replacement._generation_config
+        self.model_hash = replacement.model_hash
+        # responses of the old model can never be hit again, since the model hash is part of the key
+        if self.cache is not None:
+            self.cache.clear()
+        # the encoder states of the old model are of no use either; the cache is kept (unless the new model cannot use it)
+        # so that its counters keep increasing
+        if self.encoder_cache is not None and replacement.encoder_cache is not None:
+            self.encoder_cache.clear()
+        else:
+            self.encoder_cache = replacement.encoder_cache
+
+    def _free_old_model(self):
+        gc.collect()
+        if self.device.type == 'cuda':
+            torch.cuda.empty_cache()
+
+    def reload(self, path=None, checkpoint_name=None):
+        """
+        Reloads the model synchronously, used when there is no request batcher (--stdin)
+        """
+        replacement = self._load_replacement_or_fail(path, checkpoint_name)
+        self.swap(replacement)
+        del replacement
+        self._free_old_model()
+        logger.info('Reloaded model from %s (hash %s)', self.args.best_checkpoint, self.model_hash)
+
+    async def reload_async(self, path=None, checkpoint_name=None):
+        """
+        Reloads the model without interrupting the service: the new model is loaded and warmed up in a background
+        thread while requests keep being served by the old one, then the two are swapped between batches.
+        Requests that are already running finish on the old model.
+        """
+        if self._reloading:
+            raise ServerError('reload_in_progress', 'The model is already being reloaded')
+        self._reloading = True
+        try:
+            loop = asyncio.get_event_loop()
+            logger.info('Reloading model')
+            replacement = await loop.run_in_executor(None, self._load_replacement_or_fail, path, checkpoint_name)
+            await loop.run_in_executor(self.batcher.executor, self.swap, replacement)
+            del replacement
+            self._free_old_model()
+            logger.info('Reloaded model from %s (hash %s)', self.args.best_checkpoint, self.model_hash)
+        finally:
+            self._reloading = False
+
+    async def _reload_on_signal(self):
+        try:
+            await self.reload_async()
+        except ServerError as e:
+            logger.warning('Model was not reloaded: %s', e.message)
+
+    def _command_response(self, request):
+        # the model was just (re)loaded, so this does not block
+        model_hash = self.models.get(request.get('model')).model_hash
+        return {'id': request.get('id'), 'status': 'ok', 'model_hash': model_hash}
+
+    def _check_command(self, request):
+        if request['command'] != 'reload':
+            raise ServerError('invalid_command', f'Unknown command {request["command"]}')
+        # checkpoints are unpickled when they are loaded, so clients can only choose among the files of --path
+        path = request.get('path')
+        if path is not None and (not isinstance(path, str) or os.path.realpath(path) != os.path.realpath(self.args.path)):
+            raise ServerError('invalid_command', 'The model can only be reloaded from the directory the server was started with')
+        checkpoint_name = request.get('checkpoint_name')
+        if checkpoint_name is not None and (not isinstance(checkpoint_name, str) or os.path.basename(checkpoint_name) != checkpoint_name
+                                            or checkpoint_name in ('', '.', '..')):
+            raise ServerError('invalid_command', 'checkpoint_name must be the name of a file in the model directory')
+
+    @staticmethod
+    def response_message(request, response, is_batch):
+        if is_batch:
+            return {'id': request['id'], 'instances': response}
         else:
-            response = self.handle_request(request)
             assert len(response) == 1
             response = response[0]
             response['id'] = request['id']
-            return json.dumps(response) + '\n'
+            return response
+
+    @staticmethod
+    def error_message(request, error):
+        return {'id': request.get('id'), 'error': error.code, 'message': error.message}
+
+    @staticmethod
+    def partial_stream(request, is_batch, send):
+        """
+        Returns a `stream` function for `RequestBatcher.submit` that calls `send` with a message containing
+        the partial answer of an instance of `request` every time it changes
+        """
+        last_partial_answers = dict()
+
+        def stream(instance_index, partial_answer):
+            if last_partial_answers.get(instance_index) == partial_answer:
+                return
+            last_partial_answers[instance_index] = partial_answer
+            message = {'id': request.get('id'), 'partial': partial_answer}
+            if is_batch:
+                message['instance'] = instance_index
+            send(message)
+
+        return stream
+
+    def _encode(self, protocol, message):
+        with self.metrics.time_serialization(protocol.name, 'serialize'):
+            return protocol.encode(message)
+
+    def handle_json_request(self, line : str) -> str:
+        request = dict()
+        try:
+            request = self._decode_request(JsonLinesProtocol, line)
+            is_batch = 'instances' in request
+            if 'command' in request:
+                self._check_command(request)
+                if request.get('model') is not None:
+                    self.models.reload(request['model'])
+                else:
+                    self.reload(request.get('path'), request.get('checkpoint_name'))
+                message = self._command_response(request)
+            else:
+                message = self.response_message(request, self.handle_request(request), is_batch)
+        except ServerError as e:
+            message = self.error_message(request, e)
+        return self._encode(JsonLinesProtocol, message).decode('utf-8')
+
+    async def _handle_client_message(self, data, protocol, client_writer):
+        def send(message):
+            client_writer.write(self._encode(protocol, message))
+
+        request = dict()
+        try:
+            request = self._decode_request(protocol, data)
+            is_batch = 'instances' in request
+            if 'command' in request:
+                # admin commands bypass the request queue
+                self._check_command(request)
+                if request.get('model') is not None:
+                    await asyncio.get_event_loop().run_in_executor(None, self.models.reload, request['model'])
+                else:
+                    await self.reload_async(request.get('path'), request.get('checkpoint_name'))
+                send(self._command_response(request))
+                return
+            if request.get('model') is not None:
+                # load the model in the background rather than in the inference thread, which serves the other models
+                await asyncio.get_event_loop().run_in_executor(None, self.models.get, request['model'])
+            stream = None
+            if request.get('stream'):
+                stream = self.partial_stream(request, is_batch, send)
+            response = await self.batcher.submit(request, stream)
+        except ServerError as e:
+            send(self.error_message(request, e))
+            return
+        except Exception:
+            logger.exception('Failed to process request %s', data)
+            send(self.error_message(request, ServerError('internal_error', 'The server failed to process the request')))
+            return
+        send(self.response_message(request, response, is_batch))
+
+    def _decode_request(self, protocol, data):
+        """
+        Decodes a request received with `protocol`. Raises a ServerError if it is not a valid message of the protocol, or not an object
+        """
+        with self.metrics.time_serialization(protocol.name, 'parse'):
+            try:
+                request = protocol.decode(data)
+            except Exception as e:
+                raise ServerError('invalid_request', f'Cannot decode the request: {str(e) or type(e).__name__}')
+        if not isinstance(request, dict):
+            raise ServerError('invalid_request', 'A request must be an object')
+        return request
+
+    def _negotiate_protocol(self, data, client_writer):
+        """
+        Handles the first message of a connection. Clients that want a protocol other than JSON lines
+        send {"protocol": name} as a JSON line, and the server acknowledges it in JSON before switching.
+        Returns the protocol of the rest of the connection, or None if `data` is a regular request.
+        """
+        try:
+            message = json.loads(data)
+        except ValueError:
+            return None
+        if not isinstance(message, dict) or 'protocol' not in message:
+            return None
+        protocol = PROTOCOLS.get(message['protocol'])
+        if protocol is None:
+            client_writer.write(JsonLinesProtocol.encode(self.error_message(message, ServerError('invalid_protocol', f'Unknown protocol {message["protocol"]}'))))
+            return JsonLinesProtocol
+        client_writer.write(JsonLinesProtocol.encode({'protocol': protocol.name}))
+        return protocol
 
     async def handle_client(self, client_reader, client_writer):
+        # requests on the same connection are pipelined: we keep reading while earlier requests
+        # are still running, and each response is written as soon as it is ready, tagged with its `id`
+        pending = set()
+        self._client_writers.add(client_writer)
         try:
-            line = await client_reader.readline()
-            while line:
-                client_writer.write(self.handle_json_request(line).encode('utf-8'))
-                line = await client_reader.readline()
+            protocol = JsonLinesProtocol
+            data = await protocol.read(client_reader)
+            if data is not None:
+                negotiated = self._negotiate_protocol(data, client_writer)
+                if negotiated is not None:
+                    protocol = negotiated
+                    data = await protocol.read(client_reader)
+            while data is not None:
+                task = asyncio.ensure_future(self._handle_client_message(data, protocol, client_writer))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+                self._pending_messages.add(task)
+                task.add_done_callback(self._pending_messages.discard)
+                data = await protocol.read(client_reader)
+
+            # the client closed its side of the connection, finish what it has sent so far
+            if pending:
+                await asyncio.gather(*pending)
+            client_writer.close()
 
         except IOError:
             logger.info('Connection to client_reader closed')
+            for task in pending:
+                task.cancel()
             try:
                 client_writer.close()
             except IOError:
                 pass
+        finally:
+            self._client_writers.discard(client_writer)
+
+    def _retire(self, server):
+        """
+        Stops accepting connections, and stops the event loop once the requests received so far are answered
+        """
+        logger.info('Retiring, %d requests left', len(self._pending_messages))
+        server.close()
+        asyncio.ensure_future(self._stop_when_idle())
+
+    async def _stop_when_idle(self):
+        while self._pending_messages:
+            await asyncio.sleep(0.05)
+        # clients see their connection close, and connect to another worker
+        for client_writer in list(self._client_writers):
+            client_writer.close()
+        asyncio.get_event_loop().stop()
 
-    def _run_tcp(self):
+    def _run_tcp(self, sock=None):
+        """
+        Serves requests over TCP. If `sock` is provided, it is an already listening socket to accept connections from
+        """
         loop = asyncio.get_event_loop()
-        server = loop.run_until_complete(asyncio.start_server(self.handle_client, port=self.args.port))
+        self.batcher = self.make_batcher()
+        batcher_task = loop.create_task(self.batcher.run())
+        if sock is not None:
+            server = loop.run_until_complete(asyncio.start_server(self.handle_client, sock=sock))
+            # in a worker of _run_workers, where the parent reloads the model and replaces the workers
+            loop.add_signal_handler(signal.SIGHUP, self._retire, server)
+        else:
+            server = loop.run_until_complete(asyncio.start_server(self.handle_client, port=self.args.port))
+            loop.add_signal_handler(signal.SIGHUP, lambda: asyncio.ensure_future(self._reload_on_signal()))
+        # workers start with the signals blocked by the parent, see _run_workers
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGHUP})
+        self.metrics.ready = True
+        logger.info('Ready to accept requests')
         try:
             loop.run_forever()
         except KeyboardInterrupt:
             pass
+        batcher_task.cancel()
+        self.batcher.executor.shutdown(wait=False)
+        if self.cache is not None:
+            logger.info('Response cache statistics: %s', self.cache.stats())
         server.close()
         loop.run_until_complete(server.wait_closed())
         loop.close()
 
     def _run_stdin(self):
+        self.metrics.ready = True
         try:
             while True:
                 line = sys.stdin.readline()
@@ -164,12 +1848,140 @@ class Server(object):
         except KeyboardInterrupt:
             pass
 
+    def _start_worker(self, worker_id, sock, num_threads):
+        pid = os.fork()
+        if pid != 0:
+            logger.info('Started worker %d with pid %d', worker_id, pid)
+            return pid
+
+        # in the worker
+        exit_code = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            # SIGHUP stays blocked until the event loop handles it, so that it is not lost
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGCHLD})
+            torch.set_num_threads(num_threads)
+            if self.args.metrics_port is not None:
+                # each worker has its own metrics
+                start_metrics_server(self.metrics, self.args.metrics_port + worker_id)
+            self._run_tcp(sock)
+        except Exception:
+            logger.exception('Worker %d failed', worker_id)
+            exit_code = 1
+        finally:
+            os._exit(exit_code)
+
+    def _run_workers(self):
+        """
+        Serves requests over TCP from `args.workers` processes forked from this one.
+        The model is loaded once before forking, so its weights are shared copy-on-write by all workers.
+        All workers accept connections from the same listening socket.
+        On SIGHUP, this process reloads the model, then replaces the workers one at a time: each finishes the requests
+        it has received and exits, and a new worker is forked with the new model.
+        """
+        if self.args.stdin:
+            raise ValueError('--workers cannot be used together with --stdin')
+        if self.device.type != 'cpu':
+            raise ValueError('--workers is only supported when running on CPU')
+
+        num_threads = worker_num_threads(self.args)
+        logger.info('Starting %d workers with %d threads each', self.args.workers, num_threads)
+
+        sock = socket.create_server(('', self.args.port))
+        # move all the objects allocated so far (including the model) out of the reach of the garbage collector,
+        # so that the workers do not write to (and therefore copy) the memory pages that hold them
+        gc.freeze()
+
+        # terminating the parent terminates all the workers
+        def on_sigterm(signum, frame):
+            raise KeyboardInterrupt
+        signal.signal(signal.SIGTERM, on_sigterm)
+        # the loop below waits for these signals; the workers inherit the mask and unblock them
+        signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGCHLD, signal.SIGHUP})
+
+        # pid -> worker id
+        workers = dict()
+        # the workers that were asked to finish their requests and exit, to be replaced by workers with the reloaded model
+        retiring = dict()
+        # the worker ids to replace, one at a time so that the others keep serving
+        to_replace = []
+        for worker_id in range(self.args.workers):
+            workers[self._start_worker(worker_id, sock, num_threads)] = worker_id
+        try:
+            while workers or retiring:
+                if to_replace and not retiring:
+                    worker_id = to_replace.pop(0)
+                    pid = next((pid for pid, other_id in workers.items() if other_id == worker_id), None)
+                    if pid is not None:
+                        retiring[pid] = workers.pop(pid)
+                        os.kill(pid, signal.SIGHUP)
+                    continue
+
+                if signal.sigwaitinfo({signal.SIGCHLD, signal.SIGHUP}).si_signo == signal.SIGHUP:
+                    if self._reload_for_workers():
+                        # a worker that is retiring is replaced by a worker with the new model anyway
+                        to_replace = sorted(workers.values())
+                    continue
+
+                for pid, status in reap_children():
+                    if pid in retiring:
+                        worker_id = retiring.pop(pid)
+                        logger.info('Replacing worker %d', worker_id)
+                        workers[self._start_worker(worker_id, sock, num_threads)] = worker_id
+                        continue
+                    worker_id = workers.pop(pid, None)
+                    if worker_id is None:
+                        continue
+                    if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+                        logger.info('Worker %d exited', worker_id)
+                        continue
+                    logger.warning('Worker %d exited unexpectedly (status %d), restarting it', worker_id, status)
+                    workers[self._start_worker(worker_id, sock, num_threads)] = worker_id
+        except KeyboardInterrupt:
+            for pid in itertools.chain(workers, retiring):
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+            for pid in itertools.chain(workers, retiring):
+                try:
+                    os.waitpid(pid, 0)
+                except ChildProcessError:
+                    pass
+        sock.close()
+
+    def _reload_for_workers(self):
+        """
+        Reloads the model in the parent of the workers, so that the workers started from now on share the new weights.
+        Returns whether it succeeded
+        """
+        gc.unfreeze()
+        try:
+            self.reload()
+        except ServerError as e:
+            logger.warning('Model was not reloaded: %s', e.message)
+            return False
+        finally:
+            # as in _run_workers
+            gc.freeze()
+        # do not report the warmup in the metrics of the new workers
+        self.metrics.reset()
+        return True
+
     def run(self):
         log_model_size(logger, self.model, self.args.model)
         self.model.to(self.device)
 
         self.model.eval()
-        if self.args.stdin:
+        if self.args.metrics_port is not None and self.args.workers <= 1:
+            start_metrics_server(self.metrics, self.args.metrics_port)
+        # with --workers, this happens once before forking so that the workers share the result
+        self.warmup()
+        # do not report the warmup in the metrics
+        self.metrics.reset()
+        if self.args.workers > 1:
+            self._run_workers()
+        elif self.args.stdin:
             self._run_stdin()
         else:
             self._run_tcp()
@@ -185,6 +1997,60 @@ def parse_argv(parser):
                         help='Checkpoint file to use (relative to --path, defaults to best.pth)')
     parser.add_argument('--port', default=8401, type=int, help='TCP port to listen on')
     parser.add_argument('--stdin', action='store_true', help='Interact on stdin/stdout instead of TCP')
+    parser.add_argument('--workers', default=1, type=int,
+                        help='Number of server processes. The model is loaded once and shared by all processes. Only supported on CPU.')
+    parser.add_argument('--threads_per_worker', default=None, type=int,
+                        help='Number of threads each server process uses for inference. Defaults to the number of CPUs divided by --workers')
+    parser.add_argument('--max_batch_wait', default=5, type=float,
+                        help='Maximum time (in milliseconds) to wait for more requests before running a batch. 0 disables waiting.')
+    parser.add_argument('--max_batch_tokens', default=4000, type=int,
+                        help='Maximum number of input tokens in a batch of requests')
+    parser.add_argument('--val_batch_size', nargs='+', default=None, type=int,
+                        help='Maximum number of input tokens (including padding) of each batch run through the model. Requests with more '
+                             'are split into batches of examples of similar length. Defaults to the value used in training')
+    parser.add_argument('--continuous_batching', action='store_true',
+                        help='Schedule requests one decoding step at a time instead of one batch at a time, so that short outputs are returned '
+                             'as soon as they are complete and new requests join the running ones at the next step. '
+                             'Only for TransformerSeq2Seq models with greedy decoding. --max_batch_tokens limits the input tokens of running requests')
+    parser.add_argument('--max_queue_size', default=1000, type=int,
+                        help='Maximum number of requests waiting to be processed. Further requests are rejected as overloaded. 0 means no limit.')
+    parser.add_argument('--priority_classes', type=str, nargs='+', default=DEFAULT_PRIORITY_CLASSES,
+                        help='Priority classes of requests, as NAME=WEIGHT. When several classes have requests waiting, each gets a share of '
+                             'the model proportional to its weight. Requests choose a class with their `priority` field; the first class is the default')
+    parser.add_argument('--task_priorities', type=str, nargs='+', default=None,
+                        help='Priority classes of the requests for some tasks that do not specify one, as TASK=CLASS (e.g. almond_translate=bulk)')
+    parser.add_argument('--max_input_words', default=None, type=int,
+                        help='Maximum number of words in the context and question of an instance. Longer inputs are rejected, '
+                             'unless --truncate_long_inputs is provided')
+    parser.add_argument('--truncate_long_inputs', action='store_true',
+                        help='Truncate inputs longer than --max_input_words instead of rejecting them')
+    parser.add_argument('--warmup_tasks', type=str, nargs='*', default=None,
+                        help='Tasks to run synthetic requests for before accepting requests. Defaults to the tasks the model was trained on; '
+                             'pass the option without any task to disable warmup')
+    parser.add_argument('--warmup_batch_sizes', type=int, nargs='+', default=[1, 16],
+                        help='Number of inputs of each synthetic batch used for warmup')
+    parser.add_argument('--warmup_lengths', type=int, nargs='+', default=[8, 64],
+                        help='Number of words of the synthetic inputs used for warmup')
+    parser.add_argument('--cache_size', default=10000, type=int,
+                        help='Maximum number of responses to keep in the response cache. 0 disables the cache.')
+    parser.add_argument('--cache_ttl', default=3600, type=float,
+                        help='Time (in seconds) after which a cached response expires. 0 means cached responses never expire.')
+    parser.add_argument('--encoder_cache_mb', default=256, type=int,
+                        help='Maximum size in MB of the encoder states kept for requests with a `session` field, so that a session that '
+                             'resends the same input skips the encoder (TransformerSeq2Seq only). 0 disables the cache.')
+    parser.add_argument('--encoder_cache_session_entries', default=4, type=int,
+                        help='Maximum number of inputs whose encoder states are kept for each session')
+    parser.add_argument('--bootleg_cache_size', default=100000, type=int,
+                        help='With --ned_retrieve_method bootleg, maximum number of sentences whose entity annotations are kept in memory '
+                             '(they expire after --cache_ttl). 0 disables the cache.')
+    parser.add_argument('--models', type=str, nargs='+', default=None,
+                        help='Additional models to serve, as NAME=PATH[:SRC_LOCALE[:TGT_LOCALE]]. Requests choose a model with their `model` field, '
+                             'requests without it are served by the model in --path. Models are loaded the first time they are used')
+    parser.add_argument('--model_memory_budget', type=int, default=None,
+                        help='Maximum size in MB of the parameters of all loaded models. The least recently used models are unloaded to stay within it')
+    parser.add_argument('--metrics_port', default=None, type=int,
+                        help='If provided, serve latency, queue and batch metrics in Prometheus format over HTTP on this port. '
+                             'With --workers, worker i uses port metrics_port + i.')
     parser.add_argument('--database_dir', type=str, help='Database folder containing all relevant files')
     parser.add_argument('--src_locale', default='en', help='locale tag of the input language to parse')
     parser.add_argument('--tgt_locale', default='en', help='locale tag of the target language to generate')
@@ -194,20 +2060,11 @@ def parse_argv(parser):
     parser.add_argument('--calibrator_paths', type=str, nargs='+', default=None,
                         help='If provided, will be used to output confidence scores for each prediction. Defaults to `--path`/calibrator.pkl')
 
-def init(args):
-    load_config_json(args)
-    set_seed(args)
-    
-    devices = get_devices()
-    device = devices[0] # server only runs on a single device
-
-    bootleg_annotator = None
-    if args.do_ned and args.ned_retrieve_method == 'bootleg':
-        bootleg_annotator = init_bootleg_annotator(args, device)
+    add_quantization_arguments(parser)
+    add_runtime_arguments(parser)
 
-    logger.info(f'Arguments:\n{pformat(vars(args))}')
+def load_model(args, device):
     logger.info(f'Loading from {args.best_checkpoint}')
-
     Model = getattr(models, args.model)
     model, _ = Model.load(args.path,
                           model_checkpoint_file=args.checkpoint_name,
@@ -217,33 +2074,84 @@ def init(args):
                           tgt_lang=args.tgt_locale
                           )
 
+    quantize_model(model, args, device)
+    load_runtime(model, args, device)
     model.to(device)
     model.eval()
+    return model
 
+
+def load_confidence_estimators(args):
+    """
+    Loads the calibrators in `--calibrator_paths`, or all the calibrators found in `--path` if none was specified.
+    Returns the estimators and their names, or (None, []) if there are no calibrators
+    """
     # set the default path for calibrator if it exists
-    estimator_filenames = []
-    if args.calibrator_paths is None:
-        for filename in os.listdir(args.path):
+    if args.search_calibrators:
+        args.calibrator_paths = None
+        for filename in sorted(os.listdir(args.path)):
             path = os.path.join(args.path, filename)
             if not ConfidenceEstimator.is_estimator(path):
                 continue
             if args.calibrator_paths is None:
                 args.calibrator_paths = []
             args.calibrator_paths.append(path)
-            estimator_filenames.append(os.path.splitext(filename)[0])
+        if args.calibrator_paths is not None and args.runtime == 'torchscript':
+            # see check_runtime_args
+            logger.warning('Ignoring the calibrators in %s, which cannot be used with --runtime torchscript', args.path)
+            args.calibrator_paths = None
+
+    if args.calibrator_paths is None:
+        return None, []
+
+    confidence_estimators = []
+    estimator_filenames = []
+    for path in args.calibrator_paths:
+        estimator = ConfidenceEstimator.load(path)
+        confidence_estimators.append(estimator)
+        estimator_filenames.append(os.path.splitext(os.path.basename(path))[0])
+        logger.info('Loading confidence estimator "%s" from %s', estimator.name, path)
+    args.mc_dropout_num = confidence_estimators[0].mc_dropout_num # we assume all estimators have the same mc_dropout_num
+
+    return confidence_estimators, estimator_filenames
+
+
+def init(args):
+    check_runtime_args(args)
+    load_config_json(args)
+    set_seed(args)
+    
+    if args.quantize is not None or args.runtime != 'eager':
+        # quantized and TorchScript models only run on CPU
+        device = torch.device('cpu')
+    else:
+        devices = get_devices()
+        device = devices[0] # server only runs on a single device
+
+    bootleg_annotator = None
+    if args.do_ned and args.ned_retrieve_method == 'bootleg':
+        bootleg_annotator = init_bootleg_annotator(args, device)
+
+    logger.info(f'Arguments:\n{pformat(vars(args))}')
+
+    model = load_model(args, device)
+
+    if args.warmup_tasks is None:
+        # warm up the tasks the model was trained on
+        with open(os.path.join(args.path, 'config.json')) as config_file:
+            args.warmup_tasks = json.load(config_file).get('train_task_names', [])
 
-    confidence_estimators = None
-    if args.calibrator_paths is not None:
-        confidence_estimators = []
-        for path in args.calibrator_paths:
-            estimator = ConfidenceEstimator.load(path)
-            confidence_estimators.append(estimator)
-            logger.info('Loading confidence estimator "%s" from %s', estimator.name, path)
-        args.mc_dropout_num = confidence_estimators[0].mc_dropout_num # we assume all estimators have the same mc_dropout_num
+    # remember whether calibrators were given explicitly, so we look for them again when reloading
+    args.search_calibrators = args.calibrator_paths is None
+    confidence_estimators, estimator_filenames = load_confidence_estimators(args)
 
     return model, device, confidence_estimators, estimator_filenames, bootleg_annotator
 
 def main(args):
+    if args.workers > 1:
+        # OpenMP thread pools do not survive fork(), so the parent process must not start any;
+        # each worker sets its own number of threads after it is forked
+        torch.set_num_threads(1)
     model, device, confidence_estimators, estimator_filenames, bootleg_annotator = init(args)
     server = Server(args, model.numericalizer, model, device, confidence_estimators, estimator_filenames, bootleg_annotator)
     server.run()
@@ -0,0 +1,221 @@
+#
+# Copyright (c) 2021, Salesforce, Inc.
+#                     The Board of Trustees of the Leland Stanford Junior University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+import logging
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from .server_protocol import PROTOCOLS
+
+logger = logging.getLogger(__name__)
+
+# the stages of a request, in the order they happen
+STAGES = ['parse', 'preprocess', 'bootleg', 'numericalize', 'collate', 'encode', 'generate', 'score', 'reverse', 'postprocess', 'confidence', 'serialize']
+
+QUANTILES = [0.5, 0.95, 0.99]
+
+
+class Distribution(object):
+    """
+    Keeps the count and sum of all observed values, and a window with the most recent values to compute quantiles
+    """
+
+    def __init__(self, window_size=1000):
+        self.count = 0
+        self.sum = 0.0
+        self._window = deque(maxlen=window_size)
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.count += 1
+            self.sum += value
+            self._window.append(value)
+
+    def quantiles(self):
+        with self._lock:
+            window = list(self._window)
+        if not window:
+            return OrderedDict((q, float('nan')) for q in QUANTILES)
+        return OrderedDict(zip(QUANTILES, np.quantile(window, QUANTILES).tolist()))
+
+    def to_dict(self):
+        result = {'count': self.count, 'sum': self.sum}
+        for q, value in self.quantiles().items():
+            result[f'p{int(q * 100)}'] = value
+        return result
+
+
+class ServerMetrics(object):
+    """
+    Latency of each stage of the server, and distributions of queue depths and batch sizes
+    """
+
+    def __init__(self, window_size=1000):
+        self.window_size = window_size
+        self.reset()
+        # set by the server once it accepts requests
+        self.ready = False
+        # name -> (help, type, label, function returning the current value) of additional metrics, e.g. the response cache counters
+        # if label is not None, the function returns a dictionary from label values to values
+        self._callbacks = OrderedDict()
+
+    def reset(self):
+        """
+        Forgets all the observed values
+        """
+        self.stages = OrderedDict((stage, Distribution(self.window_size)) for stage in STAGES)
+        self.queue_depth = Distribution(self.window_size)
+        self.batch_requests = Distribution(self.window_size)
+        self.batch_examples = Distribution(self.window_size)
+        # (protocol name, 'parse' or 'serialize') -> time to decode requests or encode responses, for each protocol of server_protocol.py
+        self.serialization = OrderedDict(((protocol, stage), Distribution(self.window_size))
+                                         for protocol in PROTOCOLS for stage in ('parse', 'serialize'))
+
+    def observe(self, stage, seconds):
+        self.stages[stage].observe(seconds)
+
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    @contextmanager
+    def time_serialization(self, protocol, stage):
+        """
+        Measures the `stage` ('parse' or 'serialize') of a request that uses `protocol`
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.observe(stage, seconds)
+            self.serialization[(protocol, stage)].observe(seconds)
+
+    def add_gauge(self, name, help, fn, label=None):
+        self._callbacks[name] = (help, 'gauge', label, fn)
+
+    def add_counter(self, name, help, fn, label=None):
+        self._callbacks[name] = (help, 'counter', label, fn)
+
+    def to_dict(self):
+        return {
+            'ready': self.ready,
+            'stages': OrderedDict((stage, distribution.to_dict()) for stage, distribution in self.stages.items()),
+            'queue_depth': self.queue_depth.to_dict(),
+            'batch_requests': self.batch_requests.to_dict(),
+            'batch_examples': self.batch_examples.to_dict(),
+            'serialization': OrderedDict((f'{protocol}_{stage}', distribution.to_dict())
+                                         for (protocol, stage), distribution in self.serialization.items()),
+            'values': OrderedDict((name, fn()) for name, (_help, _type, _label, fn) in self._callbacks.items()),
+        }
+
+    def to_prometheus(self):
+        """
+        Returns all metrics in Prometheus text exposition format
+        """
+        lines = ['# HELP genienlp_ready Whether the server has finished warming up and accepts requests',
+                 '# TYPE genienlp_ready gauge',
+                 f'genienlp_ready {int(self.ready)}']
+
+        def add_summary(name, help, distributions, label=None):
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} summary')
+            for label_value, distribution in distributions:
+                if label is None:
+                    labels = ''
+                elif isinstance(label, tuple):
+                    labels = ''.join(f'{l}="{v}",' for l, v in zip(label, label_value))
+                else:
+                    labels = f'{label}="{label_value}",'
+                for q, value in distribution.quantiles().items():
+                    lines.append(f'{name}{{{labels}quantile="{q}"}} {"NaN" if np.isnan(value) else value}')
+                labels = '{' + labels.rstrip(',') + '}' if labels else ''
+                lines.append(f'{name}_sum{labels} {distribution.sum}')
+                lines.append(f'{name}_count{labels} {distribution.count}')
+
+        add_summary('genienlp_stage_seconds', 'Time spent in each stage of processing a request',
+                    list(self.stages.items()), label='stage')
+        add_summary('genienlp_queue_depth', 'Number of requests waiting when a batch is formed', [(None, self.queue_depth)])
+        add_summary('genienlp_batch_requests', 'Number of requests in each batch', [(None, self.batch_requests)])
+        add_summary('genienlp_batch_examples', 'Number of examples in each batch passed to the model', [(None, self.batch_examples)])
+        add_summary('genienlp_serialization_seconds', 'Time spent parsing requests and serializing responses, for each wire protocol',
+                    list(self.serialization.items()), label=('protocol', 'stage'))
+
+        for name, (help, type, label, fn) in self._callbacks.items():
+            lines.append(f'# HELP genienlp_{name} {help}')
+            lines.append(f'# TYPE genienlp_{name} {type}')
+            if label is None:
+                lines.append(f'genienlp_{name} {fn()}')
+            else:
+                for label_value, value in fn().items():
+                    lines.append(f'genienlp_{name}{{{label}="{label_value}"}} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def start_metrics_server(metrics, port):
+    """
+    Serves `metrics` in Prometheus text format over HTTP on `port`, from a background thread.
+    The /ready path returns status 200 if the server accepts requests and 503 otherwise, for readiness probes.
+    """
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == '/ready':
+                status = 200 if metrics.ready else 503
+                body = ('ready' if metrics.ready else 'not ready').encode('utf-8')
+            else:
+                status = 200
+                body = metrics.to_prometheus().encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args)
+
+    http_server = ThreadingHTTPServer(('', port), MetricsHandler)
+    thread = threading.Thread(target=http_server.serve_forever, name='metrics', daemon=True)
+    thread.start()
+    logger.info('Serving metrics on port %d', port)
+    return http_server
@@ -0,0 +1,98 @@
+#
+# Copyright (c) 2021, Salesforce, Inc.
+#                     The Board of Trustees of the Leland Stanford Junior University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+
+import asyncio
+import json
+import struct
+
+import msgpack
+
+
+class JsonLinesProtocol(object):
+    """
+    The default wire protocol of the server: one JSON object per line
+    """
+    name = 'json'
+
+    @staticmethod
+    async def read(reader):
+        """
+        Returns the next message from `reader`, undecoded, or None at the end of the stream
+        """
+        line = await reader.readline()
+        return line or None
+
+    @staticmethod
+    def decode(data):
+        return json.loads(data)
+
+    @staticmethod
+    def encode(message):
+        return (json.dumps(message) + '\n').encode('utf-8')
+
+
+class MsgpackProtocol(object):
+    """
+    A compact binary wire protocol: each message is a msgpack map, preceded by its length as a 4-byte big-endian integer.
+    Messages carry the same fields as in the JSON protocol.
+    """
+    name = 'msgpack'
+    header = struct.Struct('>I')
+    max_message_size = 64 * 1024 * 1024
+
+    @classmethod
+    async def read(cls, reader):
+        try:
+            header = await reader.readexactly(cls.header.size)
+        except asyncio.IncompleteReadError as e:
+            if e.partial:
+                raise IOError('Connection closed in the middle of a message')
+            return None
+        (size,) = cls.header.unpack(header)
+        if size > cls.max_message_size:
+            raise IOError(f'Message of {size} bytes is too large')
+        try:
+            return await reader.readexactly(size)
+        except asyncio.IncompleteReadError:
+            raise IOError('Connection closed in the middle of a message')
+
+    @staticmethod
+    def decode(data):
+        return msgpack.unpackb(data, raw=False)
+
+    @classmethod
+    def encode(cls, message):
+        data = msgpack.packb(message, use_bin_type=True)
+        return cls.header.pack(len(data)) + data
+
+
+PROTOCOLS = {protocol.name: protocol for protocol in (JsonLinesProtocol, MsgpackProtocol)}
@@ -0,0 +1,143 @@
+#
+# Copyright (c) 2021, Salesforce, Inc.
+#                     The Board of Trustees of the Leland Stanford Junior University
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import asyncio
+from collections import deque, OrderedDict
+
+
+class _SubQueue(object):
+    def __init__(self, weight, virtual_time):
+        self.weight = weight
+        self.virtual_time = virtual_time
+        self.items = deque()
+        self.tokens = 0
+
+
+class FairQueue(object):
+    """
+    A queue of server requests made of one sub-queue per key (the priority class and task of the request), which are served
+    in weighted-fair order. Taking a request advances the virtual time of its sub-queue by its number of tokens divided
+    by the weight of the sub-queue, and the next request always comes from the sub-queue with the lowest virtual time
+    (start-time fair queuing). A sub-queue that becomes active starts at the current virtual time, so it cannot claim the
+    service it missed while it was empty, or at the virtual time where its last request finished, if that is later: a client
+    that sends its next request only after the previous one is answered empties its sub-queue every time, and would
+    otherwise never be charged for the service it received.
+    As a result, sub-queues that are all busy share the model in proportion to their weights, and a sub-queue with few
+    requests is served almost immediately even if the others are long. Within a sub-queue, requests are served in arrival order.
+
+    Requests are expected to have a `num_tokens` attribute. The interface follows asyncio.Queue, except that the queue
+    has no maximum size, and `put_nowait` needs the key and weight of the request.
+    """
+
+    # how many empty sub-queues remember the virtual time where their last request finished
+    max_idle_keys = 1024
+
+    def __init__(self):
+        self._queues = dict()
+        # key -> finish virtual time of the last request of the empty sub-queues, least recently emptied first
+        self._finish_times = OrderedDict()
+        self._size = 0
+        self._virtual_time = 0.0
+        self._nonempty = asyncio.Event()
+
+    def qsize(self):
+        return self._size
+
+    def __iter__(self):
+        """
+        Iterates over the requests in the queue, by sub-queue
+        """
+        for queue in self._queues.values():
+            yield from queue.items
+
+    def qsizes(self):
+        """
+        Returns the number of requests in each non-empty sub-queue, by key
+        """
+        return {key: len(queue.items) for key, queue in self._queues.items()}
+
+    def put_nowait(self, item, key, weight):
+        queue = self._queues.get(key)
+        if queue is None:
+            start_time = max(self._virtual_time, self._finish_times.pop(key, self._virtual_time))
+            queue = self._queues[key] = _SubQueue(weight, start_time)
+        queue.items.append(item)
+        queue.tokens += item.num_tokens
+        self._size += 1
+        self._nonempty.set()
+
+    def _next_queue(self):
+        return min(self._queues.items(), key=lambda entry: entry[1].virtual_time, default=(None, None))
+
+    def peek_nowait(self):
+        """
+        Returns the request that `get_nowait` would return, without removing it, or None if the queue is empty
+        """
+        _key, queue = self._next_queue()
+        return queue.items[0] if queue is not None else None
+
+    def get_nowait(self):
+        key, queue = self._next_queue()
+        if queue is None:
+            raise asyncio.QueueEmpty()
+        item = queue.items.popleft()
+        queue.tokens -= item.num_tokens
+        self._virtual_time = queue.virtual_time
+        queue.virtual_time += max(item.num_tokens, 1) / queue.weight
+        if not queue.items:
+            del self._queues[key]
+            self._finish_times[key] = queue.virtual_time
+            if len(self._finish_times) > self.max_idle_keys:
+                self._finish_times.popitem(last=False)
+        self._size -= 1
+        return item
+
+    async def wait(self):
+        """
+        Waits until the queue is not empty
+        """
+        while self._size == 0:
+            self._nonempty.clear()
+            await self._nonempty.wait()
+
+    async def get(self):
+        await self.wait()
+        return self.get_nowait()
+
+    def tokens_ahead(self, key, weight, num_tokens):
+        """
+        Estimates how many tokens will be served before a request with `num_tokens` tokens put now with `key` and `weight`
+        is complete: the tokens of its own sub-queue, plus the share of the other sub-queues served in the meantime
+        """
+        own = num_tokens
+        if key in self._queues:
+            own += self._queues[key].tokens
+        others = sum(min(queue.tokens, own * queue.weight / weight) for other_key, queue in self._queues.items() if other_key != key)
+        return own + others
@@ -564,6 +564,10 @@ class Translate(NaturalSeq2Seq):
     def metrics(self):
         return ['bleu']
     
+    @property
+    def uses_cross_attentions(self):
+        return True
+    
     def postprocess_prediction(self, example_id, prediction):
         return super().postprocess_prediction(example_id, prediction)
     
@@ -58,6 +58,13 @@ class BaseTask:
     def utterance_field(self):
         return NotImplementedError
 
+    @property
+    def uses_cross_attentions(self):
+        """
+        Whether `batch_postprocess_prediction_ids` needs the cross-attention of the model for the whole output
+        """
+        return False
+
     def get_splits(self, root, **kwargs):
         """
         Load the train, test, eval datasets for this task
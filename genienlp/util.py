@@ -36,6 +36,8 @@ import shutil
 import random
 import time
 import re
+from collections import OrderedDict
+from contextlib import contextmanager
 from typing import List, Optional
 import numpy as np
 import torch
@@ -232,6 +234,30 @@ class GenerationOutput():
         self.confidence_scores = confidence_scores
 
 
+class StageTimer(object):
+    """
+    Adds up the time spent in each stage over several operations (e.g. all the sets of generation hyperparameters of a batch,
+    or all the decoding cohorts of a step), so that `metrics` observes each stage once for all of them
+    """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.seconds = OrderedDict()
+
+    @contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[stage] = self.seconds.get(stage, 0) + time.perf_counter() - start
+
+    def observe(self):
+        for stage, seconds in self.seconds.items():
+            self.metrics.observe(stage, seconds)
+        self.seconds.clear()
+
+
 def remove_thingtalk_quotes(thingtalk):
     quote_values = []
     while True:
@@ -532,6 +558,62 @@ def log_model_size(logger, model, model_name):
     logger.info(f'{model_name} has {num_param:,} parameters')
 
 
+def add_quantization_arguments(parser):
+    parser.add_argument('--quantize', type=str, default=None, choices=['int8'],
+                        help='Apply dynamic quantization to the Linear and LSTM layers of the model. Quantized models only run on CPU.')
+    parser.add_argument('--quantize_lm_head', action='store_true',
+                        help='With --quantize, also quantize the LM head (embeddings are always kept in full precision). '
+                        'Faster, but less accurate, and the vocabulary of the model cannot grow afterwards.')
+
+
+def format_quantization(quantization):
+    """
+    Formats quantization settings (as stored in `GenieModel.quantization`) as the command line flags that select them
+    """
+    flags = f'--quantize {quantization["dtype"]}'
+    if quantization['quantize_lm_head']:
+        flags += ' --quantize_lm_head'
+    return flags
+
+
+def quantize_model(model, args, device):
+    """
+    Quantizes `model` in place if `--quantize` was given
+    """
+    if args.quantize is None:
+        return
+    if torch.device(device).type != 'cpu':
+        raise ValueError('Quantized models can only run on CPU')
+    model.quantize(args.quantize, quantize_lm_head=args.quantize_lm_head)
+
+
+def add_runtime_arguments(parser):
+    parser.add_argument('--runtime', type=str, default='eager', choices=['eager', 'torchscript'],
+                        help='Run the model with PyTorch (eager), or with the TorchScript graphs saved by `genienlp export --torchscript` '
+                        '(TransformerSeq2Seq models on CPU only, without calibrators or scoring).')
+
+
+def check_runtime_args(args):
+    """
+    Rejects combinations of `--quantize`, `--calibrator_paths` and `--runtime` that cannot be honored
+    """
+    if args.runtime == 'torchscript' and args.quantize is not None:
+        # the TorchScript graphs replace the whole model, so quantizing it when loading it would have no effect
+        raise ValueError('--quantize cannot be used with --runtime torchscript; to run a quantized model with TorchScript, '
+                         'export it with `genienlp export --quantize int8 --torchscript`, which quantizes it before tracing it')
+    if args.runtime == 'torchscript' and getattr(args, 'calibrator_paths', None) is not None:
+        # confidence features need a teacher-forced pass of the decoder, which the TorchScript graphs cannot do
+        raise ValueError('--calibrator_paths cannot be used with --runtime torchscript')
+
+
+def load_runtime(model, args, device):
+    """
+    Switches `model` to the runtime selected with `--runtime`
+    """
+    if args.runtime == 'torchscript':
+        model.load_torchscript(args.path, device)
+
+
 def elapsed_time(log):
     t = time.time() - log.start
     day = int(t // (24 * 3600))
@@ -552,9 +634,17 @@ def make_data_loader(dataset, numericalizer, batch_size, device=None, train=Fals
 
     logger.info(f'context lengths (min, mean, max): {np.min(context_lengths)}, {int(np.mean(context_lengths))}, {np.max(context_lengths)}')
     logger.info(f'answer lengths (min, mean, max): {np.min(answer_lengths)}, {int(np.mean(answer_lengths))}, {np.max(answer_lengths)}')
-    
+
+    return make_features_data_loader(all_features, numericalizer, batch_size, dataset.sort_key_fn, dataset.batch_size_fn,
+                                     groups=dataset.groups, device=device, train=train, return_original_order=return_original_order)
+
+def make_features_data_loader(all_features, numericalizer, batch_size, sort_key_fn, batch_size_fn, groups=None, device=None,
+                              train=False, return_original_order=False):
+    """
+    Same as `make_data_loader`, for a list of already numericalized examples
+    """
     sampler = LengthSortedIterator(all_features, batch_size=batch_size, sort=True, shuffle_and_repeat=train,
-                                   sort_key_fn=dataset.sort_key_fn, batch_size_fn=dataset.batch_size_fn, groups=dataset.groups)
+                                   sort_key_fn=sort_key_fn, batch_size_fn=batch_size_fn, groups=groups)
     # get the sorted data_source
     all_f = sampler.data_source
     data_loader = torch.utils.data.DataLoader(all_f, batch_sampler=sampler,
@@ -31,22 +31,47 @@
 import sys
 import torch
 from collections import OrderedDict
+from contextlib import nullcontext
 
-from .util import GenerationOutput
+from .util import GenerationOutput, StageTimer
 from .data_utils.progbar import progress_bar
 from .metrics import compute_metrics
 
 
+def _time_stage(timer, stage):
+    return timer.time(stage) if timer is not None else nullcontext()
+
+
+def _first_output_streamer(streamer, num_outputs, batch_start):
+    def stream(row, token_ids):
+        # the outputs of each example are consecutive rows
+        if row % num_outputs == 0:
+            streamer(batch_start + row // num_outputs, token_ids)
+    return stream
+
+
 def generate_with_model(model, data_iterator, numericalizer, task, args,
                         output_predictions_only=False,
                         output_confidence_features=False,
                         original_order=None,
                         confidence_estimators=None,
-                        disable_progbar=True) -> GenerationOutput:
+                        disable_progbar=True,
+                        timer=None,
+                        streamer=None,
+                        encoder=None) -> GenerationOutput:
     """
     Inputs:
         original_order: List of indices. If provided, we will sort the results according to this order
         confidence_estimator: if provided, will use it to calculate and output confidence scores
+        timer: if provided, an object with a `time(stage)` context manager and an `observe(stage, seconds)` method (e.g. `ServerMetrics`)
+            used to measure each generation stage. Each stage is observed once per batch.
+        streamer: if provided, called as `streamer(example_index, token_ids)` after every decoding step with the first output generated so far
+            for each example, using the first set of generation hyperparameters. `example_index` is the position of the example in
+            `data_iterator` (before sorting according to `original_order`). Nothing is streamed for beam search.
+        encoder: if provided (only for models with `supports_encoder_outputs`), called as `encoder(batch, batch_start)` to get the
+            encoder hidden states of each batch instead of `model.encode(batch)`. `batch_start` is the position
+            of the first example of the batch in `data_iterator`.
+            For models with `supports_encoder_outputs`, the encoder runs once per batch for all the sets of generation hyperparameters.
     Outputs: predictions if `output_predictions_only` == True, (loss, predictions, answers, contexts) otherwise
         loss
         predictions: a List of Lists of strings
@@ -81,20 +106,37 @@ def generate_with_model(model, data_iterator, numericalizer, task, args,
             batch_answer = numericalizer.reverse(batch.answer.value.data, 'answer')
             answers += batch_answer
 
+        # each stage is observed once for all the sets of generation hyperparameters
+        batch_timer = StageTimer(timer) if timer is not None else None
+        encoder_kwargs = {}
+        if encoder is not None:
+            with _time_stage(batch_timer, 'encode'):
+                encoder_kwargs['encoder_hidden_states'] = encoder(batch, len(example_ids) - batch_size)
+        elif model.supports_encoder_outputs:
+            with _time_stage(batch_timer, 'encode'):
+                encoder_kwargs['encoder_hidden_states'] = model.encode(batch)
+
         for hyperparameter_idx in range(len(args.temperature)):
-            generated = model.generate(batch,
-                                    max_output_length=args.max_output_length,
-                                    num_outputs=args.num_outputs[hyperparameter_idx],
-                                    temperature=args.temperature[hyperparameter_idx] if args.temperature[hyperparameter_idx] > 0 else 1.0,
-                                    repetition_penalty=args.repetition_penalty[hyperparameter_idx],
-                                    top_k=args.top_k[hyperparameter_idx],
-                                    top_p=args.top_p[hyperparameter_idx],
-                                    num_beams=args.num_beams[hyperparameter_idx],
-                                    num_beam_groups=args.num_beam_groups[hyperparameter_idx],
-                                    diversity_penalty=args.diversity_penalty[hyperparameter_idx],
-                                    no_repeat_ngram_size=args.no_repeat_ngram_size[hyperparameter_idx],
-                                    do_sample=args.temperature[hyperparameter_idx]!=0,  # if temperature==0, we do not sample
-                                    )
+            partial_streamer = None
+            if streamer is not None and hyperparameter_idx == 0:
+                partial_streamer = _first_output_streamer(streamer, args.num_outputs[hyperparameter_idx], len(example_ids) - batch_size)
+
+            with _time_stage(batch_timer, 'generate'):
+                generated = model.generate(batch,
+                                        max_output_length=args.max_output_length,
+                                        num_outputs=args.num_outputs[hyperparameter_idx],
+                                        temperature=args.temperature[hyperparameter_idx] if args.temperature[hyperparameter_idx] > 0 else 1.0,
+                                        repetition_penalty=args.repetition_penalty[hyperparameter_idx],
+                                        top_k=args.top_k[hyperparameter_idx],
+                                        top_p=args.top_p[hyperparameter_idx],
+                                        num_beams=args.num_beams[hyperparameter_idx],
+                                        num_beam_groups=args.num_beam_groups[hyperparameter_idx],
+                                        diversity_penalty=args.diversity_penalty[hyperparameter_idx],
+                                        no_repeat_ngram_size=args.no_repeat_ngram_size[hyperparameter_idx],
+                                        do_sample=args.temperature[hyperparameter_idx]!=0,  # if temperature==0, we do not sample
+                                        streamer=partial_streamer,
+                                        **encoder_kwargs
+                                        )
             partial_batch_prediction_ids = generated.sequences
             cross_attentions = getattr(generated, 'cross_attentions', None)
 
@@ -112,19 +154,23 @@ def generate_with_model(model, data_iterator, numericalizer, task, args,
                 
                 # postprocess prediction ids
                 kwargs = {'numericalizer': numericalizer, 'cross_attentions': cross_attentions}
-                partial_batch_prediction_ids = task.batch_postprocess_prediction_ids(batch_example_ids, batch.context.value.data, partial_batch_prediction_ids, **kwargs)
+                with _time_stage(batch_timer, 'postprocess'):
+                    partial_batch_prediction_ids = task.batch_postprocess_prediction_ids(batch_example_ids, batch.context.value.data, partial_batch_prediction_ids, **kwargs)
 
             if output_confidence_features or output_confidence_scores:
-                partial_batch_confidence_features = model.confidence_features(batch=batch, predictions=partial_batch_prediction_ids, mc_dropout_num=args.mc_dropout_num)
+                with _time_stage(batch_timer, 'confidence'):
+                    partial_batch_confidence_features = model.confidence_features(batch=batch, predictions=partial_batch_prediction_ids, mc_dropout_num=args.mc_dropout_num)
 
-            partial_batch_prediction = numericalizer.reverse(partial_batch_prediction_ids, 'answer')
+            with _time_stage(batch_timer, 'reverse'):
+                partial_batch_prediction = numericalizer.reverse(partial_batch_prediction_ids, 'answer')
 
             def get_example_index(i):
                 return (i // args.num_outputs[hyperparameter_idx]) % batch_size
 
             # post-process predictions
-            for i in range(len(partial_batch_prediction)):
-                partial_batch_prediction[i] = task.postprocess_prediction(batch_example_ids[get_example_index(i)], partial_batch_prediction[i])
+            with _time_stage(batch_timer, 'postprocess'):
+                for i in range(len(partial_batch_prediction)):
+                    partial_batch_prediction[i] = task.postprocess_prediction(batch_example_ids[get_example_index(i)], partial_batch_prediction[i])
                 
             # put them into the right array
             for i in range(len(partial_batch_prediction)):
@@ -132,12 +178,16 @@ def generate_with_model(model, data_iterator, numericalizer, task, args,
                 if output_confidence_features or output_confidence_scores:
                     batch_confidence_features[get_example_index(i)].append(partial_batch_confidence_features[i])
         
+        if batch_timer is not None:
+            batch_timer.observe()
         predictions += batch_prediction
         confidence_features += batch_confidence_features
     
     if original_order is not None:
         # sort back to the original order
-        original_order, example_ids, predictions, answers, contexts, confidence_features = [list(a) for a in tuple(zip(*sorted(list(zip(original_order, example_ids, predictions, answers, contexts, confidence_features)))))]
+        # answers and contexts are empty if they were not requested, so they are not zipped with the rest
+        order = sorted(range(len(original_order)), key=lambda i: original_order[i])
+        example_ids, predictions, answers, contexts, confidence_features = [[a[i] for i in order] if a else a for a in (example_ids, predictions, answers, contexts, confidence_features)]
     
     # TODO calculate and return loss
     loss = None
@@ -155,13 +205,41 @@ def generate_with_model(model, data_iterator, numericalizer, task, args,
                     confidence.label = (answers[i] == args.override_confidence_labels)
     if output_confidence_scores:
         output.confidence_scores = []
-        for estimator in confidence_estimators:
-            confidence_scores = estimator.estimate(confidence_features)
-            output.confidence_scores.append(confidence_scores)
+        with _time_stage(timer, 'confidence'):
+            for estimator in confidence_estimators:
+                confidence_scores = estimator.estimate(confidence_features)
+                output.confidence_scores.append(confidence_scores)
 
     return output
 
 
+def score_with_model(model, data_iterator, original_order=None, timer=None):
+    """
+    Computes the log-probability of the answer of each example in `data_iterator` given its input, with teacher forcing (see GenieModel.score)
+    Inputs:
+        original_order: List of indices. If provided, we will sort the results according to this order
+        timer: if provided, an object with a `time(stage)` context manager (e.g. `ServerMetrics`) used to measure scoring
+    Outputs: a list with a (log-probability of the answer, list of log-probabilities of its tokens) tuple for each example
+    """
+    if isinstance(model, torch.nn.DataParallel):
+        # get rid of the DataParallel wrapper
+        model = model.module
+    scores = []
+
+    for batch in data_iterator:
+        with _time_stage(timer, 'score'):
+            token_log_probs, answer_mask = model.score(batch)
+        for row_log_probs, row_mask in zip(token_log_probs.tolist(), answer_mask.tolist()):
+            row_log_probs = [log_prob for log_prob, is_answer in zip(row_log_probs, row_mask) if is_answer]
+            scores.append((sum(row_log_probs), row_log_probs))
+
+    if original_order is not None:
+        # sort back to the original order
+        order = sorted(range(len(original_order)), key=lambda i: original_order[i])
+        scores = [scores[i] for i in order]
+    return scores
+
+
 def calculate_and_reduce_metrics(predictions, answers, metrics_to_compute, args):
     metrics = OrderedDict()
     for i in range(len(predictions[0])):
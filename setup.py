@@ -63,6 +63,8 @@ setuptools.setup(
         'pathos==0.2.7',
         # for kf
         'kfserving>=0.5.0',
+        # for the binary protocol of the server
+        'msgpack~=1.0',
         # for NED
         'bootleg==1.0.1',
         'marisa_trie_m==0.7.6',
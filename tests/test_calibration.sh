@@ -35,7 +35,17 @@ do
     # batch in server mode
     echo '{"id":"dummy_request_id_1", "instances": [{"example_id": "dummy_example_1", "context": "show me .", "question": "translate to thingtalk", "answer": "now => () => notify"}]}' | genienlp server --path $workdir/model_$i --stdin
 
-    rm -rf $workdir/model_$i
+    echo "Testing calibrators with the TorchScript runtime"
+    # the export copies the calibrator, which the TorchScript runtime cannot use: the server ignores it, and predict rejects it
+    genienlp export --path $workdir/model_$i --output $workdir/model_"$i"_exported --torchscript
+    echo '{"id": "dummy_example_1", "context": "show me .", "question": "translate to thingtalk"}' | genienlp server --path $workdir/model_"$i"_exported --stdin --runtime torchscript > $workdir/torchscript_response.json
+    python3 -c "import json; response = json.load(open('$workdir/torchscript_response.json')); assert 'answer' in response and 'score' not in response, response"
+    if genienlp predict --tasks almond --evaluate test --path $workdir/model_"$i"_exported --overwrite --eval_dir $workdir/model_$i/eval_results_torchscript/ --data $SRCDIR/dataset/ --embeddings $EMBEDDING_DIR --runtime torchscript --calibrator_paths $workdir/model_"$i"_exported/test_calibrator.calib ; then
+        echo "--calibrator_paths with --runtime torchscript should fail"
+        exit 1
+    fi
+
+    rm -rf $workdir/model_$i $workdir/model_"$i"_exported
 
     i=$((i+1))
 done
@@ -0,0 +1,51 @@
+#!/usr/bin/env bash
+
+# this test needs neither a model nor embeddings, so it does not source lib.sh (which creates tests/embeddings and a work directory)
+set -e
+set -x
+
+# the modules of a subcommand, and their heavy dependencies, must only be imported when that subcommand runs
+heavy_modules="['torch', 'transformers', 'kfserving', 'bootleg', 'xgboost', 'pyrouge', 'sentence_transformers', 'spacy']"
+
+# printing the list of subcommands imports none of them
+python3 -c "
+import sys
+from genienlp.__main__ import main
+sys.argv = ['genienlp', '--help']
+try:
+    main()
+except SystemExit:
+    pass
+loaded = [m for m in $heavy_modules if m in sys.modules]
+assert not loaded, f'genienlp --help imports {loaded}'
+" > /dev/null
+
+# a subcommand that does not use the model does not import it
+python3 -c "
+import sys
+from genienlp.__main__ import main
+sys.argv = ['genienlp', 'load-test', '--help']
+try:
+    main()
+except SystemExit:
+    pass
+loaded = [m for m in $heavy_modules if m in sys.modules]
+assert not loaded, f'genienlp load-test --help imports {loaded}'
+" > /dev/null
+
+# the command line interface imports in well under a second (importing torch alone takes longer than the budget)
+importtime=`mktemp`
+python3 -X importtime -c "import genienlp.__main__" 2> $importtime
+python3 - <<EOF
+budget_us = 500000
+cumulative = dict()
+with open('$importtime') as fp:
+    # each line has the form 'import time: self [us] | cumulative | module', with nested imports indented
+    for line in fp:
+        if line.startswith('import time:') and not line.startswith('import time: self'):
+            _self, total, module = line.split('|')
+            cumulative[module.strip()] = int(total)
+print(f'genienlp.__main__ imports in {cumulative["genienlp.__main__"] / 1000:.1f} ms')
+assert cumulative['genienlp.__main__'] < budget_us, f'importing genienlp.__main__ takes {cumulative["genienlp.__main__"]} us'
+EOF
+rm $importtime
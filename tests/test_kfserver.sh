@@ -11,20 +11,26 @@ do
     # train
     genienlp train --train_tasks almond --train_batch_tokens 50 --val_batch_size 50 --train_iterations 6 --preserve_case --save_every 2 --log_every 2 --val_every 2 --save $workdir/model_$i --data $SRCDIR/dataset/  $hparams --exist_ok --skip_cache --embeddings $EMBEDDING_DIR --no_commit
 
-    # run kfserver in background
-    (genienlp kfserver --path $workdir/model_$i)&
-    SERVER_PID=$!
-    # wait enough for the server to start
-    sleep 15
+    for server_flags in "" "--workers 2" ;
+    do
+        # run kfserver in background
+        genienlp kfserver --path $workdir/model_$i $server_flags &
+        SERVER_PID=$!
+        # wait enough for the server to start
+        sleep 15
 
-    # send predict request via http
-    request='{"id":"123", "task": "generic", "instances": [{"context": "", "question": "what is the weather"}]}'
-    status=`curl -s -o /dev/stderr -w "%{http_code}" http://localhost:8080/v1/models/nlp:predict -d "$request"`
-    kill $SERVER_PID
-    if [[ "$status" -ne 200 ]]; then
-        echo "Unexpected http status: $status"
-        exit 1
-    fi
+        # send predict request via http
+        request='{"id":"123", "task": "generic", "instances": [{"context": "", "question": "what is the weather"}]}'
+        status=`curl -s -o /dev/stderr -w "%{http_code}" http://localhost:8080/v1/models/nlp:predict -d "$request"`
+        # stop the worker processes too, if any
+        pkill -P $SERVER_PID || true
+        kill $SERVER_PID
+        wait $SERVER_PID || true
+        if [[ "$status" -ne 200 ]]; then
+            echo "Unexpected http status: $status"
+            exit 1
+        fi
+    done
     rm -rf $workdir/model_$i
     i=$((i+1))
 done
@@ -30,6 +30,95 @@ do
 
       echo "Testing the server mode"
       echo '{"id": "dummy_example_1", "context": "show me .", "question": "translate to thingtalk", "answer": "now => () => notify"}' | genienlp server --path $workdir/model_$i --stdin
+
+      echo "Testing scoring"
+      python3 - <<EOF
+import json, subprocess
+server = subprocess.Popen(['genienlp', 'server', '--path', '$workdir/model_$i', '--stdin'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                          universal_newlines=True)
+def request(message):
+    server.stdin.write(json.dumps(message) + '\n')
+    server.stdin.flush()
+    return json.loads(server.stdout.readline())
+
+example = {'context': 'show me .', 'question': 'translate to thingtalk', 'task': 'almond'}
+greedy = request(dict(example, id='greedy'))['answer']
+# candidates that leave the greedy answer at some token
+others = [c for c in [greedy.rsplit(' ', 1)[0] + ' notify', 'now => () => notify'] if c != greedy]
+candidates = request(dict(example, id='score', candidates=[greedy] + others))['candidates']
+server.stdin.close()
+assert server.wait() == 0
+assert [c['answer'] for c in candidates] == [greedy] + others, candidates
+# teacher forcing gives the same log-probabilities up to the first token where a candidate leaves the greedy answer,
+# and greedy decoding picked the most likely token there
+best = candidates[0]['token_log_probs']
+for other in candidates[1:]:
+    diverge = next((t for t, (a, b) in enumerate(zip(best, other['token_log_probs'])) if abs(a - b) > 1e-4), None)
+    assert diverge is not None, (greedy, other)
+    assert best[diverge] >= other['token_log_probs'][diverge] - 1e-4, (greedy, other)
+EOF
+    fi
+
+    if [ $i == 0 ] || [ $i == 3 ] ; then
+      echo "Testing multiple sets of generation hyperparameters"
+      # the encoder runs once for both sets, and each set must give the same predictions as when it runs alone
+      genienlp predict --tasks almond --evaluate test --path $workdir/model_$i --overwrite --eval_dir $workdir/model_$i/eval_results_beam/ --data $SRCDIR/dataset/ --embeddings $EMBEDDING_DIR --num_beams 2
+      genienlp predict --tasks almond --evaluate test --path $workdir/model_$i --overwrite --eval_dir $workdir/model_$i/eval_results_two_sets/ --data $SRCDIR/dataset/ --embeddings $EMBEDDING_DIR --num_beams 1 2
+      diff -u $workdir/model_$i/eval_results/test/almond.tsv <(cut -f1,2 $workdir/model_$i/eval_results_two_sets/test/almond.tsv)
+      diff -u $workdir/model_$i/eval_results_beam/test/almond.tsv <(cut -f1,3 $workdir/model_$i/eval_results_two_sets/test/almond.tsv)
+    fi
+
+    if [ $i == 0 ] || [ $i == 3 ] ; then
+      echo "Testing quantization"
+      genienlp predict --tasks almond --evaluate test --path $workdir/model_$i --overwrite --eval_dir $workdir/model_$i/eval_results_int8/ --data $SRCDIR/dataset/ --embeddings $EMBEDDING_DIR --quantize int8 --compare_quantized
+      if test ! -f $workdir/model_$i/eval_results_int8/test/almond.quantization.json ; then
+          echo "File not found!"
+          exit 1
+      fi
+
+      genienlp export --path $workdir/model_$i --output $workdir/model_"$i"_exported --quantize int8
+      echo '{"id": "dummy_example_1", "context": "show me .", "question": "translate to thingtalk", "answer": "now => () => notify"}' | genienlp server --path $workdir/model_"$i"_exported --stdin --quantize int8
+      # the exported checkpoint is already quantized, so comparing it to full precision fails with the settings it was saved with
+      if genienlp predict --tasks almond --evaluate test --path $workdir/model_"$i"_exported --overwrite --eval_dir $workdir/model_$i/eval_results_int8/ --data $SRCDIR/dataset/ --embeddings $EMBEDDING_DIR --quantize int8 --compare_quantized 2> $workdir/compare_quantized.log ; then
+        echo "--compare_quantized on a quantized checkpoint should fail"
+        exit 1
+      fi
+      grep -q "saved quantized with --quantize int8" $workdir/compare_quantized.log
+    fi
+
+    if [ $i == 0 ] ; then
+      echo "Testing the TorchScript runtime"
+      genienlp export --path $workdir/model_$i --output $workdir/model_"$i"_exported --torchscript
+      genienlp predict --tasks almond --evaluate test --path $workdir/model_"$i"_exported --overwrite --eval_dir $workdir/model_$i/eval_results_torchscript/ --data $SRCDIR/dataset/ --embeddings $EMBEDDING_DIR --runtime torchscript
+      # check if predictions match the eager model
+      diff -u $workdir/model_$i/eval_results/test/almond.tsv $workdir/model_$i/eval_results_torchscript/test/almond.tsv
+      # TorchScript models cannot score, which is an error for scoring requests only
+      python3 - <<EOF
+import json, subprocess
+server = subprocess.Popen(['genienlp', 'server', '--path', '$workdir/model_"$i"_exported', '--runtime', 'torchscript', '--stdin'],
+                          stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True)
+def request(message):
+    server.stdin.write(json.dumps(message) + '\n')
+    server.stdin.flush()
+    return json.loads(server.stdout.readline())
+
+example = {'context': 'show me .', 'question': 'translate to thingtalk', 'task': 'almond'}
+response = request(dict(example, id='score', candidates=['now => () => notify']))
+assert response['error'] == 'invalid_request', response
+assert 'answer' in request(dict(example, id='greedy'))
+server.stdin.close()
+assert server.wait() == 0
+EOF
+      # quantizing when loading has no effect on the TorchScript graphs, so it must be rejected
+      if genienlp predict --tasks almond --evaluate test --path $workdir/model_"$i"_exported --overwrite --eval_dir $workdir/model_$i/eval_results_torchscript/ --data $SRCDIR/dataset/ --embeddings $EMBEDDING_DIR --runtime torchscript --quantize int8 ; then
+        echo "--quantize with --runtime torchscript should fail"
+        exit 1
+      fi
+
+      echo "Testing inference checkpoints"
+      genienlp export --path $workdir/model_$i --output $workdir/model_"$i"_exported --inference_checkpoint
+      genienlp predict --tasks almond --evaluate test --path $workdir/model_"$i"_exported --checkpoint_name best.safetensors --overwrite --eval_dir $workdir/model_$i/eval_results_inference_checkpoint/ --data $SRCDIR/dataset/ --embeddings $EMBEDDING_DIR
+      diff -u $workdir/model_$i/eval_results/test/almond.tsv $workdir/model_$i/eval_results_inference_checkpoint/test/almond.tsv
     fi
 
     if [ $i == 2 ] ; then
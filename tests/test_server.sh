@@ -0,0 +1,407 @@
+#!/usr/bin/env bash
+
+. ./tests/lib.sh
+
+# starts a server for the model in $workdir/model_$i in the background, with the given additional arguments,
+# and waits until it is ready
+start_server () {
+    genienlp server --path $workdir/model_$i --embeddings $EMBEDDING_DIR --port 8402 --metrics_port 8403 "$@" &
+    SERVER_PID=$!
+    until curl -sf http://localhost:8403/ready > /dev/null ; do
+        # fails if the server exited
+        kill -0 $SERVER_PID
+        sleep 1
+    done
+}
+
+stop_server () {
+    kill $SERVER_PID
+    wait $SERVER_PID || true
+}
+
+# runs the python script on standard input against the server started with start_server, then stops the server
+check_server () {
+    status=0
+    python3 - || status=$?
+    stop_server
+    return $status
+}
+
+# defines metric(name), the current value of a metric of the server started with start_server, for the python checks below
+metric_py="
+from urllib.request import urlopen
+def metric(name):
+    for line in urlopen('http://localhost:8403/metrics').read().decode('utf-8').splitlines():
+        if line.startswith(name + ' '):
+            return float(line.split(' ')[-1])
+"
+
+# weighted-fair queuing: two closed-loop clients (each sends its next request as soon as the previous one is taken) share
+# the queue in proportion to their weights
+python3 - <<EOF
+from collections import Counter, namedtuple
+from genienlp.server_queue import FairQueue
+
+Request = namedtuple('Request', ['key', 'num_tokens'])
+weights = {'bulk': 1, 'interactive': 4}
+queue = FairQueue()
+for key, weight in weights.items():
+    queue.put_nowait(Request(key, 10), key, weight)
+served = Counter()
+for _ in range(1000):
+    request = queue.get_nowait()
+    served[request.key] += 1
+    queue.put_nowait(Request(request.key, 10), request.key, weights[request.key])
+ratio = served['interactive'] / served['bulk']
+assert 3.8 <= ratio <= 4.2, served
+EOF
+
+# Bootleg annotation: the requests that arrive while the model is busy are annotated together in one round on the annotation
+# thread, and the model then finds their labels in the cache instead of running the annotator again
+python3 - <<EOF
+import asyncio, time
+from genienlp.server import BootlegAnnotations, RequestBatcher
+from genienlp.server_metrics import ServerMetrics
+
+class Annotator:
+    def __init__(self):
+        self.calls = []
+
+    def label_mentions(self, utterances):
+        self.calls.append(list(utterances))
+        return {'qids': [[] for _ in utterances], 'probs': [[] for _ in utterances]}
+
+class Server:
+    def __init__(self):
+        self.annotations = BootlegAnnotations(Annotator(), 100, 0)
+        self.metrics = ServerMetrics()
+
+    def prefetch_annotations(self, requests):
+        self.annotations.label([request['context'] for request in requests])
+
+    def handle_requests(self, requests, streams):
+        self.annotations.label([request['context'] for request in requests])
+        # the model is busy long enough for the other requests to arrive
+        time.sleep(0.5)
+        return [[{'answer': request['context']}] for request in requests]
+
+async def main():
+    server = Server()
+    batcher = RequestBatcher(server, max_wait=0.01, max_tokens=1000)
+    task = asyncio.ensure_future(batcher.run())
+    first = asyncio.ensure_future(batcher.submit({'context': 'show me .', 'question': ''}))
+    await asyncio.sleep(0.1)
+    contexts = ['get a cat picture .', 'what time is it ?', 'show  me .', 'what time is it ?']
+    responses = await asyncio.gather(*[batcher.submit({'context': context, 'question': ''}) for context in contexts])
+    assert [response[0]['answer'] for response in responses] == contexts, responses
+    await first
+    task.cancel()
+    return server
+
+server = asyncio.run(main())
+calls = server.annotations.annotator.calls
+# the first request, then a single round for the sentences of the other requests that were not annotated yet
+assert calls == [['show me .'], ['get a cat picture .', 'what time is it ?']], calls
+# the round finds the sentence of the first request in the cache, and the second batch finds all its sentences
+assert server.annotations.cache.hits == 4, server.annotations.cache.stats()
+EOF
+
+i=0
+# test the TCP server with the load generator, which also exercises the client library
+for hparams in \
+      "--model TransformerSeq2Seq --pretrained_model sshleifer/bart-tiny-random" ;
+do
+
+    # train
+    genienlp train --train_tasks almond --train_batch_tokens 50 --val_batch_size 50 --train_iterations 6 --preserve_case --save_every 2 --log_every 2 --val_every 2 --save $workdir/model_$i --data $SRCDIR/dataset/  $hparams --exist_ok --skip_cache --embeddings $EMBEDDING_DIR --no_commit
+
+    for server_flags in "" "--continuous_batching" ;
+    do
+        # starts a server, sends requests from the almond dev set at 20 requests per second, and fails if any request fails
+        genienlp load-test --path $workdir/model_$i --server_args "--embeddings $EMBEDDING_DIR $server_flags" --input $SRCDIR/dataset/almond/eval.tsv \
+          --task almond --qps 20 --num_requests 100 --output $workdir/load_test_$i.json
+        python3 -c "import json; results = json.load(open('$workdir/load_test_$i.json')); assert results['requests'] == 100, results"
+    done
+
+    # run a server in the background and check its behavior with raw connections
+    start_server
+    check_server <<EOF
+import json, socket, struct
+import msgpack
+
+def send_line(connection, data):
+    connection.sendall(data)
+    return json.loads(connection.makefile('rb').readline())
+
+def send_frame(connection, data):
+    connection.sendall(struct.pack('>I', len(data)) + data)
+    reader = connection.makefile('rb')
+    (size,) = struct.unpack('>I', reader.read(4))
+    return msgpack.unpackb(reader.read(size), raw=False)
+
+request = {'id': 1, 'task': 'almond', 'context': 'show me .', 'question': 'translate to thingtalk'}
+
+# malformed messages get an error response, and the connection keeps working
+connection = socket.create_connection(('localhost', 8402))
+for data in [b'not json\n', b'[1, 2]\n']:
+    response = send_line(connection, data)
+    assert response['id'] is None and response['error'] == 'invalid_request', response
+assert 'answer' in send_line(connection, (json.dumps(request) + '\n').encode('utf-8'))
+connection.close()
+
+connection = socket.create_connection(('localhost', 8402))
+assert send_line(connection, b'{"protocol": "msgpack"}\n') == {'protocol': 'msgpack'}
+response = send_frame(connection, b'\xc1')
+assert response['id'] is None and response['error'] == 'invalid_request', response
+assert 'answer' in send_frame(connection, msgpack.packb(request, use_bin_type=True))
+connection.close()
+EOF
+
+    # warmup: the synthetic requests run before the server is ready are not reported in the metrics, and they leave
+    # nothing slow for the first real request (the bound is loose, this only catches lazy initialization on the first request)
+    start_server --cache_size 0
+    check_server <<EOF
+import statistics, time
+from genienlp.client import Client
+$metric_py
+assert metric('genienlp_ready') == 1
+assert all(metric(f'genienlp_stage_seconds_count{{stage="{stage}"}}') == 0 for stage in ['preprocess', 'encode', 'generate'])
+with Client(port=8402) as client:
+    latencies = []
+    for context in ['show me .', 'get a cat picture .', 'what time is it ?'] * 4:
+        start = time.perf_counter()
+        client.predict(context, task='almond')
+        latencies.append(time.perf_counter() - start)
+assert metric('genienlp_stage_seconds_count{stage="generate"}') == len(latencies)
+assert latencies[0] < max(10 * statistics.median(latencies[1:]), 0.5), latencies
+EOF
+
+    # admission control: long inputs, malformed deadlines, requests that cannot meet their deadline and requests beyond the
+    # queue limit are rejected
+    # (each batch holds a single request, so a burst of requests fills the queue while the model runs)
+    start_server --cache_size 0 --max_input_words 20 --max_queue_size 1 --max_batch_tokens 10
+    check_server <<EOF
+from genienlp.client import Client, ClientError
+
+def error_code(future):
+    try:
+        future.result()
+    except ClientError as e:
+        return e.code
+    return None
+
+with Client(port=8402) as client:
+    request = {'task': 'almond', 'context': 'show me .', 'question': 'translate to thingtalk'}
+    assert 'answer' in client.request(request)
+    code = error_code(client.submit(dict(request, context=' '.join(['word'] * 30))))
+    assert code == 'input_too_long', code
+    code = error_code(client.submit(dict(request, deadline_ms=0)))
+    assert code in ('overloaded', 'deadline_exceeded'), code
+    for deadline_ms in ['soon', -5, True, [100]]:
+        code = error_code(client.submit(dict(request, deadline_ms=deadline_ms)))
+        assert code == 'invalid_request', (deadline_ms, code)
+
+    codes = [error_code(future) for future in [client.submit(request) for _ in range(50)]]
+    assert set(codes) == {None, 'overloaded'}, codes
+    # the server recovers once the burst is over
+    assert 'answer' in client.request(request)
+EOF
+
+    # batch splitting: a request with more input tokens than --val_batch_size runs as several batches, and its answers
+    # come back in the order of its instances
+    start_server --cache_size 0 --val_batch_size 30
+    check_server <<EOF
+from genienlp.client import Client
+$metric_py
+with Client(port=8402) as client:
+    contexts = ['show me .', 'show me my emails from bob sent yesterday about the meeting .', 'get a cat picture .',
+                'post on twitter that i am running late for the meeting with alice and bob today .', 'what time is it ?',
+                'when i receive an email from my boss , send me a notification with its subject and its sender .']
+    answers = [client.predict(context, task='almond') for context in contexts]
+    batches, examples = metric('genienlp_batch_examples_count'), metric('genienlp_batch_examples_sum')
+    response = client.request({'task': 'almond', 'instances': [{'context': context, 'question': ''} for context in contexts]})
+    assert [instance['answer'] for instance in response['instances']] == answers, response
+    assert metric('genienlp_batch_examples_count') - batches > 1
+    assert metric('genienlp_batch_examples_sum') - examples == len(contexts)
+EOF
+
+    # encoder cache: without the response cache, an input that a session sends again skips the encoder
+    start_server --cache_size 0
+    check_server <<EOF
+from genienlp.client import Client
+$metric_py
+with Client(port=8402) as client:
+    def predict(task='almond', session='s'):
+        hits, misses = metric('genienlp_encoder_cache_hits'), metric('genienlp_encoder_cache_misses')
+        answer = client.predict('show me .', 'translate to thingtalk', task=task, session=session)
+        return answer, metric('genienlp_encoder_cache_hits') - hits, metric('genienlp_encoder_cache_misses') - misses
+
+    answer, hits, misses = predict()
+    assert (hits, misses) == (0, 1), (hits, misses)
+    assert predict() == (answer, 1, 0)
+    # another session, another task, or the same input after a reload go through the encoder again
+    assert predict(session='t') == (answer, 0, 1)
+    assert predict(task='generic')[1:] == (0, 1)
+    assert client.request({'command': 'reload'})['status'] == 'ok'
+    assert predict() == (answer, 0, 1)
+    assert predict() == (answer, 1, 0)
+EOF
+
+    # response cache: repeated requests are hits, and the least recently used entry is evicted when the cache is full
+    start_server --cache_size 2
+    check_server <<EOF
+from genienlp.client import Client
+$metric_py
+with Client(port=8402) as client:
+    def predict(context):
+        hits, misses = metric('genienlp_cache_hits'), metric('genienlp_cache_misses')
+        client.predict(context, 'translate to thingtalk', task='almond')
+        return metric('genienlp_cache_hits') - hits, metric('genienlp_cache_misses') - misses
+
+    evictions = metric('genienlp_cache_evictions')
+    assert predict('show me a .') == (0, 1)
+    assert predict('show me b .') == (0, 1)
+    assert predict('show me a .') == (1, 0)
+    # a was used more recently than b, so c evicts b
+    assert predict('show me c .') == (0, 1)
+    assert metric('genienlp_cache_evictions') - evictions == 1
+    assert metric('genienlp_cache_size') == 2
+    assert predict('show me a .') == (1, 0)
+    assert predict('show me b .') == (0, 1)
+    assert metric('genienlp_cache_evictions') - evictions == 2
+EOF
+
+    # model pool: with a memory budget smaller than any model, using a model unloads the one that was used before it
+    start_server --cache_size 0 --models a=$workdir/model_$i b=$workdir/model_$i --model_memory_budget 1
+    check_server <<EOF
+from genienlp.client import Client
+$metric_py
+def pool_state(name):
+    return tuple(metric(f'genienlp_{m}{{model="{name}"}}') for m in ['model_resident', 'model_loads', 'model_evictions'])
+
+with Client(port=8402) as client:
+    answer = client.predict('show me .', 'translate to thingtalk', task='almond')
+    assert pool_state('a') == pool_state('b') == (0, 0, 0)
+    assert client.predict('show me .', 'translate to thingtalk', task='almond', model='a') == answer
+    assert pool_state('a') == (1, 1, 0)
+    assert client.predict('show me .', 'translate to thingtalk', task='almond', model='b') == answer
+    assert pool_state('a') == (0, 1, 1) and pool_state('b') == (1, 1, 0)
+    # a is loaded again from disk
+    assert client.predict('show me .', 'translate to thingtalk', task='almond', model='a') == answer
+    assert pool_state('a') == (1, 2, 1) and pool_state('b') == (0, 1, 1)
+EOF
+
+    # hot reload: reloading another checkpoint changes the model hash, and the responses of the old model are not reused
+    cp $workdir/model_$i/best.pth $workdir/model_$i/reloaded.pth
+    start_server
+    check_server <<EOF
+from genienlp.client import Client, ClientError
+$metric_py
+with Client(port=8402) as client:
+    def predict():
+        hits, misses = metric('genienlp_cache_hits'), metric('genienlp_cache_misses')
+        answer = client.predict('show me .', 'translate to thingtalk', task='almond')
+        return answer, metric('genienlp_cache_hits') - hits, metric('genienlp_cache_misses') - misses
+
+    # reloading the same checkpoint keeps its hash
+    old_hash = client.request({'command': 'reload'})['model_hash']
+    assert client.request({'command': 'reload'})['model_hash'] == old_hash
+    answer, _, _ = predict()
+    assert predict() == (answer, 1, 0)
+    response = client.request({'command': 'reload', 'checkpoint_name': 'reloaded.pth'})
+    assert response['status'] == 'ok' and response['model_hash'] != old_hash, response
+    # same weights, so the same answer, but it comes from the new model
+    assert predict() == (answer, 0, 1)
+
+    # clients cannot load files from outside the model directory
+    for command in [{'checkpoint_name': '../model_$i/best.pth'}, {'checkpoint_name': '/etc/passwd'}, {'path': '$workdir'}]:
+        try:
+            client.request(dict(command, command='reload'))
+            assert False, command
+        except ClientError as e:
+            assert e.code == 'invalid_command', e
+EOF
+
+    # workers: both workers answer requests, and SIGHUP replaces them with workers forked after the parent reloads the model
+    # (worker i serves its metrics on --metrics_port + i)
+    start_server --workers 2
+    check_server <<EOF
+import os, signal, subprocess, time
+from genienlp.client import Client
+
+def workers():
+    return set(subprocess.run(['pgrep', '-P', '$SERVER_PID'], stdout=subprocess.PIPE, universal_newlines=True).stdout.split())
+
+contexts = ['show me .', 'get a cat picture .', 'what time is it ?', 'show me my emails .']
+with Client(port=8402) as client:
+    answers = [client.predict(context, task='almond') for context in contexts]
+old_workers = workers()
+assert len(old_workers) == 2, old_workers
+
+os.kill($SERVER_PID, signal.SIGHUP)
+deadline = time.time() + 300
+while True:
+    new_workers = workers()
+    if len(new_workers) == 2 and not new_workers & old_workers:
+        break
+    assert time.time() < deadline, (old_workers, new_workers)
+    time.sleep(1)
+# the old workers closed their connections, so this needs a new client
+with Client(port=8402) as client:
+    assert [client.predict(context, task='almond') for context in contexts] == answers
+EOF
+
+    # streaming: partial answers arrive before the response, which has the same answer as without streaming
+    for server_flags in "" "--continuous_batching" ;
+    do
+        start_server --cache_size 0 $server_flags
+        check_server <<EOF
+from genienlp.client import Client
+
+with Client(port=8402) as client:
+    request = {'id': 'r', 'task': 'almond', 'context': 'show me .', 'question': 'translate to thingtalk'}
+    answer = client.request(request)['answer']
+    partials = []
+    response = client.request(dict(request, stream=True), on_partial=partials.append)
+    assert response['answer'] == answer, response
+    assert partials and all(p['id'] == 'r' and isinstance(p['partial'], str) for p in partials), partials
+
+    instances = [{'context': 'show me .', 'question': ''}, {'context': 'show me my emails .', 'question': ''}]
+    answers = [instance['answer'] for instance in client.request({'task': 'almond', 'instances': instances})['instances']]
+    partials = []
+    response = client.request({'task': 'almond', 'instances': instances, 'stream': True}, on_partial=partials.append)
+    assert [instance['answer'] for instance in response['instances']] == answers, response
+    assert set(p['instance'] for p in partials) == {0, 1}, partials
+EOF
+    done
+
+    # continuous batching: requests that arrive while others are decoding, and are merged into their batch, get the same
+    # answers as with regular batches
+    for server_flags in "" "--continuous_batching" ;
+    do
+        start_server --cache_size 0 $server_flags
+        check_server <<EOF
+import json, time
+from genienlp.client import Client
+
+with open('$SRCDIR/dataset/almond/eval.tsv') as fp:
+    contexts = [line.split('\t')[1] for line in fp][:20]
+with Client(port=8402) as client:
+    futures = []
+    for context in contexts:
+        futures.append(client.submit({'task': 'almond', 'context': context, 'question': ''}))
+        # the next request arrives while the previous ones are still decoding
+        time.sleep(0.02)
+    answers = [future.result()['answer'] for future in futures]
+with open('$workdir/answers$server_flags.json', 'w') as fp:
+    json.dump(answers, fp, indent=2)
+EOF
+    done
+    diff -u $workdir/answers.json $workdir/answers--continuous_batching.json
+
+    rm -rf $workdir/model_$i
+    i=$((i+1))
+done
+
+rm -fr $workdir
+rm -rf $SRCDIR/torch-shm-file-*